@@ -39,7 +39,7 @@ from .updater import Updater
 from .babel import babel, get_locale
 from . import config_sql
 from . import cache_buster
-from . import ub, db
+from . import ub, db, thumbnail_index
 
 # PostgreSQL/SQLAlchemy imports
 from sqlalchemy import create_engine
@@ -76,6 +76,8 @@ except ImportError:
 
 mimetypes.init()
 mimetypes.add_type('application/javascript', '.mjs')
+mimetypes.add_type('image/webp', '.webp')
+mimetypes.add_type('image/avif', '.avif')
 # ... (mimetype definitions remain the same)
 
 
@@ -256,6 +258,13 @@ def create_app():
     # db.CalibreDB.setup_db(config.config_calibre_dir)
     db.CalibreDB.setup_db(config.config_calibre_dir, cli_param.settings_path)
     calibre_db.init_db()
+    thumbnail_index.load(ub.session)
+
+    # Background tasks are stored in the shared task queue table unless TASK_QUEUE=memory
+    if (os.getenv("TASK_QUEUE") or "database") == "database":
+        from .services.worker import WorkerThread
+        from .services.task_store import DatabaseTaskStore
+        WorkerThread.get_instance().set_store(DatabaseTaskStore(ub.session.get_bind(), ub.TaskQueueEntry.__table__))
 
     updater_thread.init_updater(config, web_server)
     # Perform dry run of updater and exit afterward
@@ -50,11 +50,11 @@ from .helper import check_valid_domain, send_test_mail, reset_password, generate
     valid_email, check_username
 from .embed_helper import get_calibre_binarypath
 from .gdriveutils import is_gdrive_ready, gdrive_support
-from .render_template import render_title_template, get_sidebar_config
+from .render_template import render_title_template, get_sidebar_config, SHELVES_NAMESPACE
 from .services.worker import WorkerThread
 from .usermanagement import user_login_required
 from .babel import get_available_translations, get_available_locale, get_user_locale_language
-from . import debug_info
+from . import debug_info, tiered_cache
 from .utils import get_env_path 
 import urllib
 
@@ -801,6 +801,7 @@ def edit_restriction(res_type, user_id):
             elementlist[int(element['id'][1:])] = element['Element']
             usr.denied_column_value = ','.join(elementlist)
             ub.session_commit("Changed denied columns of user {} to {}".format(usr.name, usr.denied_column_value))
+    calibre_db.invalidate_common_filters()
     return ""
 
 @admi.route("/ajax/addrestriction/<int:res_type>", methods=['POST'])
@@ -852,6 +853,7 @@ def add_restriction(res_type, user_id):
             usr.denied_column_value = restriction_addition(element, usr.list_denied_column_values)
             ub.session_commit("Changed denied columns of user {} to {}".format(usr.name,
                                                                                usr.list_denied_column_values()))
+    calibre_db.invalidate_common_filters()
     return ""
 
 @admi.route("/ajax/deleterestriction/<int:res_type>", methods=['POST'])
@@ -904,6 +906,7 @@ def delete_restriction(res_type, user_id):
             usr.denied_column_value = restriction_deletion(element, usr.list_denied_column_values)
             ub.session_commit("Deleted denied columns of user {}: {}".format(usr.name,
                                                                              usr.list_denied_column_values()))
+    calibre_db.invalidate_common_filters()
     return ""
 
 @admi.route("/ajax/listrestriction/<int:res_type>", defaults={"user_id": 0})
@@ -1864,6 +1867,7 @@ def _db_configuration_update_helper():
             # Delete user data related to old database
             try:
                 ub.session.query(ub.Downloads).delete()
+                ub.session.query(ub.DownloadCount).delete()
                 ub.session.query(ub.ArchivedBook).delete()
                 ub.session.query(ub.ReadBook).delete()
                 ub.session.query(ub.BookShelf).delete()
@@ -2302,7 +2306,10 @@ def _delete_user(content):
         if content.name != "Guest":
             # 🧹 Delete all related data for this user
             ub.session.query(ub.ReadBook).filter_by(user_id=content.id).delete()
+            downloaded_books = [book_id for book_id, in
+                                ub.session.query(ub.Downloads.book_id).filter_by(user_id=content.id)]
             ub.session.query(ub.Downloads).filter_by(user_id=content.id).delete()
+            ub.refresh_download_counts(ub.session, downloaded_books)
             for us in ub.session.query(ub.Shelf).filter_by(user_id=content.id):
                 ub.session.query(ub.BookShelf).filter_by(shelf=us.id).delete()
             ub.session.query(ub.Shelf).filter_by(user_id=content.id).delete()
@@ -2325,6 +2332,8 @@ def _delete_user(content):
             ub.session.query(ub.User).filter_by(id=content.id).delete()
 
             ub.session_commit()
+            # the bulk delete of the shelves does not trigger the cache invalidation of the shelf model
+            tiered_cache.cache.invalidate(SHELVES_NAMESPACE)
             # log.info(f"User {content.name} deleted including OAuth links")
             return _("User '%(nick)s' deleted", nick=content.name)
         else:
@@ -20,6 +20,8 @@
 import os
 import re
 import json
+import time
+import threading
 from datetime import datetime
 from urllib.parse import quote
 import unidecode
@@ -27,8 +29,8 @@ from weakref import WeakSet
 
 from sqlalchemy import create_engine , inspect
 from sqlalchemy import Table, Column, ForeignKey, CheckConstraint
-from sqlalchemy import String, Integer, Boolean, TIMESTAMP, Float, Sequence
-from sqlalchemy.orm import relationship, sessionmaker, scoped_session
+from sqlalchemy import String, Integer, Boolean, TIMESTAMP, Float, Sequence, ARRAY, any_, bindparam
+from sqlalchemy.orm import relationship, sessionmaker, scoped_session, selectinload, aliased
 from sqlalchemy.orm.collections import InstrumentedList
 from sqlalchemy.ext.declarative import DeclarativeMeta
 from sqlalchemy.exc import OperationalError, SQLAlchemyError
@@ -38,15 +40,17 @@ try:
 except ImportError:
     from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.pool import StaticPool
-from sqlalchemy.sql.expression import and_, true, false, text, func, or_
+from sqlalchemy.sql.expression import and_, true, false, text, func, or_, exists
+from sqlalchemy.sql.elements import UnaryExpression
+from sqlalchemy.sql import operators
 from sqlalchemy.ext.associationproxy import association_proxy
 from .cw_login import current_user
 from flask_babel import gettext as _
 from flask_babel import get_locale
-from flask import flash
+from flask import flash, g, has_request_context
 
-from . import logger, ub, isoLanguages,create_metadata_psql
-from .pagination import Pagination
+from . import logger, ub, isoLanguages,create_metadata_psql, search_index
+from .pagination import Pagination, encode_cursor, decode_cursor
 from .utils import get_env_path , get_metadata_path
 from .create_metadata_psql import migrate_sqlite_to_postgres        
 log = logger.create()
@@ -54,6 +58,17 @@ log = logger.create()
 cc_exceptions = ['composite', 'series']
 cc_classes = {}
 
+# seconds a cached book count is reused before the count query is run again
+COUNT_CACHE_TIMEOUT = 60
+_count_cache = {}
+_count_cache_lock = threading.Lock()
+# seconds category counts are reused, edits done by other worker processes are visible after this time at the latest
+CATEGORY_CACHE_TIMEOUT = 600
+_category_cache = {}
+_category_cache_lock = threading.Lock()
+# seconds between two checks if the custom columns of the calibre database changed
+SCHEMA_CHECK_INTERVAL = 30
+
 Base = declarative_base()
 
 books_authors_link = Table('books_authors_link', Base.metadata,
@@ -510,6 +525,8 @@ class CalibreDB:
     config = None
     session_factory = None
     instances = WeakSet()
+    schema_signature = None
+    schema_checked = 0.0
 
     def __init__(self, expire_on_commit=True, init=False):
         self.session = None
@@ -737,6 +754,12 @@ class CalibreDB:
             except OperationalError as e:
                 log.error_or_exception(f"Error setting up custom columns: {e}")
                 return None
+        cls.schema_signature = cls._schema_signature(conn)
+        cls.schema_checked = time.monotonic()
+        # release the locks of the sequence fixes, creating the search index waits for them otherwise
+        conn.close()
+
+        search_index.init_search_index(cls.engine)
 
         cls.session_factory = scoped_session(sessionmaker(
             autocommit=False,
@@ -788,6 +811,14 @@ class CalibreDB:
     def get_book_data_by_id(self, book_id):
         return self.session.query(Data).filter(Data.book == book_id).first()
 
+    # Returns the first format of every book in book_ids with one query
+    def get_book_formats(self, book_ids):
+        formats = dict()
+        for book_id, book_format in (self.session.query(Data.book, Data.format)
+                                     .filter(Data.book.in_(list(book_ids))).order_by(Data.book, Data.id)):
+            formats.setdefault(book_id, book_format)
+        return formats
+
     def set_metadata_dirty(self, book_id):
         if not self.session.query(Metadata_Dirtied).filter(Metadata_Dirtied.book == book_id).one_or_none():
             self.session.add(Metadata_Dirtied(book_id))
@@ -800,19 +831,49 @@ class CalibreDB:
             self.session.rollback()
             log.error("Database error: {}".format(e))
 
-    # Language and content filters for displaying in the UI
+    # Language and content filters for displaying in the UI, the built expression is memoized for the current
+    # request, as one page render calls common_filters several times with identical restrictions
     def common_filters(self, allow_show_archived=False, return_all_languages=False):
+        key = (self.restriction_signature(), allow_show_archived, return_all_languages)
+        cache = self._common_filters_cache()
+        if key in cache:
+            return cache[key]
+        filter_expression = self._build_common_filters(allow_show_archived, return_all_languages)
+        cache[key] = filter_expression
+        return filter_expression
+
+    def restriction_signature(self, user=None):
+        user = user or current_user
+        return (user.id,
+                user.filter_language(),
+                user.allowed_tags or "",
+                user.denied_tags or "",
+                user.allowed_column_value or "",
+                user.denied_column_value or "",
+                self.config.config_restricted_column)
+
+    @staticmethod
+    def _common_filters_cache():
+        if not has_request_context():
+            return dict()
+        if 'common_filters' not in g:
+            g.common_filters = dict()
+        return g.common_filters
+
+    # Has to be called if the archived books or the restrictions of a user were changed during a request
+    def invalidate_common_filters(self, user_id=None):
+        cache = self._common_filters_cache()
+        for key in [k for k in cache if user_id is None or k[0][0] == user_id]:
+            del cache[key]
+
+    def _build_common_filters(self, allow_show_archived=False, return_all_languages=False):
         if not allow_show_archived:
-            archived_books = (ub.session.query(ub.ArchivedBook)
-                              .filter(ub.ArchivedBook.user_id==int(current_user.id))
-                              .filter(ub.ArchivedBook.is_archived==True)
-                              .all())
-            archived_book_ids = [archived_book.book_id for archived_book in archived_books]
-            # Guard: .notin_([]) generates "NOT IN (NULL)" which aborts PostgreSQL transactions
-            if archived_book_ids:
-                archived_filter = Books.id.notin_(archived_book_ids)
-            else:
-                archived_filter = true()
+            # Correlated NOT EXISTS instead of a materialized list of ids, keeps the statement small for users
+            # with many archived books and lets PostgreSQL use an anti join
+            archived = aliased(ub.ArchivedBook)
+            archived_filter = ~exists().where(and_(archived.book_id == Books.id,
+                                                   archived.user_id == int(current_user.id),
+                                                   archived.is_archived == True)).correlate(Books)
         else:
             archived_filter = true()
 
@@ -946,7 +1007,8 @@ class CalibreDB:
         try:
             pagination = Pagination(page, pagesize, query.count())
             try:
-                entries = query.order_by(*order).offset(off).limit(pagesize).all()
+                entries = (query.options(*self.author_load_options(database))
+                           .order_by(*order).offset(off).limit(pagesize).all())
             except OperationalError:
                 self.session.rollback()
                 # Re-generate query after rollback
@@ -963,29 +1025,206 @@ class CalibreDB:
         entries = self.order_authors(entries, True, join_archive_read)
         return entries, randm, pagination
 
+    # Returns the sort column and direction if the order can be continued with a keyset cursor, which is the case
+    # for orders on exactly one column of the books table
+    @staticmethod
+    def keyset_order(order):
+        if not order or len(order) != 1:
+            return None
+        element = order[0]
+        descending = False
+        if isinstance(element, UnaryExpression):
+            if element.modifier is operators.desc_op:
+                descending = True
+            elif element.modifier is not operators.asc_op:
+                return None
+            element = element.element
+        column = getattr(element, 'expression', element)
+        if getattr(column, 'table', None) is not Books.__table__:
+            return None
+        return getattr(Books, column.key), descending
+
+    @staticmethod
+    def _keyset_filter(column, descending, last_value, last_id):
+        # PostgreSQL sorts NULL values last for ascending and first for descending order
+        if descending:
+            if last_value is None:
+                return or_(column.isnot(None), and_(column.is_(None), Books.id < last_id))
+            return or_(column < last_value, and_(column == last_value, Books.id < last_id))
+        if last_value is None:
+            return and_(column.is_(None), Books.id > last_id)
+        return or_(column > last_value, and_(column == last_value, Books.id > last_id), column.is_(None))
+
+    # Fill a page continuing after the row addressed by cursor (keyset pagination), the cost of a page does not
+    # depend on its depth. Returns the entries, the cursor of the next page (None on the last page) and the number
+    # of books according to count_mode
+    def fill_indexpage_keyset(self, cursor, database, pagesize, db_filter, order, allow_show_archived,
+                              config_read_column, count_mode="cached"):
+        pagesize = int(pagesize or self.config.config_books_per_page)
+        column, descending = self.keyset_order(order)
+        query = (self.generate_linked_query(config_read_column, database)
+                 .filter(db_filter)
+                 .filter(self.common_filters(allow_show_archived)))
+        total_count = self.count_books(query, count_mode)
+        if cursor:
+            last_value, last_id = decode_cursor(cursor)
+            query = query.filter(self._keyset_filter(column, descending, last_value, last_id))
+        entries = (query.options(*self.author_load_options(database))
+                   .order_by(order[0], Books.id.desc() if descending else Books.id.asc())
+                   .limit(pagesize + 1).all())
+        next_cursor = None
+        if len(entries) > pagesize:
+            entries = entries[:pagesize]
+            last_book = entries[-1][0]
+            next_cursor = encode_cursor([getattr(last_book, column.key), last_book.id])
+        entries = self.order_authors(entries, True, True)
+        return entries, next_cursor, total_count
+
+    # count_mode: "exact" runs count(), "cached" reuses an exact count of the same statement for
+    # COUNT_CACHE_TIMEOUT seconds, "estimate" takes the row estimate of the PostgreSQL planner, None skips counting
+    def count_books(self, query, count_mode="exact"):
+        if not count_mode:
+            return None
+        if count_mode == "exact":
+            return query.count()
+        statement = query.statement.compile(dialect=self.session.bind.dialect,
+                                            compile_kwargs={"render_postcompile": True})
+        if count_mode == "estimate":
+            try:
+                plan = self.session.connection().exec_driver_sql("EXPLAIN (FORMAT JSON) " + str(statement),
+                                                                 statement.params).scalar()
+                if isinstance(plan, str):
+                    plan = json.loads(plan)
+                return int(plan[0]["Plan"]["Plan Rows"])
+            except (SQLAlchemyError, KeyError, IndexError, TypeError, ValueError) as ex:
+                log.debug("Count estimation failed, falling back to exact count: {}".format(ex))
+                return query.count()
+        key = (str(statement), repr(sorted(statement.params.items())))
+        now = time.monotonic()
+        with _count_cache_lock:
+            cached = _count_cache.get(key)
+        if cached and now - cached[0] < COUNT_CACHE_TIMEOUT:
+            return cached[1]
+        # counted outside of the lock, requests of other statements don't wait for it
+        count = query.count()
+        with _count_cache_lock:
+            if len(_count_cache) > 1000:
+                _count_cache.clear()
+            _count_cache[key] = (now, count)
+        return count
+
+    # The books visible for the current user only depend on these values, the user id is only part of it if the
+    # user archived books
+    def category_signature(self):
+        if has_request_context() and 'category_signature' in g:
+            return g.category_signature
+        archived = ub.session.query(exists().where(and_(ub.ArchivedBook.user_id == int(current_user.id),
+                                                        ub.ArchivedBook.is_archived == True))).scalar()
+        signature = self.restriction_signature()[1:] + (int(current_user.id) if archived else None,)
+        if has_request_context():
+            g.category_signature = signature
+        return signature
+
+    # Returns the value created by builder for name, shared by all users with the same category signature
+    def cached_by_restriction(self, name, builder):
+        key = (name, self.category_signature())
+        now = time.monotonic()
+        with _category_cache_lock:
+            cached = _category_cache.get(key)
+        if cached and now - cached[0] < CATEGORY_CACHE_TIMEOUT:
+            return cached[1]
+        value = builder()
+        with _category_cache_lock:
+            if len(_category_cache) > 1000:
+                _category_cache.clear()
+            _category_cache[key] = (now, value)
+        return value
+
+    # Has to be called if books were created, edited or deleted, or if a user archived books
+    @staticmethod
+    def invalidate_category_cache(user_id=None):
+        with _category_cache_lock:
+            if user_id is None:
+                _category_cache.clear()
+            else:
+                for key in [k for k in _category_cache if k[1][-1] == user_id]:
+                    _category_cache.pop(key, None)
+        if has_request_context():
+            g.pop('category_signature', None)
+
+    # Link column of the category, link column of the book and the condition of the link for books with category
+    @staticmethod
+    def _category_link(kind):
+        if kind == 'author':
+            return books_authors_link.c.author, books_authors_link.c.book, None
+        if kind == 'tag':
+            return books_tags_link.c.tag, books_tags_link.c.book, true()
+        if kind == 'series':
+            return books_series_link.c.series, books_series_link.c.book, true()
+        if kind == 'publisher':
+            return books_publishers_link.c.publisher, books_publishers_link.c.book, true()
+        if kind == 'rating':
+            return (books_ratings_link.c.rating, books_ratings_link.c.book,
+                    and_(books_ratings_link.c.rating == Ratings.id, Ratings.rating > 0))
+        if kind == 'language':
+            return books_languages_link.c.lang_code, books_languages_link.c.book, true()
+        if kind == 'format':
+            return Data.format, Data.book, true()
+        raise ValueError("Unknown category {}".format(kind))
+
+    def get_category_counts(self, kind, return_all_languages=False):
+        """Returns the number of visible books per category id (format name for formats) and the number of
+        visible books without category"""
+        def build():
+            category, book, linked = self._category_link(kind)
+            book_filter = self.common_filters(return_all_languages=return_all_languages)
+            counts = dict(self.session.query(category, func.count(book))
+                          .join(Books, Books.id == book).filter(book_filter)
+                          .group_by(category).all())
+            no_category_count = 0
+            if linked is not None:
+                no_category_count = (self.session.query(Books).filter(book_filter)
+                                     .filter(~exists().where(and_(book == Books.id, linked)))
+                                     .count())
+            return counts, no_category_count
+        return self.cached_by_restriction(('counts', kind, return_all_languages), build)
+
+    # Condition for the categories with visible books, the ids of the cached counts are sent as one array parameter
+    @staticmethod
+    def category_filter(column, counts):
+        return column == any_(bindparam(None, list(counts), type_=ARRAY(Integer)))
+
+    # Sort column and link table of the alphabetical navigation per kind
+    @staticmethod
+    def _letter_column(kind):
+        if kind == 'book':
+            return Books.sort, None
+        if kind == 'author':
+            return Authors.sort, books_authors_link
+        if kind == 'tag':
+            return Tags.name, books_tags_link
+        if kind == 'series':
+            return Series.sort, books_series_link
+        if kind == 'publisher':
+            return Publishers.name, books_publishers_link
+        raise ValueError("Unknown letter index {}".format(kind))
+
+    def get_letter_index(self, kind):
+        """Returns the sorted upper case first letters of all entries of kind with visible books"""
+        def build():
+            column, linked_table = self._letter_column(kind)
+            char = func.upper(func.substr(column, 1, 1))
+            query = self.session.query(char)
+            if linked_table is not None:
+                query = query.join(linked_table).join(Books)
+            query = query.filter(self.common_filters()).group_by(char).order_by(char)
+            return [letter for letter, in query if letter]
+        return self.cached_by_restriction(('letters', kind), build)
+
     # Orders all Authors in the list according to authors sort
     def order_authors(self, entries, list_return=False, combined=False):
         for entry in entries:
-            if combined:
-                sort_authors = entry.Books.author_sort.split('&')
-                ids = [a.id for a in entry.Books.authors]
-            else:
-                sort_authors = entry.author_sort.split('&')
-                ids = [a.id for a in entry.authors]
-            authors_ordered = list()
-            for auth in sort_authors:
-                results = self.session.query(Authors).filter(Authors.sort == auth.lstrip().strip()).all()
-                if not len(results):
-                    log.error("Author {} not found to display name in right order".format(auth.strip()))
-                    break
-                for r in results:
-                    if r.id in ids:
-                        authors_ordered.append(r)
-                        ids.remove(r.id)
-            for author_id in ids:
-                result = self.session.query(Authors).filter(Authors.id == author_id).first()
-                authors_ordered.append(result)
-
+            authors_ordered = self._order_book_authors(entry.Books if combined else entry)
             if list_return:
                 if combined:
                     entry.Books.authors = authors_ordered
@@ -995,6 +1234,29 @@ class CalibreDB:
                 return authors_ordered
         return entries
 
+    # Authors are matched against the already loaded authors of the book, so ordering a whole page costs no
+    # additional queries if the page query eager loads Books.authors (see author_load_options)
+    @staticmethod
+    def _order_book_authors(book):
+        remaining = list(book.authors)
+        authors_ordered = list()
+        for auth in (book.author_sort or "").split('&'):
+            sort_name = auth.strip()
+            results = [a for a in remaining if a.sort == sort_name]
+            if not len(results):
+                log.error("Author {} not found to display name in right order".format(sort_name))
+                break
+            for r in results:
+                authors_ordered.append(r)
+                remaining.remove(r)
+        authors_ordered.extend(remaining)
+        return authors_ordered
+
+    @staticmethod
+    def author_load_options(database=Books):
+        # Loads the authors of all books of a page with one additional query instead of one query per book
+        return [selectinload(Books.authors)] if database is Books else []
+
     def get_typeahead(self, database, query, replace=('', ''), tag_filter=true()):
         query = query or ''
         # PostgreSQL uses ILIKE for case-insensitive search
@@ -1030,6 +1292,9 @@ class CalibreDB:
         elif len(join) == 1:
             query = query.outerjoin(join[0])
 
+        if search_index.is_ready():
+            return query.filter(self.common_filters(True)).filter(Books.id.in_(search_index.matching_books(term)))
+
         cc = self.get_cc_columns(config, filter_config_custom_read=True)
         filter_expression = [Books.tags.any(func.lower(Tags.name).ilike("%" + term + "%")),
                              Books.series.any(func.lower(Series.name).ilike("%" + term + "%")),
@@ -1066,21 +1331,33 @@ class CalibreDB:
         return cc
 
     # read search results from calibre-database and return it (function is used for feed and simple search
-    def get_search_results(self, term, config, offset=None, order=None, limit=None, *join):
-        order = order[0] if order else [Books.sort]
+    def get_search_results(self, term, config, offset=None, order=None, limit=None, *join, count_mode="exact"):
+        query = self.search_query(term, config, *join)
+        # the number of matches is counted on the plain query, the result page is fetched with offset and limit
+        result_count = self.count_books(query, count_mode)
+        if order:
+            order = order[0]
+        elif search_index.is_ready():
+            # without explicit order the best matches are shown first
+            query = query.outerjoin(search_index.search_index_table,
+                                    search_index.search_index_table.c.book == Books.id)
+            order = [search_index.rank(term).desc(), Books.sort]
+        else:
+            order = [Books.sort]
         pagination = None
-        result = self.search_query(term, config, *join).order_by(*order).all()
-        result_count = len(result)
+        query = query.options(*self.author_load_options()).order_by(*order)
         if offset is not None and limit is not None:
             offset = int(offset)
-            limit_all = offset + int(limit)
             pagination = Pagination((offset / (int(limit)) + 1), limit, result_count)
-        else:
-            offset = 0
-            limit_all = result_count
+            query = query.offset(offset).limit(int(limit))
 
-        ub.store_combo_ids(result)
-        entries = self.order_authors(result[offset:limit_all], list_return=True, combined=True)
+        ub.store_search_query('simple', term)
+        entries = self.order_authors(query.all(), list_return=True, combined=True)
+        if result_count is None:
+            result_count = len(entries)
+        if not offset and len(entries) == result_count:
+            # the complete result is already loaded, no need to run the search again for adding it to a shelf
+            ub.store_combo_ids(entries)
 
         return entries, result_count, pagination
 
@@ -1088,33 +1365,22 @@ class CalibreDB:
     def speaking_language(self, languages=None, return_all_languages=False, with_count=False, reverse_order=False):
 
         if with_count:
+            no_lang_count = 0
             if not languages:
-                subquery = self.session.query(books_languages_link.c.lang_code, func.count(books_languages_link.c.book).label('count'))\
-                    .join(Books, Books.id == books_languages_link.c.book)\
-                    .filter(self.common_filters(return_all_languages=return_all_languages)) \
-                    .group_by(books_languages_link.c.lang_code).subquery()
-                languages = self.session.query(Languages, subquery.c.count) \
-                    .join(subquery, Languages.id == subquery.c.lang_code).all()
+                counts, no_lang_count = self.get_category_counts('language', return_all_languages)
+                languages = [(lang, counts[lang.id]) for lang in self.session.query(Languages)
+                             .filter(self.category_filter(Languages.id, counts))]
             tags = list()
             for lang in languages:
                 tag = Category(isoLanguages.get_language_name(get_locale(), lang[0].lang_code), lang[0].lang_code)
                 tags.append([tag, lang[1]])
-            if not return_all_languages:
-                no_lang_count = (self.session.query(Books)
-                                 .outerjoin(books_languages_link).outerjoin(Languages)
-                                 .filter(Languages.lang_code==None)
-                                 .filter(self.common_filters())
-                                 .count())
-                if no_lang_count:
-                    tags.append([Category(_("None"), "none"), no_lang_count])
+            if not return_all_languages and no_lang_count:
+                tags.append([Category(_("None"), "none"), no_lang_count])
             return sorted(tags, key=lambda x: x[0].name.lower(), reverse=reverse_order)
         else:
             if not languages:
-                languages = self.session.query(Languages) \
-                    .join(books_languages_link) \
-                    .join(Books) \
-                    .filter(self.common_filters(return_all_languages=return_all_languages)) \
-                    .group_by(Languages.id).all()
+                counts = self.get_category_counts('language', return_all_languages)[0]
+                languages = self.session.query(Languages).filter(self.category_filter(Languages.id, counts)).all()
             for lang in languages:
                 lang.name = isoLanguages.get_language_name(get_locale(), lang.lang_code)
             return sorted(languages, key=lambda x: x.name, reverse=reverse_order)
@@ -1159,7 +1425,34 @@ class CalibreDB:
         if self.engine:
             self.engine.dispose()
         self.setup_db(config.config_calibre_dir, app_db_path)
-        self.update_config(config)
+        self.update_config(config, config.config_calibre_dir, app_db_path)
+
+    # The mapped classes only depend on the custom columns, books changed by other processes are visible without
+    # reconnecting
+    @staticmethod
+    def _schema_signature(conn):
+        try:
+            return tuple(tuple(row) for row in
+                         conn.execute(text("SELECT id, datatype, is_multiple FROM custom_columns ORDER BY id")))
+        except SQLAlchemyError as ex:
+            log.debug("Reading custom columns failed: {}".format(ex))
+            return None
+
+    def refresh_db(self, config, app_db_path):
+        """Gives a fresh view of the library, the database is only reconnected if the custom columns changed"""
+        if not self.session:
+            return
+        self.session.expire_all()
+        now = time.monotonic()
+        if now - self.schema_checked < SCHEMA_CHECK_INTERVAL:
+            return
+        CalibreDB.schema_checked = now
+        signature = self._schema_signature(self.session.connection())
+        if signature is None:
+            self.session.rollback()
+        elif signature != self.schema_signature:
+            log.info("Custom columns of the calibre database changed, reconnecting")
+            self.reconnect_db(config, app_db_path)
 
 
 def lcase(s):
@@ -28,7 +28,7 @@ import os
 
 from flask import send_file, __version__
 
-from . import logger, config
+from . import logger, config, tiered_cache
 from .about import collect_stats
 
 log = logger.create()
@@ -69,6 +69,7 @@ def send_debug():
     with zipfile.ZipFile(memory_zip, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
         zf.writestr('settings.txt', json.dumps(config.to_dict(), sort_keys=True, indent=2))
         zf.writestr('libs.txt', json.dumps(collect_stats(), sort_keys=True, indent=2, cls=lazyEncoder))
+        zf.writestr('cache.txt', json.dumps(tiered_cache.cache.stats(), sort_keys=True, indent=2))
         for fp in file_list:
             zf.write(fp, os.path.basename(fp))
     memory_zip.seek(0)
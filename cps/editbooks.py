@@ -37,7 +37,7 @@ from sqlalchemy.exc import OperationalError, IntegrityError, InterfaceError
 from sqlalchemy.orm.exc import StaleDataError
 from sqlalchemy.sql.expression import func
 
-from . import constants, logger, isoLanguages, gdriveutils, uploader, helper, kobo_sync_status
+from . import constants, logger, isoLanguages, gdriveutils, uploader, helper, kobo_sync_status, search_index
 from .clean_html import clean_string
 from . import config, ub, db, calibre_db
 from .services.worker import WorkerThread
@@ -216,6 +216,7 @@ def edit_book(book_id):
 
         calibre_db.session.merge(book)
         calibre_db.session.commit()
+        metadata_changed([book.id])
         if config.config_use_google_drive:
             gdriveutils.updateGdriveCalibreFromLocal()
         if meta is not False \
@@ -307,6 +308,7 @@ def upload():
                     calibre_db.set_metadata_dirty(book_id)
                 # save data to database, reread data
                 calibre_db.session.commit()
+                metadata_changed([book_id])
 
                 if config.config_use_google_drive:
                     gdriveutils.updateGdriveCalibreFromLocal()
@@ -477,6 +479,7 @@ def edit_list_book(param):
         if param == 'title' and vals.get('checkT') == "false":
             book.sort = sort_param
             calibre_db.session.commit()
+        metadata_changed([book.id])
     except (OperationalError, IntegrityError, StaleDataError) as e:
         calibre_db.session.rollback()
         log.error_or_exception("Database error: {}".format(e))
@@ -594,6 +597,7 @@ def table_xchange_author_title():
                 calibre_db.session.rollback()
                 log.error_or_exception("Database error: {}".format(e))
                 return json.dumps({'success': False})
+            metadata_changed([book.id])
 
             if config.config_use_google_drive:
                 gdriveutils.updateGdriveCalibreFromLocal()
@@ -832,6 +836,12 @@ def move_coverfile(meta, db_book):
               category="error")
 
 
+# Has to be called after book metadata was committed, keeps derived data in sync with the database
+def metadata_changed(book_ids):
+    search_index.update_books(calibre_db, book_ids)
+    calibre_db.invalidate_category_cache()
+
+
 def delete_whole_book(book_id, book):
     # delete book from shelves, Downloads, Read list
     ub.session.query(ub.BookShelf).filter(ub.BookShelf.book_id == book_id).delete()
@@ -931,6 +941,7 @@ def delete_book_from_table(book_id, book_format, json_response, location=""):
                     if book_format.upper() in ['KEPUB', 'EPUB', 'EPUB3']:
                         kobo_sync_status.remove_synced_book(book.id, True)
                 calibre_db.session.commit()
+                metadata_changed([book_id])
             except Exception as ex:
                 log.error_or_exception(ex)
                 calibre_db.session.rollback()
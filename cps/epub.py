@@ -17,17 +17,32 @@
 #  along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import posixpath
 import zipfile
+from collections import namedtuple
+from datetime import datetime
+
 from lxml import etree
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import SQLAlchemyError
 
 from . import isoLanguages, cover
-from . import config, logger
+from . import config, logger, ub
 from .helper import split_authors
 from .epub_helper import get_content_opf, default_ns
 from .constants import BookMeta
 
 log = logger.create()
 
+# Package facts (opf version, rendition layout, spine length, cover) of the epub files are parsed once and stored in
+# the epub_package_info table of the app database, a stored entry is valid as long as size and modification time
+# of the file are unchanged. Recently used entries are additionally kept in memory.
+PACKAGE_CACHE_SIZE = 5000
+PACKAGE_FORMATS = ['EPUB', 'KEPUB']
+_package_cache = {}
+
+PackageInfo = namedtuple('PackageInfo', 'opf_version layout spine_length cover_href')
+
 
 def _extract_cover(zip_file, cover_file, cover_path, tmp_file_name):
     if cover_file is None:
@@ -46,23 +61,103 @@ def _extract_cover(zip_file, cover_file, cover_path, tmp_file_name):
     return cover.cover_processing(tmp_file_name, cf, extension)
 
 
-def get_epub_layout(book, book_data):
-    file_path = os.path.normpath(os.path.join(config.get_book_path(),
-                                              book.path, book_data.name + "." + book_data.format.lower()))
+def get_book_file_path(book_path, book_data):
+    return os.path.normpath(os.path.join(config.get_book_path(),
+                                         book_path, book_data.name + "." + book_data.format.lower()))
 
+
+def file_stat(file_path):
     try:
-        tree, __ = get_content_opf(file_path, default_ns)
-        p = tree.xpath('/pkg:package/pkg:metadata', namespaces=default_ns)[0]
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime
 
-        layout = p.xpath('pkg:meta[@property="rendition:layout"]/text()', namespaces=default_ns)
-    except (etree.XMLSyntaxError, KeyError, IndexError, OSError) as e:
-        log.error("Could not parse epub metadata of book {} during kobo sync: {}".format(book.id, e))
-        layout = []
 
-    if len(layout) == 0:
-        return None
+def read_package_info(file_path):
+    """Parses content.opf of the epub file, all facts are None if the package can't be read. Raises
+    zipfile.BadZipfile if the file is no zip archive, nothing is stored for such files"""
+    try:
+        tree, cf_name = get_content_opf(file_path, default_ns)
+        package = '/pkg:package'
+        layout = tree.xpath(package + '/pkg:metadata/pkg:meta[@property="rendition:layout"]/text()',
+                            namespaces=default_ns)
+        spine_length = len(tree.xpath(package + '/pkg:spine/pkg:itemref', namespaces=default_ns))
+        cover_href = tree.xpath(package + "/pkg:manifest/pkg:item[contains(concat(' ', @properties, ' '), "
+                                          "' cover-image ')]/@href", namespaces=default_ns)
+        if not cover_href:
+            meta_cover = tree.xpath(package + "/pkg:metadata/pkg:meta[@name='cover']/@content",
+                                    namespaces=default_ns)
+            if meta_cover:
+                cover_href = [item.get('href') for item in
+                              tree.xpath(package + '/pkg:manifest/pkg:item', namespaces=default_ns)
+                              if item.get('id') == meta_cover[0]]
+    except (etree.XMLSyntaxError, KeyError, IndexError, OSError) as e:
+        log.error("Could not parse epub package of {}: {}".format(file_path, e))
+        return PackageInfo(None, None, None, None)
+    return PackageInfo(tree.get('version'),
+                       layout[0] if layout else None,
+                       spine_length,
+                       posixpath.join(posixpath.dirname(cf_name), cover_href[0]) if cover_href else None)
+
+
+def store_package_info(connection, data_id, book_id, stat, info):
+    statement = pg_insert(ub.EpubPackageInfo.__table__).values(data_id=data_id, book_id=book_id,
+                                                               file_size=stat[0], file_mtime=stat[1],
+                                                               scanned_at=datetime.utcnow(), **info._asdict())
+    statement = statement.on_conflict_do_update(index_elements=['data_id'],
+                                                set_={column: statement.excluded[column] for column in
+                                                      ['book_id', 'file_size', 'file_mtime', 'scanned_at']
+                                                      + list(PackageInfo._fields)})
+    connection.execute(statement)
+
+
+def _row_to_info(row):
+    return PackageInfo(row.opf_version, row.layout, row.spine_length, row.cover_href)
+
+
+def _remember(data_id, stat, info):
+    if len(_package_cache) >= PACKAGE_CACHE_SIZE:
+        _package_cache.clear()
+    _package_cache[data_id] = (stat, info)
+
+
+def prefetch_package_info(data_ids):
+    """Loads the stored package facts of the data rows with one query into the memory cache"""
+    data_ids = [data_id for data_id in data_ids if data_id not in _package_cache]
+    if not data_ids:
+        return
+    for row in ub.session.query(ub.EpubPackageInfo).filter(ub.EpubPackageInfo.data_id.in_(data_ids)):
+        _remember(row.data_id, (row.file_size, row.file_mtime), _row_to_info(row))
+
+
+def get_package_info(book, book_data):
+    """Package facts of the epub file of book_data, the file is only parsed if it changed since the last time"""
+    file_path = get_book_file_path(book.path, book_data)
+    stat = file_stat(file_path)
+    if stat is None:
+        log.error("Epub file of book {} not found: {}".format(book.id, file_path))
+        return PackageInfo(None, None, None, None)
+    cached = _package_cache.get(book_data.id)
+    if cached and cached[0] == stat:
+        return cached[1]
+    row = ub.session.query(ub.EpubPackageInfo).filter(ub.EpubPackageInfo.data_id == book_data.id).one_or_none()
+    if row and (row.file_size, row.file_mtime) == stat:
+        info = _row_to_info(row)
     else:
-        return layout[0]
+        info = read_package_info(file_path)
+        # separate transaction, pending changes of the request session are not committed
+        try:
+            with ub.session.get_bind().begin() as connection:
+                store_package_info(connection, book_data.id, book.id, stat, info)
+        except SQLAlchemyError as ex:
+            log.error("Storing epub package info failed: {}".format(ex))
+    _remember(book_data.id, stat, info)
+    return info
+
+
+def get_epub_layout(book, book_data):
+    return get_package_info(book, book_data).layout
 
 
 def get_epub_info(tmp_file_path, original_file_name, original_file_extension):
@@ -50,10 +50,8 @@ def index(thread_id):
 
     else:
         # Only return top-level comments (parent_id is None)
-        # Replies are automatically included via the relationship
-        comments = Comment.query.filter_by(thread_id=thread.id, parent_id=None)\
-                                .order_by(Comment.created_at.desc())\
-                                .all()
+        # Replies, likes and authors are loaded for the whole thread at once
+        comments = Comment.load_tree(thread, current_user if current_user.is_authenticated else None)
         return jsonify(comments_schema.dump(comments)), 200
 
 
@@ -81,9 +79,11 @@ def show(comment_id):
 @comments_blueprint.route('/comments/<int:comment_id>/like', methods=["POST"])
 @login_required
 def like(comment_id):
-    comment = Comment.query.get_or_404(comment_id)
+    # locked until the commit, the repair of the reaction counters waits for the like in progress
+    comment = Comment.query.filter_by(id=comment_id).with_for_update(read=True, key_share=True, of=Comment) \
+        .first_or_404()
     
-    from cps.forum.database.models.like import CommentLike
+    from cps.forum.database.models.like import CommentLike, count_reaction
     
     data = request.get_json(silent=True) or {}
     
@@ -101,35 +101,29 @@ def like(comment_id):
             
     existing_like = CommentLike.query.filter_by(user_id=current_user.id, comment_id=comment.id).first()
     
-    if has_payload:
-        if reaction_val:
-            # Upsert (Create or Update)
-            if existing_like:
-                existing_like.reaction_type = reaction_val
-                existing_like.save()
-            else:
-                new_like = CommentLike(user_id=current_user.id, comment_id=comment.id, reaction_type=reaction_val)
-                new_like.save()
-            liked = True
-            current_type = reaction_val
+    if not has_payload:
+        # Legacy Toggle (No payload), default to 'like'
+        reaction_val = None if existing_like else 'like'
+
+    # The like and the reaction counters of the comment are changed in one transaction
+    if reaction_val:
+        # Upsert (Create or Update)
+        if existing_like:
+            count_reaction(comment.id, existing_like.reaction_type, -1)
+            existing_like.reaction_type = reaction_val
         else:
-            # Explicit unlike (null sent)
-            if existing_like:
-                existing_like.delete()
-            liked = False
-            current_type = None
+            db.session.add(CommentLike(user_id=current_user.id, comment_id=comment.id, reaction_type=reaction_val))
+        count_reaction(comment.id, reaction_val, 1)
+        liked = True
+        current_type = reaction_val
     else:
-        # Legacy Toggle (No payload)
+        # Explicit unlike (null sent) or toggled off
         if existing_like:
-            existing_like.delete()
-            liked = False
-            current_type = None
-        else:
-            # Default to 'like'
-            new_like = CommentLike(user_id=current_user.id, comment_id=comment.id, reaction_type='like')
-            new_like.save()
-            liked = True
-            current_type = 'like'
+            count_reaction(comment.id, existing_like.reaction_type, -1)
+            db.session.delete(existing_like)
+        liked = False
+        current_type = None
+    db.session.commit()
         
     return jsonify({
         "likes_count": comment.likes_count, 
@@ -1,10 +1,12 @@
-from flask import redirect, url_for, flash, Blueprint, render_template, abort, request , jsonify
+from flask import redirect, url_for, flash, Blueprint, render_template, abort, request , jsonify, session
 from flask_login import login_required, current_user
 from slugify import slugify
 from .forms import ThreadCreationForm
 from cps.forum.database.models import Thread, Category , Emoji
 from cps.forum.src.decorators.email_verified import email_verified
+from cps.forum.src import aggregates, view_counter
 from sqlalchemy.orm import joinedload
+from sqlalchemy.orm.attributes import set_committed_value
 import requests
 from cps.logger import create
 from sqlalchemy.exc import IntegrityError
@@ -112,7 +114,6 @@ def category_threads(category_slug):
 @thread_blueprint.route("<string:category_slug>/<string:thread_slug>", methods=["GET", "POST", "DELETE", "PUT"])
 def show(category_slug, thread_slug):
     from cps import calibre_db
-    from sqlalchemy import func, desc
     
     category = Category.query.filter_by(slug=category_slug).first_or_404()
     thread = Thread.query\
@@ -120,7 +121,9 @@ def show(category_slug, thread_slug):
         .first_or_404()
 
     if request.method == "GET":
-        thread.update({"views_count": thread.views_count + 1})
+        view_counter.record_view(thread, session.get('_id'))
+        # show the views which are not written yet
+        set_committed_value(thread, 'views_count', thread.views_count + view_counter.pending(thread.id))
 
     # Support for method overriding via _method query arg or form field
     method = request.args.get('_method', request.method).upper()
@@ -151,11 +154,6 @@ def show(category_slug, thread_slug):
     # Fetch book data if this thread is linked to a book
     book = None
     book_format = None
-    log.info(f"thread All datas :")
-    log.info({
-    c.name: getattr(thread, c.name)
-    for c in thread.__table__.columns
-    })
     if thread.book_id:
         book = calibre_db.get_book(thread.book_id)
         if book:
@@ -165,38 +163,13 @@ def show(category_slug, thread_slug):
                     book_format = format_obj.format.lower()
                     break
     
-    # Get top contributors (users with most comments)
-    from cps.forum.database.models import Comment
-    from cps.forum import db
-    from cps import ub
-    top_contributors_data = db.session.query(
-        Comment.user_id, 
-        func.count(Comment.id).label('comment_count')
-    ).group_by(Comment.user_id)\
-     .order_by(desc('comment_count'))\
-     .limit(5).all()
-    
-    top_contributors = []
-    for user_id, comment_count in top_contributors_data:
-        user = ub.session.query(ub.User).filter(ub.User.id == user_id).first()
-        if user:
-            top_contributors.append({
-                'user': user,
-                'comment_count': comment_count
-            })
-    
-    # Get recent discussions (recent threads)
-    recent_discussions = Thread.query\
-        .order_by(Thread.updated_at.desc())\
-        .limit(5).all()
-
-    log.info(f"show.html chacking parms {book},{book_format} thread {thread}")
+    log.debug(f"show.html chacking parms {book},{book_format} thread {thread}")
     return render_template("threads/show.html",
                         thread=thread, 
                         book=book,
                         book_format=book_format,
-                        top_contributors=top_contributors,
-                        recent_discussions=recent_discussions)
+                        top_contributors=aggregates.top_contributors(),
+                        recent_discussions=aggregates.recent_discussions())
 
 
 @thread_blueprint.route("<string:category_slug>/<string:thread_slug>/edit")
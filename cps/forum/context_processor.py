@@ -4,7 +4,7 @@ Injects forum-specific variables into all forum templates
 """
 from flask import request
 from flask_login import current_user
-from cps.forum.database.models.category import Category
+from cps.forum.src import aggregates
 from cps.forum.auth_bridge import get_forum_user
 import logging
 
@@ -23,8 +23,7 @@ def inject_forum_context():
     
     # Inject categories for navbar dropdown
     try:
-        categories = Category.query.all()
-        context['app_categories'] = categories
+        context['app_categories'] = aggregates.categories()
     except Exception as e:
         log.error(f"Error loading categories: {e}")
         context['app_categories'] = []
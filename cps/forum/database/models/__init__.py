@@ -48,5 +48,5 @@ class Base(db.Model):
 from .category import Category
 from .thread import Thread
 from .comment import Comment
-from .like import CommentLike
+from .like import CommentLike, CommentReactionCounts
 from .emoji import Emoji
\ No newline at end of file
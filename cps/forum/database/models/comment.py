@@ -1,6 +1,11 @@
+from collections import defaultdict
+
 from cps.forum.database.models import Base
 from cps.forum import db
 
+# marks values which were not loaded with the comment tree
+_NOT_LOADED = object()
+
 
 class Comment(Base):
     __tablename__ = "forum_comments"
@@ -15,6 +20,9 @@ class Comment(Base):
     # Relationship within forum database
     thread = db.relationship("Thread", back_populates="comments")
     likes = db.relationship("CommentLike", backref="comment", cascade="all, delete-orphan", lazy='dynamic')
+    # Loaded together with the comment, the like counts and the top reaction are read from the counters
+    reaction_counts = db.relationship("CommentReactionCounts", uselist=False, lazy="joined",
+                                      cascade="all, delete-orphan", passive_deletes=True)
     
     # Self-referential relationship for replies
     replies = db.relationship(
@@ -25,49 +33,80 @@ class Comment(Base):
         order_by="Comment.created_at"
     )
 
+    # Filled by load_tree, the properties below only query the database for comments loaded otherwise
+    _user_reaction = _NOT_LOADED
+    _owner = _NOT_LOADED
+
+    @classmethod
+    def load_tree(cls, thread, user=None):
+        """Top level comments of the thread, newest first, with all replies, reaction counters and authors loaded in
+        a constant number of queries. Reactions of the user are returned as current_user_reaction"""
+        from sqlalchemy.orm.attributes import set_committed_value
+        from cps import ub
+        from .like import CommentLike
+
+        # the reaction counters are joined to the comments
+        comments = cls.query.filter(cls.thread_id == thread.id).order_by(cls.created_at).all()
+
+        user_reactions = dict()
+        if user is not None:
+            user_reactions = dict(db.session.query(CommentLike.comment_id, CommentLike.reaction_type)
+                                  .join(cls, cls.id == CommentLike.comment_id)
+                                  .filter(cls.thread_id == thread.id, CommentLike.user_id == user.id))
+
+        user_ids = set(comment.user_id for comment in comments if comment.user_id)
+        owners = dict()
+        if user_ids:
+            owners = dict((owner.id, owner) for owner in
+                          ub.session.query(ub.User).filter(ub.User.id.in_(user_ids)))
+
+        by_id = dict((comment.id, comment) for comment in comments)
+        replies = defaultdict(list)
+        roots = list()
+        for comment in comments:
+            comment._user_reaction = user_reactions.get(comment.id)
+            comment._owner = owners.get(comment.user_id)
+            set_committed_value(comment, 'thread', thread)
+            if comment.parent_id is None:
+                roots.append(comment)
+            elif comment.parent_id in by_id:
+                replies[comment.parent_id].append(comment)
+                set_committed_value(comment, 'parent', by_id[comment.parent_id])
+        for comment in comments:
+            set_committed_value(comment, 'replies', replies[comment.id])
+        roots.reverse()
+        return roots
+
     @property
     def likes_count(self):
-        return self.likes.count()
+        return self.reaction_counts.total if self.reaction_counts else 0
 
     @property
     def liked_by_current_user(self):
-        from flask_login import current_user
-        if not current_user.is_authenticated:
-            return False
-        return self.likes.filter_by(user_id=current_user.id).first() is not None
+        return self.current_user_reaction is not None
 
     @property
     def current_user_reaction(self):
         from flask_login import current_user
         if not current_user.is_authenticated:
             return None
+        if self._user_reaction is not _NOT_LOADED:
+            return self._user_reaction
         like = self.likes.filter_by(user_id=current_user.id).first()
         return like.reaction_type if like else None
 
     @property
     def top_reaction(self):
         """Returns the most common reaction type for this comment"""
-        from sqlalchemy import func
-        from .like import CommentLike
-        # This relies on the dynamic loader
-        if self.likes_count == 0:
-            return None
-        
-        # Get reaction with highest count
-        try:
-            top = self.likes.with_entities(CommentLike.reaction_type, func.count(CommentLike.reaction_type).label('cnt'))\
-                .group_by(CommentLike.reaction_type)\
-                .order_by(func.count(CommentLike.reaction_type).desc())\
-                .first()
-            return top.reaction_type if top else None
-        except Exception:
-            return 'like' # Fallback
+        return self.reaction_counts.top_reaction if self.reaction_counts else None
 
     @property
     def owner(self):
         """Load user from main users table"""
         if not self.user_id:
             return None
+        if self._owner is not _NOT_LOADED:
+            return self._owner
         from cps import ub
         return ub.session.query(ub.User).filter(ub.User.id == self.user_id).first()
 
@@ -1,6 +1,12 @@
+from sqlalchemy.dialects.postgresql import insert
+
 from cps.forum.database.models import Base
 from cps.forum import db
 
+# Reactions offered by the comment component, each one has a counter column
+REACTION_TYPES = ('like', 'celebrate', 'support', 'love', 'insightful', 'funny')
+
+
 class CommentLike(Base):
     __tablename__ = "forum_comment_likes"
     
@@ -11,3 +17,40 @@ class CommentLike(Base):
     __table_args__ = (
         db.UniqueConstraint('user_id', 'comment_id', name='unique_user_comment_like'),
     )
+
+
+class CommentReactionCounts(db.Model):
+    """Number of reactions per type of a comment, updated together with the likes. Reactions of other types only
+    count in total"""
+    __tablename__ = "forum_comment_reaction_counts"
+
+    comment_id = db.Column(db.Integer, db.ForeignKey("forum_comments.id", ondelete="CASCADE"), primary_key=True)
+    total = db.Column(db.Integer, nullable=False, default=0)
+    like_count = db.Column(db.Integer, nullable=False, default=0)
+    celebrate_count = db.Column(db.Integer, nullable=False, default=0)
+    support_count = db.Column(db.Integer, nullable=False, default=0)
+    love_count = db.Column(db.Integer, nullable=False, default=0)
+    insightful_count = db.Column(db.Integer, nullable=False, default=0)
+    funny_count = db.Column(db.Integer, nullable=False, default=0)
+
+    def count(self, reaction_type):
+        return getattr(self, reaction_type + '_count')
+
+    @property
+    def top_reaction(self):
+        if not self.total:
+            return None
+        top = max(REACTION_TYPES, key=self.count)
+        return top if self.count(top) else None
+
+
+def count_reaction(comment_id, reaction_type, delta):
+    """Adds delta to the counters of the comment in the current transaction, the caller commits"""
+    table = CommentReactionCounts.__table__
+    columns = ['total']
+    if reaction_type in REACTION_TYPES:
+        columns.append(reaction_type + '_count')
+    statement = insert(table).values(comment_id=comment_id, **dict((column, max(delta, 0)) for column in columns))
+    statement = statement.on_conflict_do_update(index_elements=[table.c.comment_id],
+                                                set_=dict((column, table.c[column] + delta) for column in columns))
+    db.session.execute(statement)
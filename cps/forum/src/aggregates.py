@@ -0,0 +1,71 @@
+"""
+Forum Aggregates
+Sidebar and navbar data shared by all forum pages, cached with a ttl and dropped from the cache
+as soon as a comment or thread is created, changed or deleted
+"""
+from sqlalchemy import func
+from sqlalchemy.orm import joinedload
+
+from cps.forum import db
+from cps.forum.database.models import Category, Comment, Thread
+from cps.forum.src.cache import Cache, NAMESPACE
+from cps.tiered_cache import invalidate_on_commit
+
+CONTRIBUTORS = "top_contributors"
+RECENT_DISCUSSIONS = "recent_discussions"
+CATEGORIES = "categories"
+
+CONTRIBUTORS_TIMEOUT = 5*60
+RECENT_DISCUSSIONS_TIMEOUT = 60
+CATEGORIES_TIMEOUT = 10*60
+
+
+def top_contributors(limit=5):
+    """Users with the most comments, as dicts with user (name, forum_avatar) and comment_count"""
+    def load():
+        from cps import ub
+        counts = db.session.query(Comment.user_id, func.count(Comment.id).label('comment_count'))\
+            .group_by(Comment.user_id)\
+            .order_by(func.count(Comment.id).desc())\
+            .limit(limit).all()
+        users = dict()
+        user_ids = [user_id for user_id, __ in counts if user_id]
+        if user_ids:
+            users = dict((user.id, user) for user in ub.session.query(ub.User).filter(ub.User.id.in_(user_ids)))
+        return [{'user': {'name': users[user_id].name, 'forum_avatar': users[user_id].forum_avatar},
+                 'comment_count': comment_count}
+                for user_id, comment_count in counts if user_id in users]
+
+    return Cache().remember(CONTRIBUTORS, CONTRIBUTORS_TIMEOUT, load)
+
+
+def recent_discussions(limit=5):
+    """Most recently updated threads, as dicts with the fields shown in the sidebar"""
+    def load():
+        threads = Thread.query\
+            .options(joinedload(Thread.category))\
+            .order_by(Thread.updated_at.desc())\
+            .limit(limit).all()
+        return [{'title': thread.title,
+                 'slug': thread.slug,
+                 'category': {'slug': thread.category.slug if thread.category else None},
+                 'comments_count': thread.comments_count,
+                 'views_count': thread.views_count}
+                for thread in threads]
+
+    return Cache().remember(RECENT_DISCUSSIONS, RECENT_DISCUSSIONS_TIMEOUT, load)
+
+
+def categories():
+    """All categories as dicts with id, name and slug"""
+    def load():
+        return [{'id': category.id, 'name': category.name, 'slug': category.slug}
+                for category in Category.query.all()]
+
+    return Cache().remember(CATEGORIES, CATEGORIES_TIMEOUT, load)
+
+
+# the entries are dropped after the commit of a session which changed comments, threads or categories
+invalidate_on_commit(Comment, NAMESPACE, [CONTRIBUTORS], events=('after_insert', 'after_delete'))
+invalidate_on_commit(Thread, NAMESPACE, [RECENT_DISCUSSIONS])
+invalidate_on_commit(Category, NAMESPACE, [CATEGORIES])
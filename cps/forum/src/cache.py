@@ -1,33 +1,32 @@
-import os
-import json
-from cachelib import FileSystemCache
+"""
+Forum Cache
+Forum entries of the tiered cache of the app (cps/tiered_cache.py), all in the forum namespace
+"""
+from cps.tiered_cache import cache
 
+NAMESPACE = "forum"
+DEFAULT_TIMEOUT = 10*60
 
-class Cache:
-    def __init__(self):
-        self._cache = FileSystemCache(Cache.cache_dir(), default_timeout=10*60)
+_MISSING = object()
 
-    @staticmethod
-    def cache_dir():
-        return os.path.join(os.getcwd(), 'forum', 'src', 'storage', 'cache')
 
+class Cache:
     def set(self, key, value, timeout=None):
-        try:
-            return self._cache.set(key, json.dumps(value), timeout=timeout)
-
-        except Exception as exception:
-            print(exception)
-
+        cache.set(NAMESPACE, key, value, timeout=timeout or DEFAULT_TIMEOUT)
 
     def get(self, key):
-        try:
-            data = self._cache.get(key)
-            if data:
-                return json.loads(data)
+        return cache.get(NAMESPACE, key)
 
-        except Exception as exception:
-            print(exception)
+    def delete(self, key):
+        cache.delete(NAMESPACE, key)
 
+    def remember(self, key, timeout, producer):
+        """Cached value of the key, calls producer and caches its result if there is none"""
+        return cache.remember(NAMESPACE, key, producer, timeout=timeout)
 
     def has(self, key):
-        return self._cache.has(key) is not None
+        return cache.get(NAMESPACE, key, _MISSING) is not _MISSING
+
+    def clear(self):
+        """Removes all forum entries"""
+        cache.invalidate(NAMESPACE)
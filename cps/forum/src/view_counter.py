@@ -0,0 +1,85 @@
+"""
+Buffered thread view counts
+Views are counted in memory and a background thread writes them every FLUSH_INTERVAL seconds
+with one atomic UPDATE ... SET views_count = views_count + n per thread
+"""
+import atexit
+import os
+import threading
+import time
+
+from sqlalchemy import bindparam, update
+from sqlalchemy.exc import SQLAlchemyError
+
+from cps.logger import create
+
+log = create()
+
+FLUSH_INTERVAL = 30
+# Views of the same session within this many seconds count once, 0 counts every view
+DEDUP_WINDOW = int(os.environ.get("FORUM_VIEW_DEDUP_WINDOW") or 0)
+
+_lock = threading.Lock()
+_pending = {}
+_seen = {}
+_state = {'engine': None, 'table': None, 'flusher': None}
+
+
+def record_view(thread, session_key=None):
+    """Counts a view of the thread, the first view starts the thread which writes the buffered views"""
+    from cps.forum import db
+    now = time.monotonic()
+    with _lock:
+        if DEDUP_WINDOW and session_key is not None:
+            key = (session_key, thread.id)
+            if now - _seen.get(key, -DEDUP_WINDOW) < DEDUP_WINDOW:
+                return
+            _seen[key] = now
+        _pending[thread.id] = _pending.get(thread.id, 0) + 1
+        if _state['engine'] is None:
+            _state['engine'] = db.engine
+            _state['table'] = type(thread).__table__
+            # a daemon, the views of the last interval are written by the exit handler
+            _state['flusher'] = threading.Thread(target=_flush_periodically, name="forum-view-counter", daemon=True)
+            _state['flusher'].start()
+
+
+def pending(thread_id):
+    """Views of the thread which are not written yet"""
+    with _lock:
+        return _pending.get(thread_id, 0)
+
+
+def _flush_periodically():
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        flush()
+
+
+def flush():
+    with _lock:
+        now = time.monotonic()
+        counts = dict(_pending)
+        _pending.clear()
+        if DEDUP_WINDOW:
+            for key in [key for key, seen in _seen.items() if now - seen >= DEDUP_WINDOW]:
+                del _seen[key]
+        engine = _state['engine']
+        table = _state['table']
+    if not counts or engine is None:
+        return
+    # updated_at is kept, views do not make a thread a recent discussion
+    statement = (update(table)
+                 .where(table.c.id == bindparam('thread_id'))
+                 .values(views_count=table.c.views_count + bindparam('views'), updated_at=table.c.updated_at))
+    try:
+        with engine.begin() as conn:
+            conn.execute(statement, [{'thread_id': thread_id, 'views': views} for thread_id, views in counts.items()])
+    except SQLAlchemyError as ex:
+        log.error("Writing forum view counts failed: {}".format(ex))
+        with _lock:
+            for thread_id, views in counts.items():
+                _pending[thread_id] = _pending.get(thread_id, 0) + views
+
+
+atexit.register(flush)
@@ -25,19 +25,20 @@ import re
 import regex
 import shutil
 import socket
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import requests
 import unidecode
 from uuid import uuid4
 
-from flask import send_from_directory, make_response, abort, url_for, Response
+from flask import send_from_directory, make_response, abort, url_for, Response, request
 from flask_babel import gettext as _
 from flask_babel import lazy_gettext as N_
 from flask_babel import get_locale
 from .cw_login import current_user
-from sqlalchemy.sql.expression import true, false, and_, or_, text, func
+from sqlalchemy.sql.expression import true, false, and_, text, func
 from sqlalchemy.exc import InvalidRequestError, OperationalError
 from werkzeug.datastructures import Headers
+from werkzeug.exceptions import NotFound
 from werkzeug.security import generate_password_hash
 from markupsafe import escape
 from urllib.parse import quote
@@ -54,21 +55,27 @@ except ImportError:
 
 from . import calibre_db, cli_param
 from .tasks.convert import TaskConvert
-from . import logger, config, db, ub, fs
+from . import logger, config, db, ub, fs, thumbnail_index
 from . import gdriveutils as gd
 from .constants import (STATIC_DIR as _STATIC_DIR, CACHE_TYPE_THUMBNAILS, THUMBNAIL_TYPE_COVER, THUMBNAIL_TYPE_SERIES,
                         SUPPORTED_CALIBRE_BINARIES)
 from .subproc_wrapper import process_wait
 from .services.worker import WorkerThread
 from .tasks.mail import TaskEmail
-from .tasks.thumbnail import TaskClearCoverThumbnailCache, TaskGenerateCoverThumbnails
+from .tasks.thumbnail import TaskClearCoverThumbnailCache, TaskGenerateCoverThumbnails, TaskGenerateSeriesThumbnails
 from .tasks.metadata_backup import TaskBackupMetadata
 from .file_helper import get_temp_dir
 from .epub_helper import get_content_opf, create_new_metadata_backup, updateEpub, replace_metadata
 from .embed_helper import do_calibre_export
+from .jinjia import book_last_modified
 
 log = logger.create()
 
+# max-age of cover responses requested with the current version parameter
+COVER_IMMUTABLE_MAX_AGE = 31536000
+# thumbnail formats in order of preference
+THUMBNAIL_MIMETYPES = {'avif': 'image/avif', 'webp': 'image/webp', 'jpeg': 'image/jpeg'}
+
 try:
     from wand.image import Image
     from wand.exceptions import MissingDelegateError, BlobError
@@ -152,7 +159,8 @@ def send_registration_mail(e_mail, user_name, default_password, send_otp, resend
         recipient=e_mail,
         task_message=N_("Registration Email for user: %(name)s", name=user_name),
         text=txt,
-        html = html
+        html = html,
+        sensitive=True
     ))
     return
 
@@ -745,9 +753,19 @@ def get_cover_on_failure():
         abort(403)
 
 
-def get_book_cover(book_id, resolution=None):
+def get_book_cover(book_id, resolution=None, version=None, formats=None):
     book = calibre_db.get_filtered_book(book_id, allow_show_archived=True)
-    return get_book_cover_internal(book, resolution=resolution)
+    return get_book_cover_internal(book, resolution=resolution, version=version, formats=formats)
+
+
+def accepted_thumbnail_formats(requested_format=None):
+    """Thumbnail formats for the current request in order of preference, jpeg is always the last one. Avif and webp
+    are only used if the client lists them in the Accept header, wildcards are not sufficient"""
+    if requested_format in THUMBNAIL_MIMETYPES:
+        return [requested_format, 'jpeg'] if requested_format != 'jpeg' else ['jpeg']
+    accepted = [mimetype for mimetype, quality in request.accept_mimetypes if quality > 0]
+    return [image_format for image_format, mimetype in THUMBNAIL_MIMETYPES.items()
+            if mimetype in accepted and image_format != 'jpeg'] + ['jpeg']
 
 
 def get_book_cover_with_uuid(book_uuid, resolution=None):
@@ -757,53 +775,110 @@ def get_book_cover_with_uuid(book_uuid, resolution=None):
     return get_book_cover_internal(book, resolution=resolution)
 
 
-def get_book_cover_internal(book, resolution=None):
-    if book and book.has_cover:
+def _utc_seconds(value):
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc).replace(microsecond=0)
+
+
+def cover_validators(entity_key, last_modified, thumbnail=None):
+    """ETag and Last-Modified of a cover, derived from the database without accessing the file"""
+    last_modified = _utc_seconds(last_modified)
+    etag = "{}-{}".format(entity_key, int(last_modified.timestamp()))
+    if thumbnail:
+        generated_at = _utc_seconds(thumbnail.generated_at)
+        etag += "-{}{}-{}".format(thumbnail.resolution, thumbnail.format, int(generated_at.timestamp()))
+        last_modified = max(last_modified, generated_at)
+    return etag, last_modified
+
+
+def cover_not_modified(etag, last_modified):
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    return request.if_modified_since is not None and request.if_modified_since >= last_modified
 
+
+def cover_response(response, etag, last_modified, immutable=False, negotiated=False):
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    if negotiated:
+        response.vary.add("Accept")
+    # covers are only visible to logged in users, shared caches must not store them
+    if immutable:
+        response.headers["Cache-Control"] = "private, max-age={}, immutable".format(COVER_IMMUTABLE_MAX_AGE)
+    else:
+        response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+
+def _send_cover_file(directory, filename):
+    # validators are set by cover_response
+    return send_from_directory(directory, filename, etag=False, conditional=False)
+
+
+def _send_thumbnail_file(thumbnail):
+    # the file is not checked beforehand, a missing file is reported by send_from_directory
+    try:
+        return _send_cover_file(fs.FileSystem().get_cache_file_dir(thumbnail.filename, CACHE_TYPE_THUMBNAILS),
+                                thumbnail.filename)
+    except NotFound:
+        log.debug("Thumbnail file {} not found".format(thumbnail.filename))
+        return None
+
+
+def get_book_cover_internal(book, resolution=None, version=None, formats=None):
+    if book and book.has_cover:
+        thumbnail = get_book_cover_thumbnail(book, resolution, formats) if resolution else None
+        etag, last_modified = cover_validators("book-{}".format(book.id), book.last_modified, thumbnail)
+        # the requested thumbnail or its preferred format may be generated later on,
+        # so only the final image is cached forever
+        immutable = (version is not None and version == book_last_modified(book)
+                     and (not resolution or (thumbnail is not None and thumbnail.format == (formats or ['jpeg'])[0])))
+        negotiated = formats is not None and len(formats) > 1
+        if cover_not_modified(etag, last_modified):
+            return cover_response(Response(status=304), etag, last_modified, immutable, negotiated)
         # Send the book cover thumbnail if it exists in cache
-        if resolution:
-            thumbnail = get_book_cover_thumbnail(book, resolution)
+        response = _send_thumbnail_file(thumbnail) if thumbnail else None
+        if response is None:
             if thumbnail:
-                cache = fs.FileSystem()
-                if cache.get_cache_file_exists(thumbnail.filename, CACHE_TYPE_THUMBNAILS):
-                    return send_from_directory(cache.get_cache_file_dir(thumbnail.filename, CACHE_TYPE_THUMBNAILS),
-                                               thumbnail.filename)
-        # Send the book cover from Google Drive if configured
-        if config.config_use_google_drive:
-            try:
-                if not gd.is_gdrive_ready():
-                    return get_cover_on_failure()
-                cover_file = gd.get_cover_via_gdrive(book.path)
-                if cover_file:
-                    return Response(cover_file, mimetype='image/jpeg')
-                else:
-                    log.error('{}/cover.jpg not found on Google Drive'.format(book.path))
-                    return get_cover_on_failure()
-            except Exception as ex:
-                log.error_or_exception(ex)
-                return get_cover_on_failure()
-        # Send the book cover from the Calibre directory
-        else:
-            cover_file_path = os.path.join(config.get_book_path(), book.path)
-            # log.info(f" book cover file path chacking !! {cover_file_path}")
+                # the thumbnail file is missing, the full size cover is sent with its own validators and not final
+                etag, last_modified = cover_validators("book-{}".format(book.id), book.last_modified)
+                immutable = False
+            response = _send_book_cover(book)
+        if response is None:
+            return get_cover_on_failure()
+        return cover_response(response, etag, last_modified, immutable, negotiated)
+    else:
+        return get_cover_on_failure()
 
-            if os.path.isfile(os.path.join(cover_file_path, "cover.jpg")):
-                return send_from_directory(cover_file_path, "cover.jpg")
+
+def _send_book_cover(book):
+    # Send the book cover from Google Drive if configured
+    if config.config_use_google_drive:
+        try:
+            if not gd.is_gdrive_ready():
+                return None
+            cover_file = gd.get_cover_via_gdrive(book.path)
+            if cover_file:
+                return Response(cover_file, mimetype='image/jpeg')
             else:
-                return get_cover_on_failure()
+                log.error('{}/cover.jpg not found on Google Drive'.format(book.path))
+                return None
+        except Exception as ex:
+            log.error_or_exception(ex)
+            return None
+    # Send the book cover from the Calibre directory
     else:
-        return get_cover_on_failure()
+        cover_file_path = os.path.join(config.get_book_path(), book.path)
+        if os.path.isfile(os.path.join(cover_file_path, "cover.jpg")):
+            return _send_cover_file(cover_file_path, "cover.jpg")
+        else:
+            return None
 
 
-def get_book_cover_thumbnail(book, resolution):
+def get_book_cover_thumbnail(book, resolution, formats=None):
     if book and book.has_cover:
-        return ub.session \
-            .query(ub.Thumbnail) \
-            .filter(ub.Thumbnail.type == THUMBNAIL_TYPE_COVER) \
-            .filter(ub.Thumbnail.entity_id == book.id) \
-            .filter(ub.Thumbnail.resolution == resolution) \
-            .filter(or_(ub.Thumbnail.expiration.is_(None), ub.Thumbnail.expiration > datetime.utcnow())) \
-            .first()
+        return thumbnail_index.get(THUMBNAIL_TYPE_COVER, book.id, resolution, formats or ['jpeg'])
 
 
 def get_series_thumbnail_on_failure(series_id, resolution):
@@ -827,22 +902,18 @@ def get_series_cover_internal(series_id, resolution=None):
     if resolution:
         thumbnail = get_series_thumbnail(series_id, resolution)
         if thumbnail:
-            cache = fs.FileSystem()
-            if cache.get_cache_file_exists(thumbnail.filename, CACHE_TYPE_THUMBNAILS):
-                return send_from_directory(cache.get_cache_file_dir(thumbnail.filename, CACHE_TYPE_THUMBNAILS),
-                                           thumbnail.filename)
+            etag, last_modified = cover_validators("series-{}".format(series_id), thumbnail.generated_at)
+            if cover_not_modified(etag, last_modified):
+                return cover_response(Response(status=304), etag, last_modified)
+            response = _send_thumbnail_file(thumbnail)
+            if response:
+                return cover_response(response, etag, last_modified)
 
     return get_series_thumbnail_on_failure(series_id, resolution)
 
 
 def get_series_thumbnail(series_id, resolution):
-    return ub.session \
-        .query(ub.Thumbnail) \
-        .filter(ub.Thumbnail.type == THUMBNAIL_TYPE_SERIES) \
-        .filter(ub.Thumbnail.entity_id == series_id) \
-        .filter(ub.Thumbnail.resolution == resolution) \
-        .filter(or_(ub.Thumbnail.expiration.is_(None), ub.Thumbnail.expiration > datetime.utcnow())) \
-        .first()
+    return thumbnail_index.get(THUMBNAIL_TYPE_SERIES, series_id, resolution)
 
 
 # saves book cover from url
@@ -1134,14 +1205,27 @@ def get_download_link(book_id, book_format, client):
 
 
 def clear_cover_thumbnail_cache(book_id):
+    thumbnail_index.remove(THUMBNAIL_TYPE_COVER, book_id)
     if config.schedule_generate_book_covers:
         WorkerThread.add(None, TaskClearCoverThumbnailCache(book_id), hidden=True)
 
 
 def replace_cover_thumbnail_cache(book_id):
+    # the outdated thumbnails are not served anymore until the new ones are generated
+    thumbnail_index.remove(THUMBNAIL_TYPE_COVER, book_id)
     if config.schedule_generate_book_covers:
         WorkerThread.add(None, TaskClearCoverThumbnailCache(book_id), hidden=True)
         WorkerThread.add(None, TaskGenerateCoverThumbnails(book_id), hidden=True)
+    update_series_thumbnail_cache(book_id)
+
+
+def update_series_thumbnail_cache(book_id):
+    # series mosaics containing the cover of the book are regenerated after the book thumbnails
+    if config.schedule_generate_series_covers:
+        series_ids = [series_id for series_id, in calibre_db.session.query(db.books_series_link.c.series)
+                      .filter(db.books_series_link.c.book == book_id)]
+        if series_ids:
+            WorkerThread.add(None, TaskGenerateSeriesThumbnails(series_ids), hidden=True)
 
 
 def delete_thumbnail_cache():
@@ -1151,6 +1235,7 @@ def delete_thumbnail_cache():
 def add_book_to_thumbnail_cache(book_id):
     if config.schedule_generate_book_covers:
         WorkerThread.add(None, TaskGenerateCoverThumbnails(book_id), hidden=True)
+    update_series_thumbnail_cache(book_id)
 
 
 def update_thumbnail_cache():
@@ -154,7 +154,7 @@ def book_last_modified(book):
 
 
 @jinjia.app_template_filter('get_cover_srcset')
-def get_cover_srcset(book):
+def get_cover_srcset(book, image_format=None):
     srcset = list()
     resolutions = {
         constants.COVER_THUMBNAIL_SMALL: 'sm',
@@ -162,13 +162,27 @@ def get_cover_srcset(book):
         constants.COVER_THUMBNAIL_LARGE: 'lg'
     }
     for resolution, shortname in resolutions.items():
-        url = url_for('web.get_cover', book_id=book.id, resolution=shortname, c=book_last_modified(book))
+        url = url_for('web.get_cover', book_id=book.id, resolution=shortname, c=book_last_modified(book),
+                      format=image_format)
         srcset.append(f'{url} {resolution}x')
     return ', '.join(srcset)
 
 
+# <picture> sources of the additional thumbnail formats, best format first
+@jinjia.app_template_filter('get_cover_sources')
+def get_cover_sources(book):
+    from . import config
+    from .helper import THUMBNAIL_MIMETYPES
+    from .tasks.thumbnail import get_thumbnail_formats
+    if not config.schedule_generate_book_covers:
+        return []
+    formats = get_thumbnail_formats()
+    return [(mimetype, get_cover_srcset(book, image_format)) for image_format, mimetype in THUMBNAIL_MIMETYPES.items()
+            if image_format != 'jpeg' and image_format in formats]
+
+
 @jinjia.app_template_filter('get_series_srcset')
-def get_cover_srcset(series):
+def get_series_srcset(series):
     srcset = list()
     resolutions = {
         constants.COVER_THUMBNAIL_SMALL: 'sm',
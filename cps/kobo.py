@@ -34,7 +34,9 @@ from flask import (
     current_app,
     url_for,
     redirect,
-    abort
+    abort,
+    Response,
+    stream_with_context
 )
 from .cw_login import current_user
 from werkzeug.datastructures import Headers
@@ -42,11 +44,11 @@ from sqlalchemy import func
 from sqlalchemy.sql.expression import and_, or_
 from sqlalchemy.exc import StatementError
 from sqlalchemy.sql import select
+from sqlalchemy.orm import selectinload
 import requests
 
 from . import config, logger, kobo_auth, db, calibre_db, helper, shelf as shelf_lib, ub, csrf, kobo_sync_status
-from . import isoLanguages
-from .epub import get_epub_layout
+from . import isoLanguages, epub
 from .constants import COVER_THUMBNAIL_SMALL
 from .helper import get_download_link
 from .services import SyncToken as SyncToken
@@ -161,9 +163,9 @@ def HandleSyncRequest():
     new_archived_last_modified = datetime.datetime.min
     sync_results = []
 
-    # We reload the book database so that the user gets a fresh view of the library
-    # in case of external changes (e.g: adding a book through Calibre).
-    calibre_db.reconnect_db(config, ub.app_DB_path)
+    # The user gets a fresh view of the library in case of external changes (e.g: adding a book through Calibre),
+    # the database is only reconnected if the custom columns changed
+    calibre_db.refresh_db(config, ub.app_DB_path)
 
     only_kobo_shelves = current_user.kobo_only_shelves_sync
 
@@ -202,14 +204,19 @@ def HandleSyncRequest():
                            .order_by(db.Books.id))
 
     reading_states_in_new_entitlements = []
-    books = changed_entries.limit(SYNC_ITEM_LIMIT)
-    log.debug("Books to Sync: {}".format(len(books.all())))
+    books = changed_entries.limit(SYNC_ITEM_LIMIT).all()
+    log.debug("Books to Sync: {}".format(len(books)))
+    # reading states and synced markers of the whole page are loaded at once and committed together
+    book_ids = [book.Books.id for book in books]
+    kobo_reading_states = get_or_create_reading_states(book_ids)
+    epub.prefetch_package_info([data.id for book in books for data in book.Books.data
+                                if data.format in KOBO_FORMATS])
     for book in books:
         formats = [data.format for data in book.Books.data]
         if 'KEPUB' not in formats and config.config_kepubifypath and 'EPUB' in formats:
             helper.convert_book_format(book.Books.id, config.get_book_path(), 'EPUB', 'KEPUB', current_user.name)
 
-        kobo_reading_state = get_or_create_reading_state(book.Books.id)
+        kobo_reading_state = kobo_reading_states[book.Books.id]
         entitlement = {
             "BookEntitlement": create_book_entitlement(book.Books, archived=(book.is_archived==True)),
             "BookMetadata": get_metadata(book.Books),
@@ -243,7 +250,8 @@ def HandleSyncRequest():
             pass
 
         new_books_last_created = max(ts_created, new_books_last_created)
-        kobo_sync_status.add_synced_books(book.Books.id)
+    kobo_sync_status.add_synced_books_bulk(book_ids)
+    ub.session_commit()
 
     max_change = changed_entries.filter(ub.ArchivedBook.is_archived)\
         .filter(ub.ArchivedBook.user_id == current_user.id) \
@@ -324,9 +332,15 @@ def generate_sync_response(sync_token, sync_results, set_cont=False):
 
     # log.debug("Kobo Sync Content: {}".format(sync_results))
     # jsonify decodes the unicode string different to what kobo expects
-    response = make_response(json.dumps(sync_results), extra_headers)
-    response.headers["Content-Type"] = "application/json; charset=utf-8"
-    return response
+    return Response(stream_with_context(stream_sync_results(sync_results)), headers=extra_headers,
+                    content_type="application/json; charset=utf-8")
+
+
+def stream_sync_results(sync_results):
+    yield "["
+    for index, sync_result in enumerate(sync_results):
+        yield (", " if index else "") + json.dumps(sync_result)
+    yield "]"
 
 
 @kobo.route("/v1/library/<book_uuid>/metadata")
@@ -439,23 +453,26 @@ def get_metadata(book):
     for book_data in kepub if len(kepub) > 0 else book.data:
         if book_data.format not in KOBO_FORMATS:
             continue
+        # package facts are parsed once per file and kept in the app database
+        try:
+            fixed_layout = epub.get_package_info(book, book_data).layout == 'pre-paginated'
+        except zipfile.BadZipfile as e:
+            log.error(e)
+            continue
         for kobo_format in KOBO_FORMATS[book_data.format]:
             # log.debug('Id: %s, Format: %s' % (book.id, kobo_format))
-            try:
-                if get_epub_layout(book, book_data) == 'pre-paginated':
-                    kobo_format = 'EPUB3FL'
-                download_urls.append(
-                    {
-                        "Format": kobo_format,
-                        "Size": book_data.uncompressed_size,
-                        "Url": get_download_url_for_book(book.id, book_data.format),
-                        # The Kobo forma accepts platforms: (Generic, Android)
-                        "Platform": "Generic",
-                        # "DrmType": "None", # Not required
-                    }
-                )
-            except (zipfile.BadZipfile, FileNotFoundError) as e:
-                log.error(e)
+            if fixed_layout:
+                kobo_format = 'EPUB3FL'
+            download_urls.append(
+                {
+                    "Format": kobo_format,
+                    "Size": book_data.uncompressed_size,
+                    "Url": get_download_url_for_book(book.id, book_data.format),
+                    # The Kobo forma accepts platforms: (Generic, Android)
+                    "Platform": "Generic",
+                    # "DrmType": "None", # Not required
+                }
+            )
 
     book_uuid = book.uuid
     metadata = {
@@ -831,6 +848,31 @@ def get_ub_read_status(kobo_read_status):
     return string_to_enum_map[kobo_read_status]
 
 
+def get_or_create_reading_states(book_ids):
+    # Bulk version of get_or_create_reading_state, returns the reading states by book id, the caller commits
+    books_read = {book_read.book_id: book_read for book_read in
+                  ub.session.query(ub.ReadBook)
+                  .options(selectinload(ub.ReadBook.kobo_reading_state)
+                           .selectinload(ub.KoboReadingState.current_bookmark),
+                           selectinload(ub.ReadBook.kobo_reading_state)
+                           .selectinload(ub.KoboReadingState.statistics))
+                  .filter(ub.ReadBook.book_id.in_(book_ids), ub.ReadBook.user_id == int(current_user.id))}
+    reading_states = dict()
+    for book_id in book_ids:
+        book_read = books_read.get(book_id)
+        if not book_read:
+            book_read = ub.ReadBook(user_id=current_user.id, book_id=book_id)
+            ub.session.add(book_read)
+        if not book_read.kobo_reading_state:
+            kobo_reading_state = ub.KoboReadingState(user_id=book_read.user_id, book_id=book_id)
+            kobo_reading_state.current_bookmark = ub.KoboBookmark()
+            kobo_reading_state.statistics = ub.KoboStatistics()
+            book_read.kobo_reading_state = kobo_reading_state
+        reading_states[book_id] = book_read.kobo_reading_state
+    ub.session.flush()
+    return reading_states
+
+
 def get_or_create_reading_state(book_id):
     book_read = ub.session.query(ub.ReadBook).filter(ub.ReadBook.book_id == book_id,
                                                      ub.ReadBook.user_id == int(current_user.id)).one_or_none()
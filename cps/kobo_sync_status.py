@@ -37,6 +37,18 @@ def add_synced_books(book_id):
         ub.session_commit()
 
 
+# Adds all book ids which are not yet part of the kobo_synced_books table of the current user, the caller commits
+def add_synced_books_bulk(book_ids):
+    book_ids = set(book_ids)
+    if not book_ids:
+        return
+    present = set(book_id for book_id, in ub.session.query(ub.KoboSyncedBooks.book_id)
+                  .filter(ub.KoboSyncedBooks.book_id.in_(book_ids))
+                  .filter(ub.KoboSyncedBooks.user_id == current_user.id))
+    for book_id in sorted(book_ids - present):
+        ub.session.add(ub.KoboSyncedBooks(user_id=current_user.id, book_id=book_id))
+
+
 # Select all entries of current book in kobo_synced_books table, which are from current user and delete them
 def remove_synced_book(book_id, all=False, session=None):
     if not all:
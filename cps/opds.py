@@ -35,7 +35,7 @@ from sqlalchemy.exc import InvalidRequestError, OperationalError
 from . import logger, config, db, calibre_db, ub, isoLanguages, constants
 from .usermanagement import requires_basic_auth_if_no_ano, auth
 from .helper import get_download_link, get_book_cover
-from .pagination import Pagination
+from .pagination import Pagination, KeysetPagination
 from .web import render_read_books
 
 
@@ -75,7 +75,7 @@ def feed_normal_search():
 @opds.route("/opds/books")
 @requires_basic_auth_if_no_ano
 def feed_booksindex():
-    return render_element_index(db.Books.sort, None, 'opds.feed_letter_books')
+    return render_element_index('book', 'opds.feed_letter_books')
 
 
 @opds.route("/opds/books/letter/<book_id>")
@@ -110,7 +110,11 @@ def feed_discover():
     if not auth.current_user().check_visibility(constants.SIDEBAR_RANDOM):
         abort(404)
     query = calibre_db.generate_linked_query(config.config_read_column, db.Books)
-    entries = query.filter(calibre_db.common_filters()).order_by(func.random()).limit(config.config_books_per_page)
+    entries = (query.filter(calibre_db.common_filters())
+               .options(*calibre_db.author_load_options())
+               .order_by(func.random())
+               .limit(config.config_books_per_page).all())
+    entries = calibre_db.order_authors(entries, list_return=True, combined=True)
     pagination = Pagination(1, config.config_books_per_page, int(config.config_books_per_page))
     return render_xml_template('feed.xml', entries=entries, pagination=pagination)
 
@@ -134,21 +138,11 @@ def feed_hot():
     if not auth.current_user().check_visibility(constants.SIDEBAR_HOT):
         abort(404)
     off = request.args.get("offset") or 0
-    all_books = ub.session.query(ub.Downloads.book_id, func.count(ub.Downloads.book_id).label('count')).order_by(
-        func.count(ub.Downloads.book_id).desc()).group_by(ub.Downloads.book_id)
-    hot_books = all_books.offset(off).limit(config.config_books_per_page)
-    entries = list()
-    for book in hot_books:
-        query = calibre_db.generate_linked_query(config.config_read_column, db.Books)
-        download_book = query.filter(calibre_db.common_filters()).filter(
-            book.book_id == db.Books.id).first()
-        if download_book:
-            entries.append(download_book)
-        else:
-            ub.delete_download(book.book_id)
-    num_books = entries.__len__()
-    pagination = Pagination((int(off) / (int(config.config_books_per_page)) + 1),
-                            config.config_books_per_page, num_books)
+    entries, __, pagination = calibre_db.fill_indexpage((int(off) / (int(config.config_books_per_page)) + 1), 0,
+                                                        db.Books, ub.DownloadCount.count > 0,
+                                                        [ub.DownloadCount.count.desc(), db.Books.id],
+                                                        True, config.config_read_column,
+                                                        ub.DownloadCount, db.Books.id == ub.DownloadCount.book_id)
     return render_xml_template('feed.xml', entries=entries, pagination=pagination)
 
 
@@ -157,7 +151,7 @@ def feed_hot():
 def feed_authorindex():
     if not auth.current_user().check_visibility(constants.SIDEBAR_AUTHOR):
         abort(404)
-    return render_element_index(db.Authors.sort, db.books_authors_link, 'opds.feed_letter_author')
+    return render_element_index('author', 'opds.feed_letter_author')
 
 
 @opds.route("/opds/author/letter/<book_id>")
@@ -188,15 +182,14 @@ def feed_author(book_id):
 def feed_publisherindex():
     if not auth.current_user().check_visibility(constants.SIDEBAR_PUBLISHER):
         abort(404)
-    off = request.args.get("offset") or 0
+    off = int(request.args.get("offset") or 0)
+    counts = calibre_db.get_category_counts('publisher')[0]
     entries = calibre_db.session.query(db.Publishers)\
-        .join(db.books_publishers_link)\
-        .join(db.Books).filter(calibre_db.common_filters())\
-        .group_by(db.Publishers.id)\
+        .filter(calibre_db.category_filter(db.Publishers.id, counts))\
         .order_by(db.Publishers.sort)\
         .limit(config.config_books_per_page).offset(off)
     pagination = Pagination((int(off) / (int(config.config_books_per_page)) + 1), config.config_books_per_page,
-                            len(calibre_db.session.query(db.Publishers).all()))
+                            len(counts))
     return render_xml_template('feed.xml', listelements=entries, folder='opds.feed_publisher', pagination=pagination)
 
 
@@ -211,7 +204,7 @@ def feed_publisher(book_id):
 def feed_categoryindex():
     if not auth.current_user().check_visibility(constants.SIDEBAR_CATEGORY):
         abort(404)
-    return render_element_index(db.Tags.name, db.books_tags_link, 'opds.feed_letter_category')
+    return render_element_index('tag', 'opds.feed_letter_category')
 
 
 @opds.route("/opds/category/letter/<book_id>")
@@ -244,7 +237,7 @@ def feed_category(book_id):
 def feed_seriesindex():
     if not auth.current_user().check_visibility(constants.SIDEBAR_SERIES):
         abort(404)
-    return render_element_index(db.Series.sort, db.books_series_link, 'opds.feed_letter_series')
+    return render_element_index('series', 'opds.feed_letter_series')
 
 
 @opds.route("/opds/series/letter/<book_id>")
@@ -284,12 +277,9 @@ def feed_ratingindex():
     if not auth.current_user().check_visibility(constants.SIDEBAR_RATING):
         abort(404)
     off = request.args.get("offset") or 0
-    entries = calibre_db.session.query(db.Ratings, func.count('books_ratings_link.book').label('count'),
-                                       (db.Ratings.rating / 2).label('name')) \
-        .join(db.books_ratings_link)\
-        .join(db.Books)\
-        .filter(calibre_db.common_filters()) \
-        .group_by(db.Ratings.id)\
+    counts = calibre_db.get_category_counts('rating')[0]
+    entries = calibre_db.session.query(db.Ratings, (db.Ratings.rating / 2).label('name'))\
+        .filter(calibre_db.category_filter(db.Ratings.id, counts))\
         .order_by(db.Ratings.rating).all()
 
     pagination = Pagination((int(off) / (int(config.config_books_per_page)) + 1), config.config_books_per_page,
@@ -312,15 +302,12 @@ def feed_formatindex():
     if not auth.current_user().check_visibility(constants.SIDEBAR_FORMAT):
         abort(404)
     off = request.args.get("offset") or 0
-    entries = calibre_db.session.query(db.Data.format).join(db.Books)\
-        .filter(calibre_db.common_filters()) \
-        .group_by(db.Data.format)\
-        .order_by(db.Data.format).all()
+    entries = sorted(calibre_db.get_category_counts('format')[0])
     pagination = Pagination((int(off) / (int(config.config_books_per_page)) + 1), config.config_books_per_page,
                             len(entries))
     element = list()
     for entry in entries:
-        element.append(FeedObject(entry.format, entry.format))
+        element.append(FeedObject(entry, entry))
     return render_xml_template('feed.xml', listelements=element, folder='opds.feed_format', pagination=pagination)
 
 
@@ -463,7 +450,7 @@ def get_database_stats():
 @opds.route("/opds/cover/<book_id>")
 @requires_basic_auth_if_no_ano
 def feed_get_cover(book_id):
-    return get_book_cover(book_id)
+    return get_book_cover(book_id, version=request.args.get('c'))
 
 
 @opds.route("/opds/readbooks")
@@ -522,32 +509,35 @@ def render_xml_template(*args, **kwargs):
 
 def render_xml_dataset(data_table, book_id):
     off = request.args.get("offset") or 0
-    entries, __, pagination = calibre_db.fill_indexpage((int(off) / (int(config.config_books_per_page)) + 1), 0,
-                                                        db.Books,
-                                                        getattr(db.Books, data_table.__tablename__).any(data_table.id == book_id),
-                                                        [db.Books.timestamp.desc()],
-                                                        True, config.config_read_column)
+    cursor = request.args.get("cursor")
+    page = int(off) / (int(config.config_books_per_page)) + 1
+    db_filter = getattr(db.Books, data_table.__tablename__).any(data_table.id == book_id)
+    if cursor or not int(off):
+        # Deeper pages are continued from the cursor handed out in the "next" link instead of an offset
+        try:
+            entries, next_cursor, total_count = calibre_db.fill_indexpage_keyset(cursor, db.Books, 0, db_filter,
+                                                                                 [db.Books.timestamp.desc()],
+                                                                                 False, config.config_read_column)
+        except ValueError:
+            abort(400)
+        pagination = KeysetPagination(page, config.config_books_per_page, total_count, next_cursor)
+    else:
+        entries, __, pagination = calibre_db.fill_indexpage(page, 0,
+                                                            db.Books,
+                                                            db_filter,
+                                                            [db.Books.timestamp.desc()],
+                                                            True, config.config_read_column)
     return render_xml_template('feed.xml', entries=entries, pagination=pagination)
 
 
-def render_element_index(database_column, linked_table, folder):
-    shift = 0
+def render_element_index(kind, folder):
     off = int(request.args.get("offset") or 0)
-    entries = calibre_db.session.query(func.upper(func.substr(database_column, 1, 1)).label('id'), None, None)
-    # query = calibre_db.generate_linked_query(config.config_read_column, db.Books)
-    if linked_table is not None:
-        entries = entries.join(linked_table).join(db.Books)
-    entries = entries.filter(calibre_db.common_filters()).group_by(func.upper(func.substr(database_column, 1, 1))).all()
-    elements = []
-    if off == 0 and entries:
-        elements.append({'id': "00", 'name': _("All")})
-        shift = 1
-    for entry in entries[
-                 off + shift - 1:
-                 int(off + int(config.config_books_per_page) - shift)]:
-        elements.append({'id': entry.id, 'name': entry.id})
+    letters = calibre_db.get_letter_index(kind)
+    elements = [{'id': "00", 'name': _("All")}] if letters else []
+    elements.extend({'id': letter, 'name': letter} for letter in letters)
     pagination = Pagination((int(off) / (int(config.config_books_per_page)) + 1), config.config_books_per_page,
-                            len(entries) + 1)
+                            len(elements))
+    elements = elements[off:off + int(config.config_books_per_page)]
     return render_xml_template('feed.xml',
                                letterelements=elements,
                                folder=folder,
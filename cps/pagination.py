@@ -20,6 +20,9 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program. If not, see <http://www.gnu.org/licenses/>.
 
+import base64
+import json
+from datetime import datetime
 from math import ceil
 
 
@@ -73,3 +76,28 @@ class Pagination(object):
                     yield None
                 yield num
                 last = num
+
+
+# pagination for keyset (seek) paged results, the next page is addressed by an opaque cursor instead of an offset,
+# total_count may be an estimate or None if the count was skipped
+class KeysetPagination(Pagination):
+    def __init__(self, page, per_page, total_count, next_cursor=None):
+        super().__init__(page, per_page, total_count or 0)
+        self.next_cursor = next_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+
+def encode_cursor(values):
+    payload = [{"dt": value.isoformat()} if isinstance(value, datetime) else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps(payload).encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("utf-8"))
+        return [datetime.fromisoformat(value["dt"]) if isinstance(value, dict) else value for value in payload]
+    except (ValueError, TypeError, KeyError) as ex:
+        raise ValueError("Invalid pagination cursor") from ex
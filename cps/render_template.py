@@ -23,11 +23,25 @@ from .cw_login import current_user
 from sqlalchemy.sql.expression import or_
 
 from . import config, constants, logger, ub
+from .tiered_cache import cache, invalidate_on_commit
 from .ub import User
 
 
 log = logger.create()
 
+# public and own shelves per user for the shelf menus, dropped as a whole if any shelf changes. Kept in memory only,
+# the access of a user to shelves is not shared with other processes
+SHELVES_NAMESPACE = 'shelves_access'
+cache.set_local(SHELVES_NAMESPACE)
+invalidate_on_commit(ub.Shelf, SHELVES_NAMESPACE)
+
+
+def _load_shelves_access(user_id):
+    return [{'id': shelf.id, 'name': shelf.name, 'is_public': shelf.is_public, 'user_id': shelf.user_id}
+            for shelf in ub.session.query(ub.Shelf).filter(
+                or_(ub.Shelf.is_public == 1, ub.Shelf.user_id == user_id)).order_by(ub.Shelf.name)]
+
+
 def get_sidebar_config(kwargs=None):
     kwargs = kwargs or []
     simple = bool([e for e in ['kindle', 'tolino', "kobo", "bookeen"]
@@ -100,8 +114,8 @@ def get_sidebar_config(kwargs=None):
             {"glyph": "glyphicon-th-list", "text": _('Books List'), "link": 'web.books_table', "id": "list",
              "visibility": constants.SIDEBAR_LIST, 'public': (not current_user.is_anonymous), "page": "list",
              "show_text": _('Show Books List'), "config_show": content})
-    g.shelves_access = ub.session.query(ub.Shelf).filter(
-        or_(ub.Shelf.is_public == 1, ub.Shelf.user_id == current_user.id)).order_by(ub.Shelf.name).all()
+    user_id = current_user.id
+    g.shelves_access = cache.remember(SHELVES_NAMESPACE, str(user_id), lambda: _load_shelves_access(user_id))
 
     return sidebar, simple
 
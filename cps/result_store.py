@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+#  This file is part of the Calibre-Web (https://github.com/janeczku/calibre-web)
+#    Copyright (C) 2025 GetMyEBook-Web Contributors
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Stores the book ids of the last search result per user. Id sets are kept as delta encoded varint blobs of the
+# sorted ids, entries expire after a ttl and the least recently used entries are evicted above max_entries.
+# The memory backend only works within one process, the database backend is shared by all workers.
+
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import delete, select, update, func
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import SQLAlchemyError
+
+from . import logger
+
+log = logger.create()
+
+DEFAULT_TTL = 3600
+DEFAULT_MAX_ENTRIES = 1000
+
+
+def encode_ids(ids):
+    """Encodes the ids as sorted, delta encoded unsigned varints"""
+    result = bytearray()
+    last = 0
+    for book_id in sorted(set(int(i) for i in ids)):
+        delta = book_id - last
+        last = book_id
+        while delta >= 0x80:
+            result.append((delta & 0x7f) | 0x80)
+            delta >>= 7
+        result.append(delta)
+    return bytes(result)
+
+
+def decode_ids(blob):
+    ids = list()
+    value = shift = last = 0
+    for byte in blob or b"":
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        last += value
+        ids.append(last)
+        value = shift = 0
+    return ids
+
+
+class MemoryResultStore:
+    def __init__(self, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def set(self, key, ids):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), encode_ids(ids))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() - entry[0] > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+        return decode_ids(entry[1])
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class DatabaseResultStore:
+    """Keeps the entries in a table of the app database, table needs the columns key, ids, created and accessed"""
+    def __init__(self, engine, table, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES):
+        self.engine = engine
+        self.table = table
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+    def _expired(self):
+        return datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(seconds=self.ttl)
+
+    def set(self, key, ids):
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        table = self.table
+        statement = insert(table).values(key=key, ids=encode_ids(ids), created=now, accessed=now)
+        statement = statement.on_conflict_do_update(index_elements=[table.c.key],
+                                                    set_={'ids': statement.excluded.ids,
+                                                          'created': now,
+                                                          'accessed': now})
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(statement)
+                conn.execute(delete(table).where(table.c.accessed < self._expired()))
+                count = conn.execute(select(func.count()).select_from(table)).scalar()
+                if count > self.max_entries:
+                    oldest = select(table.c.key).order_by(table.c.accessed).limit(count - self.max_entries)
+                    conn.execute(delete(table).where(table.c.key.in_(oldest.scalar_subquery())))
+        except SQLAlchemyError as ex:
+            log.error("Storing search result failed: {}".format(ex))
+
+    def get(self, key):
+        table = self.table
+        try:
+            with self.engine.begin() as conn:
+                blob = conn.execute(update(table)
+                                    .where(table.c.key == key, table.c.accessed >= self._expired())
+                                    .values(accessed=datetime.now(timezone.utc).replace(tzinfo=None))
+                                    .returning(table.c.ids)).scalar()
+        except SQLAlchemyError as ex:
+            log.error("Loading search result failed: {}".format(ex))
+            return None
+        return decode_ids(blob) if blob is not None else None
+
+    def delete(self, key):
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(delete(self.table).where(self.table.c.key == key))
+        except SQLAlchemyError as ex:
+            log.error("Deleting search result failed: {}".format(ex))
+
+
+def create_store(backend, engine=None, table=None, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES):
+    if backend == "database" and engine is not None and table is not None:
+        return DatabaseResultStore(engine, table, ttl, max_entries)
+    if backend not in ("memory", "database"):
+        log.error("Unknown search result store '{}', using memory store".format(backend))
+    return MemoryResultStore(ttl, max_entries)
@@ -26,6 +26,9 @@ from .tasks.thumbnail import TaskGenerateCoverThumbnails, TaskGenerateSeriesThum
 from .services.worker import WorkerThread
 from .tasks.metadata_backup import TaskBackupMetadata
 from .tasks.check_threads import TaskCheckThreads
+from .tasks.reaction_counts import TaskRepairReactionCounts
+from .tasks.search_index import TaskUpdateSearchIndex
+from .tasks.epub_package import TaskScanEpubPackages
 
 def get_scheduled_tasks(reconnect=True):
     tasks = list()
@@ -36,6 +39,15 @@ def get_scheduled_tasks(reconnect=True):
     # Delete temp folder
     tasks.append([lambda: TaskClean(), 'delete temp', True])
 
+    # Index books which were added or changed outside of Calibre-Web for full text search
+    tasks.append([lambda: TaskUpdateSearchIndex(), 'update search index', True])
+
+    # Correct the reaction counters of forum comments
+    tasks.append([lambda: TaskRepairReactionCounts(), 'repair reaction counts', True])
+
+    # Parse the package metadata of epub files which were added or changed since the last scan
+    tasks.append([lambda: TaskScanEpubPackages(), 'scan epub packages', True])
+
     # Generate metadata.opf file for each changed book
     if config.schedule_metadata_backup:
         tasks.append([lambda: TaskBackupMetadata("en"), 'backup metadata', False])
@@ -54,6 +66,7 @@ def get_scheduled_tasks(reconnect=True):
 
 def end_scheduled_tasks():
     worker = WorkerThread.get_instance()
+    worker.cancel_scheduled_tasks()
     for __, __, __, task, __ in worker.tasks:
         if task.scheduled and task.is_cancellable:
             worker.end_task(task.id)
@@ -100,7 +113,8 @@ def register_startup_tasks():
         if constants.APP_MODE in ['development', 'test'] and not should_task_be_running(start, duration):
             scheduler.schedule_tasks_immediately(tasks=get_scheduled_tasks(False))
         else:
-            scheduler.schedule_tasks_immediately(tasks=[[lambda: TaskClean(), 'delete temp', True]])
+            scheduler.schedule_tasks_immediately(tasks=[[lambda: TaskClean(), 'delete temp', True],
+                                                        [lambda: TaskUpdateSearchIndex(), 'update search index', True]])
 
 
 def should_task_be_running(start, duration):
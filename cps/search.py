@@ -241,10 +241,8 @@ def extend_search_term(searchterm,
     return searchterm, pub_start, pub_end
 
 
-def render_adv_search_results(term, offset=None, order=None, limit=None):
-    sort = order[0] if order else [db.Books.sort]
-    pagination = None
-
+def adv_search_query(term):
+    """Builds the advanced search query for term, returns the query and the readable search term"""
     cc = calibre_db.get_cc_columns(config, filter_config_custom_read=True)
     calibre_db.session.connection().connection.connection.create_function("lower", 1, db.lcase)
     query = calibre_db.generate_linked_query(config.config_read_column, db.Books)
@@ -342,6 +340,7 @@ def render_adv_search_results(term, offset=None, order=None, limit=None):
         q = adv_search_ratings(q, rating_high, rating_low)
 
         if description:
+            # substring search, supported by the trigram index of the comments
             q = q.filter(db.Books.comments.any(func.lower(db.Comments.text).ilike("%" + description + "%")))
 
         # search custom columns
@@ -351,18 +350,25 @@ def render_adv_search_results(term, offset=None, order=None, limit=None):
             log.debug_or_exception(ex)
             flash(_("Error on search for custom columns, please restart Calibre-Web"), category="error")
 
-    q = q.order_by(*sort).all()
+    return q, search_term
+
+
+def render_adv_search_results(term, offset=None, order=None, limit=None):
+    sort = order[0] if order else [db.Books.sort]
+    pagination = None
+
+    q, search_term = adv_search_query(term)
     flask_session['query'] = json.dumps(term)
-    ub.store_combo_ids(q)
-    result_count = len(q)
+    ub.store_search_query('advanced', term)
+    result_count = calibre_db.count_books(q)
+    q = q.options(*calibre_db.author_load_options()).order_by(*sort)
     if offset is not None and limit is not None:
         offset = int(offset)
-        limit_all = offset + int(limit)
         pagination = Pagination((offset / (int(limit)) + 1), limit, result_count)
-    else:
-        offset = 0
-        limit_all = result_count
-    entries = calibre_db.order_authors(q[offset:limit_all], list_return=True, combined=True)
+        q = q.offset(offset).limit(int(limit))
+    entries = calibre_db.order_authors(q.all(), list_return=True, combined=True)
+    if not offset and len(entries) == result_count:
+        ub.store_combo_ids(entries)
     return render_title_template('search.html',
                                  adv_searchterm=search_term,
                                  pagination=pagination,
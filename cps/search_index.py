@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+
+#  This file is part of the Calibre-Web (https://github.com/janeczku/calibre-web)
+#    Copyright (C) 2025 GetMyEBook-Web Contributors
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Full text search index for the book metadata stored in PostgreSQL. Every book gets one row in books_search_index
+# holding a weighted tsvector (title A, authors B, tags/series/publishers/custom columns C, comments D) and the
+# lowercased metadata text, which is indexed with pg_trgm to keep substring searches fast.
+
+import re
+import threading
+import time
+
+from sqlalchemy import MetaData, Table, Column, Integer, Text, TIMESTAMP, select, func, or_, text
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.exc import SQLAlchemyError
+
+from . import logger
+
+log = logger.create()
+
+TS_CONFIG = 'simple'
+# seconds between two checks if the index is still in sync with the books table, an index out of sync is updated
+# by a background task, books changed outside of Calibre-Web are picked up this way
+READY_RECHECK_INTERVAL = 60
+# custom column types which are part of the index
+INDEXED_CC_TYPES = ['text', 'enumeration', 'comments']
+
+search_index_table = Table('books_search_index', MetaData(),
+                           Column('book', Integer, primary_key=True),
+                           Column('document', TSVECTOR),
+                           Column('content', Text),
+                           Column('last_modified', TIMESTAMP))
+
+_state = {'ready': False, 'checked': 0.0, 'engine': None}
+# only one request checks the index at a time, the others use the last result
+_check_lock = threading.Lock()
+
+_word_split = re.compile(r"\w+", re.UNICODE)
+
+
+def init_search_index(engine):
+    """Creates the index table and its indexes if missing, called on (re)connecting the calibre database"""
+    _state['engine'] = engine
+    _state['ready'] = False
+    _state['checked'] = 0.0
+    try:
+        with engine.begin() as conn:
+            conn.execute(text("CREATE TABLE IF NOT EXISTS books_search_index ("
+                              "book INTEGER PRIMARY KEY, document TSVECTOR, content TEXT, last_modified TIMESTAMP)"))
+            conn.execute(text("CREATE INDEX IF NOT EXISTS books_search_index_document_idx "
+                              "ON books_search_index USING GIN (document)"))
+    except SQLAlchemyError as ex:
+        log.error("Could not create full text search index, searching without index: {}".format(ex))
+        _state['engine'] = None
+        return
+    _create_trigram_indexes(engine)
+    _update_ready_state()
+
+
+def _create_trigram_indexes(engine):
+    statements = ["CREATE INDEX IF NOT EXISTS books_search_index_content_trgm_idx "
+                  "ON books_search_index USING GIN (content gin_trgm_ops)"]
+    # typeahead lookups filter on lower(name) ILIKE '%...%'
+    for table in ['authors', 'tags', 'series', 'publishers']:
+        statements.append("CREATE INDEX IF NOT EXISTS {0}_name_trgm_idx "
+                          "ON {0} USING GIN (lower(name) gin_trgm_ops)".format(table))
+    # the description search of the advanced search filters on lower(text) ILIKE '%...%'
+    statements.append("CREATE INDEX IF NOT EXISTS comments_text_trgm_idx "
+                      "ON comments USING GIN (lower(text) gin_trgm_ops)")
+    try:
+        with engine.begin() as conn:
+            conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+            for statement in statements:
+                conn.execute(text(statement))
+    except SQLAlchemyError as ex:
+        log.warning("pg_trgm extension not available, substring search is not index supported: {}".format(ex))
+
+
+def _update_ready_state():
+    """Compares number and last modification of the books with the index, returns True if they are in sync"""
+    _state['checked'] = time.monotonic()
+    try:
+        with _state['engine'].connect() as conn:
+            in_sync = conn.execute(text("SELECT (SELECT count(*) FROM books) = "
+                                        "(SELECT count(*) FROM books_search_index) AND "
+                                        "(SELECT max(last_modified) FROM books) IS NOT DISTINCT FROM "
+                                        "(SELECT max(last_modified) FROM books_search_index)")).scalar()
+    except SQLAlchemyError as ex:
+        log.debug("Checking full text search index failed: {}".format(ex))
+        in_sync = False
+    _state['ready'] = in_sync
+    return in_sync
+
+
+def _queue_update():
+    # imported here, the task imports this module
+    from .services.worker import WorkerThread
+    from .tasks.search_index import TaskUpdateSearchIndex
+    WorkerThread.add(None, TaskUpdateSearchIndex(), hidden=True)
+
+
+def is_ready():
+    """True if the index is in sync with the books, otherwise searches use the ILIKE fallback and the index is
+    updated in the background"""
+    if _state['engine'] is None:
+        return False
+    if time.monotonic() - _state['checked'] > READY_RECHECK_INTERVAL and _check_lock.acquire(blocking=False):
+        try:
+            if time.monotonic() - _state['checked'] > READY_RECHECK_INTERVAL and not _update_ready_state():
+                _queue_update()
+        finally:
+            _check_lock.release()
+    return _state['ready']
+
+
+def build_tsquery(term):
+    """Converts a user search term to a prefix matching tsquery, all words have to match"""
+    words = _word_split.findall(term or "")
+    return " & ".join("{}:*".format(word.lower()) for word in words)
+
+
+def ts_query(term):
+    return func.to_tsquery(TS_CONFIG, build_tsquery(term))
+
+
+def matching_books(term):
+    """Select of the ids of all books matching term either as words (prefix match) or as substring"""
+    query = build_tsquery(term)
+    conditions = [search_index_table.c.content.ilike("%" + term.strip().lower() + "%")]
+    if query:
+        conditions.append(search_index_table.c.document.op('@@')(func.to_tsquery(TS_CONFIG, query)))
+    if not conditions:
+        return select(search_index_table.c.book).where(text("false"))
+    return select(search_index_table.c.book).where(or_(*conditions))
+
+
+def rank(term):
+    return func.ts_rank(search_index_table.c.document, ts_query(term))
+
+
+def _document_sql(custom_columns):
+    cc_parts = list()
+    for cc in custom_columns:
+        if cc.datatype not in INDEXED_CC_TYPES:
+            continue
+        if cc.datatype == 'comments':
+            cc_parts.append("(SELECT string_agg(c.value, ' ') FROM custom_column_{0} c "
+                            "WHERE c.book = b.id)".format(int(cc.id)))
+        else:
+            cc_parts.append("(SELECT string_agg(c.value, ' ') FROM books_custom_column_{0}_link l "
+                            "JOIN custom_column_{0} c ON c.id = l.value WHERE l.book = b.id)".format(int(cc.id)))
+    categories = ", ".join(["(SELECT string_agg(t.name, ' ') FROM books_tags_link l "
+                            "JOIN tags t ON t.id = l.tag WHERE l.book = b.id)",
+                            "(SELECT string_agg(s.name, ' ') FROM books_series_link l "
+                            "JOIN series s ON s.id = l.series WHERE l.book = b.id)",
+                            "(SELECT string_agg(p.name, ' ') FROM books_publishers_link l "
+                            "JOIN publishers p ON p.id = l.publisher WHERE l.book = b.id)"] + cc_parts)
+    authors = ("(SELECT string_agg(a.name, ' ') FROM books_authors_link l "
+               "JOIN authors a ON a.id = l.author WHERE l.book = b.id)")
+    comments = "(SELECT string_agg(c.text, ' ') FROM comments c WHERE c.book = b.id)"
+    return ("SELECT b.id, "
+            "setweight(to_tsvector('{cfg}', coalesce(b.title, '')), 'A') || "
+            "setweight(to_tsvector('{cfg}', coalesce({authors}, '')), 'B') || "
+            "setweight(to_tsvector('{cfg}', concat_ws(' ', {categories})), 'C') || "
+            "setweight(to_tsvector('{cfg}', coalesce({comments}, '')), 'D'), "
+            "lower(concat_ws(' ', b.title, {authors}, {categories})), "
+            "b.last_modified "
+            "FROM books b ").format(cfg=TS_CONFIG, authors=authors, categories=categories, comments=comments)
+
+
+def _custom_columns(calibre_db):
+    # the same custom columns as searched by the ILIKE fallback
+    return calibre_db.get_cc_columns(calibre_db.config, filter_config_custom_read=True)
+
+
+def _upsert(session, custom_columns, where, params):
+    session.execute(text("INSERT INTO books_search_index (book, document, content, last_modified) "
+                         + _document_sql(custom_columns) + where +
+                         " ON CONFLICT (book) DO UPDATE SET document = EXCLUDED.document, "
+                         "content = EXCLUDED.content, last_modified = EXCLUDED.last_modified"), params)
+
+
+def update_books(calibre_db, book_ids):
+    """Reindexes the given books after they were created or edited, deleted books are removed from the index"""
+    book_ids = [int(book_id) for book_id in book_ids if book_id]
+    if not book_ids or _state['engine'] is None:
+        return
+    try:
+        custom_columns = _custom_columns(calibre_db)
+        session = calibre_db.session
+        session.execute(text("DELETE FROM books_search_index WHERE book = ANY(:ids) "
+                             "AND NOT EXISTS (SELECT 1 FROM books b WHERE b.id = books_search_index.book)"),
+                        {'ids': book_ids})
+        _upsert(session, custom_columns, "WHERE b.id = ANY(:ids)", {'ids': book_ids})
+        session.commit()
+    except SQLAlchemyError as ex:
+        calibre_db.session.rollback()
+        log.error("Updating full text search index failed: {}".format(ex))
+
+
+def remove_books(calibre_db, book_ids):
+    book_ids = [int(book_id) for book_id in book_ids if book_id]
+    if not book_ids or _state['engine'] is None:
+        return
+    try:
+        calibre_db.session.execute(text("DELETE FROM books_search_index WHERE book = ANY(:ids)"), {'ids': book_ids})
+        calibre_db.session.commit()
+    except SQLAlchemyError as ex:
+        calibre_db.session.rollback()
+        log.error("Removing books from full text search index failed: {}".format(ex))
+
+
+def count_stale_books(calibre_db):
+    return calibre_db.session.execute(text("SELECT count(*) FROM books b WHERE NOT EXISTS "
+                                           "(SELECT 1 FROM books_search_index i WHERE i.book = b.id "
+                                           "AND i.last_modified IS NOT DISTINCT FROM b.last_modified)")).scalar()
+
+
+def _refresh_stale(session, custom_columns, batch_size):
+    book_ids = [row[0] for row in session.execute(
+        text("SELECT b.id FROM books b WHERE NOT EXISTS (SELECT 1 FROM books_search_index i WHERE i.book = b.id "
+             "AND i.last_modified IS NOT DISTINCT FROM b.last_modified) ORDER BY b.id LIMIT :limit"),
+        {'limit': batch_size})]
+    if book_ids:
+        _upsert(session, custom_columns, "WHERE b.id = ANY(:ids)", {'ids': book_ids})
+    return len(book_ids)
+
+
+def refresh_stale_books(calibre_db, batch_size=500):
+    """Indexes up to batch_size books which are missing or outdated in the index, returns the number of books"""
+    count = _refresh_stale(calibre_db.session, _custom_columns(calibre_db), batch_size)
+    calibre_db.session.commit()
+    return count
+
+
+def _remove_orphans(session):
+    session.execute(text("DELETE FROM books_search_index i WHERE NOT EXISTS "
+                         "(SELECT 1 FROM books b WHERE b.id = i.book)"))
+
+
+def remove_orphans(calibre_db):
+    _remove_orphans(calibre_db.session)
+    calibre_db.session.commit()
+
+
+def mark_ready():
+    _state['ready'] = _state['engine'] is not None
+    _state['checked'] = time.monotonic()
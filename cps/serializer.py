@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+#  This file is part of the Calibre-Web (https://github.com/janeczku/calibre-web)
+#    Copyright (C) 2025 GetMyEBook-Web Contributors
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Schema driven JSON output for book lists. A schema is a list of (field name, getter) pairs, the getter extracts
+# the value from one result row. Rows are encoded one after another while the response is sent, instead of
+# serializing all objects at once with AlchemyEncoder.
+
+import json
+
+from . import isoLanguages
+
+
+def _join(elements, separator=","):
+    return separator.join(str(element.value) if hasattr(element, 'value') else str(element.get())
+                          for element in elements)
+
+
+def _date(value):
+    return value.isoformat() if value else ""
+
+
+def _language_names(languages, locale):
+    return ",".join(isoLanguages.get_language_name(locale, language.lang_code) for language in languages)
+
+
+def book_table_schema(custom_columns, locale, read_finished):
+    """Fields of the book table, rows are (Books, is_archived, read_status) tuples"""
+    schema = [
+        ('id', lambda row: row[0].id),
+        ('title', lambda row: row[0].title),
+        ('sort', lambda row: row[0].sort),
+        ('author_sort', lambda row: row[0].author_sort),
+        ('authors', lambda row: _join(row[0].authors, " & ")),
+        ('tags', lambda row: _join(row[0].tags)),
+        ('series', lambda row: _join(row[0].series)),
+        ('series_index', lambda row: row[0].series_index),
+        ('languages', lambda row: _language_names(row[0].languages, locale)),
+        ('publishers', lambda row: _join(row[0].publishers)),
+        ('comments', lambda row: _join(row[0].comments)),
+        ('ratings', lambda row: _join(row[0].ratings)),
+        ('pubdate', lambda row: _date(row[0].pubdate)),
+        ('timestamp', lambda row: _date(row[0].timestamp)),
+        ('last_modified', lambda row: _date(row[0].last_modified)),
+        ('has_cover', lambda row: row[0].has_cover),
+        ('uuid', lambda row: row[0].uuid),
+        ('is_archived', lambda row: row[1] is True),
+        ('read_status', lambda row: row[2] == read_finished),
+    ]
+    for column in custom_columns:
+        name = 'custom_column_' + str(column.id)
+        schema.append((name, lambda row, name=name: _join(getattr(row[0], name))))
+    return schema
+
+
+def project(schema, fields):
+    """Restricts the schema to the comma separated field names, the id is always part of the result"""
+    if not fields:
+        return schema
+    names = set(fields.split(","))
+    names.add('id')
+    return [field for field in schema if field[0] in names]
+
+
+def encode_row(row, schema):
+    return {name: getter(row) for name, getter in schema}
+
+
+def stream_json(head, rows_key, rows, schema):
+    """Yields the JSON object head with the encoded rows as list rows_key, one row per chunk"""
+    head_json = json.dumps(head, default=str)
+    yield head_json[:-1] + (", " if head else "") + json.dumps(rows_key) + ": ["
+    separator = ""
+    for row in rows:
+        yield separator + json.dumps(encode_row(row, schema), default=str)
+        separator = ", "
+    yield "]}"
+
+
+def _strings(elements):
+    return [str(element) for element in elements]
+
+
+def publication_metadata_schema():
+    """Metadata fields of an OPDS 2 publication of the mobile app, rows are Books. Identifiers, languages and
+    publishers are lists of the string form of the objects, as the app has always received them"""
+    return [
+        ('@type', lambda book: "http://schema.org/Book"),
+        ('title', lambda book: book.title),
+        ('subtitle', lambda book: ""),
+        ('author', lambda book: book.authors[0].name if book.authors else ""),
+        ('identifier', lambda book: _strings(book.identifiers)),
+        ('language', lambda book: _strings(book.languages)),
+        ('modified', lambda book: book.last_modified),
+        ('published', lambda book: book.pubdate),
+        ('publisher', lambda book: _strings(book.publishers)),
+        ('imprint', lambda book: ""),
+        ('numberOfPages', lambda book: 0),
+        ('subject', lambda book: []),
+        ('belongsTo', lambda book: {}),
+        ('description', lambda book: ""),
+    ]
+
+
+def publication_schema(metadata_schema, book_formats, base_url):
+    """Fields of an OPDS 2 publication, book_formats maps the book ids to the lower case format to download"""
+    def links(row):
+        book_id = row[0].id
+        book_format = book_formats.get(book_id)
+        if not book_format:
+            return []
+        return [{"rel": base_url,
+                 "href": "{0}/download/{1}/{2}/{1}.{2}".format(base_url, book_id, book_format),
+                 "type": 'application/pdf' if book_format == 'pdf' else 'application/epub+zip'}]
+
+    def images(row):
+        return [{"href": "{}/cover/{}".format(base_url, row[0].id), "type": "image/jpg", "height": 0, "width": 0}]
+
+    return [('metadata', lambda row: encode_row(row[0], metadata_schema)),
+            ('links', links),
+            ('images', images)]
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+
+#  This file is part of the Calibre-Web (https://github.com/janeczku/calibre-web)
+#    Copyright (C) 2025 GetMyEBook-Web Contributors
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Durable task queue in a table of the app database, shared by all app processes and nodes. Every process claims
+# waiting entries with SELECT ... FOR UPDATE SKIP LOCKED and keeps the claimed entries alive with a heartbeat,
+# entries of a process which stopped sending heartbeats are handed out again after the lease expired. Failed
+# entries are retried with exponential backoff, waiting entries with the same dedup key are only queued once.
+
+import json
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import delete, exists, func, select, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import SQLAlchemyError
+
+from .. import logger
+
+log = logger.create()
+
+STATUS_WAITING = 'waiting'
+STATUS_RUNNING = 'running'
+STATUS_FAILED = 'failed'
+
+DEFAULT_LEASE = 300
+# first retry after RETRY_BACKOFF seconds, doubled with every further attempt up to RETRY_BACKOFF_MAX
+RETRY_BACKOFF = 30
+RETRY_BACKOFF_MAX = 3600
+# entries which failed for good are kept this many days to look into the error
+FAILED_RETENTION_DAYS = 7
+# serializes the claims of all nodes, the limits per task type are counted over all nodes
+CLAIM_LOCK_ID = 0x63707331
+
+
+def _now():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class DatabaseTaskStore:
+    """Task queue in a table with the columns of ub.TaskQueueEntry"""
+    def __init__(self, engine, table, lease=DEFAULT_LEASE):
+        self.engine = engine
+        self.table = table
+        self.lease = lease
+        self.node = "{}:{}:{}".format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+    def put(self, task_class, arguments, user, hidden, scheduled, task_type, priority, dedup_key, max_attempts):
+        """Queues a task, an already waiting entry with the same dedup key is moved to the end of the queue instead.
+        Returns False if the entry could not be stored"""
+        table = self.table
+        statement = insert(table).values(task_class=task_class,
+                                         arguments=json.dumps(arguments),
+                                         user=user,
+                                         hidden=hidden,
+                                         scheduled=scheduled,
+                                         task_type=task_type,
+                                         priority=priority,
+                                         dedup_key=dedup_key,
+                                         status=STATUS_WAITING,
+                                         attempts=0,
+                                         max_attempts=max_attempts,
+                                         run_after=_now(),
+                                         created=_now())
+        if dedup_key is not None:
+            statement = statement.on_conflict_do_update(index_elements=[table.c.dedup_key],
+                                                        index_where=table.c.status == STATUS_WAITING,
+                                                        set_={'position': statement.excluded.position,
+                                                              'run_after': statement.excluded.run_after})
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(statement)
+        except SQLAlchemyError as ex:
+            log.error("Storing task in task queue failed: {}".format(ex))
+            return False
+        return True
+
+    def claim(self, type_limits, default_limit=1):
+        """Marks the next waiting entry as running on this node and returns it, types which already run the
+        allowed number of tasks on all nodes are skipped"""
+        table = self.table
+        now = _now()
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(select(func.pg_advisory_xact_lock(CLAIM_LOCK_ID)))
+                running = conn.execute(select(table.c.task_type, func.count())
+                                       .where(table.c.status == STATUS_RUNNING)
+                                       .group_by(table.c.task_type)).all()
+                saturated = [task_type for task_type, count in running
+                             if count >= type_limits.get(task_type, default_limit)]
+                entry = conn.execute(select(table)
+                                     .where(table.c.status == STATUS_WAITING,
+                                            table.c.run_after <= now,
+                                            table.c.task_type.not_in(saturated))
+                                     .order_by(table.c.priority, table.c.position)
+                                     .limit(1)
+                                     .with_for_update(skip_locked=True)).first()
+                if entry is None:
+                    return None
+                conn.execute(update(table)
+                             .where(table.c.id == entry.id)
+                             .values(status=STATUS_RUNNING,
+                                     attempts=table.c.attempts + 1,
+                                     locked_by=self.node,
+                                     heartbeat=now))
+                return entry
+        except SQLAlchemyError as ex:
+            log.error("Claiming task from task queue failed: {}".format(ex))
+            return None
+
+    def heartbeat(self, entry_ids):
+        """Extends the lease of the entries running on this node"""
+        if not entry_ids:
+            return
+        table = self.table
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(update(table)
+                             .where(table.c.id.in_(entry_ids), table.c.locked_by == self.node)
+                             .values(heartbeat=_now()))
+        except SQLAlchemyError as ex:
+            log.error("Renewing task queue lease failed: {}".format(ex))
+
+    def recover(self):
+        """Hands out the entries of nodes with an expired lease again and deletes old failed entries"""
+        table = self.table
+        waiting = table.alias()
+        now = _now()
+        stale = (table.c.status == STATUS_RUNNING) & (table.c.heartbeat < now - timedelta(seconds=self.lease))
+        try:
+            with self.engine.begin() as conn:
+                # a newer request of the same task is already waiting
+                conn.execute(delete(table).where(stale,
+                                                 table.c.dedup_key.isnot(None),
+                                                 exists().where(waiting.c.dedup_key == table.c.dedup_key,
+                                                                waiting.c.status == STATUS_WAITING)))
+                conn.execute(update(table)
+                             .where(stale, table.c.attempts >= table.c.max_attempts)
+                             .values(status=STATUS_FAILED, locked_by=None, last_error="Lease expired"))
+                conn.execute(update(table)
+                             .where(stale)
+                             .values(status=STATUS_WAITING, locked_by=None, run_after=now))
+                conn.execute(delete(table).where(table.c.status == STATUS_FAILED,
+                                                 table.c.run_after < now - timedelta(days=FAILED_RETENTION_DAYS)))
+        except SQLAlchemyError as ex:
+            log.error("Recovering task queue failed: {}".format(ex))
+
+    def complete(self, entry_id):
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(delete(self.table).where(self.table.c.id == entry_id))
+        except SQLAlchemyError as ex:
+            log.error("Removing task from task queue failed: {}".format(ex))
+
+    def fail(self, entry_id, error, retry=True):
+        """Queues the entry again with backoff, or marks it as failed once all attempts are used up"""
+        table = self.table
+        waiting = table.alias()
+        now = _now()
+        try:
+            with self.engine.begin() as conn:
+                entry = conn.execute(select(table.c.attempts, table.c.max_attempts, table.c.dedup_key)
+                                     .where(table.c.id == entry_id)).first()
+                if entry is None:
+                    return
+                if retry and entry.attempts < entry.max_attempts:
+                    if entry.dedup_key is not None and conn.execute(
+                            select(exists().where(waiting.c.dedup_key == entry.dedup_key,
+                                                  waiting.c.status == STATUS_WAITING))).scalar():
+                        conn.execute(delete(table).where(table.c.id == entry_id))
+                        return
+                    backoff = min(RETRY_BACKOFF * 2 ** (entry.attempts - 1), RETRY_BACKOFF_MAX)
+                    values = dict(status=STATUS_WAITING, run_after=now + timedelta(seconds=backoff))
+                else:
+                    values = dict(status=STATUS_FAILED, run_after=now)
+                conn.execute(update(table)
+                             .where(table.c.id == entry_id)
+                             .values(locked_by=None, last_error=str(error), **values))
+        except SQLAlchemyError as ex:
+            log.error("Updating failed task in task queue failed: {}".format(ex))
+
+    def waiting(self):
+        """Entries no node has claimed yet, in the order they are handed out"""
+        table = self.table
+        try:
+            with self.engine.connect() as conn:
+                return conn.execute(select(table)
+                                    .where(table.c.status == STATUS_WAITING)
+                                    .order_by(table.c.priority, table.c.position)).all()
+        except SQLAlchemyError as ex:
+            log.error("Reading task queue failed: {}".format(ex))
+            return []
+
+    def cancel(self, entry_id):
+        """Removes the entry if no node has claimed it yet"""
+        table = self.table
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(delete(table).where(table.c.id == entry_id, table.c.status == STATUS_WAITING))
+        except SQLAlchemyError as ex:
+            log.error("Removing task from task queue failed: {}".format(ex))
+
+    def cancel_scheduled(self):
+        """Removes the waiting entries of scheduled tasks, called at the end of the scheduled time window"""
+        table = self.table
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(delete(table).where(table.c.status == STATUS_WAITING, table.c.scheduled.is_(True)))
+        except SQLAlchemyError as ex:
+            log.error("Removing scheduled tasks from task queue failed: {}".format(ex))
@@ -16,15 +16,14 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program. If not, see <http://www.gnu.org/licenses/>.
 
+import os
+import importlib
+import json
 import threading
 import abc
-import uuid
 import time
-
-try:
-    import queue
-except ImportError:
-    import Queue as queue
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from collections import namedtuple
 
@@ -40,9 +39,24 @@ STAT_FINISH_SUCCESS = 3
 STAT_ENDED = 4
 STAT_CANCELLED = 5
 
+# task priorities, waiting tasks with a lower value are started first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NORMAL = 5
+PRIORITY_BULK = 10
+
 # Only retain this many tasks in dequeued list
 TASK_CLEANUP_TRIGGER = 20
 
+# number of tasks running at the same time
+WORKER_POOL_SIZE = 4
+# number of tasks of one type running at the same time, types not listed here run one at a time
+TASK_TYPE_LIMITS = {
+    'email': 2,
+}
+# the dispatcher wakes up at least this often to check if the main thread is still alive and to poll the durable
+# task queue
+WAIT_INTERVAL = 5
+
 QueuedTask = namedtuple('QueuedTask', 'num, user, added, task, hidden')
 
 
@@ -53,17 +67,56 @@ def _get_main_thread():
     raise Exception("main thread not found?!")
 
 
-class ImprovedQueue(queue.Queue):
+def _task_class(task_class):
+    # only task classes of the cps.tasks package are created from the durable task queue
+    module_name, __, class_name = task_class.rpartition('.')
+    if not module_name.startswith('cps.tasks.'):
+        raise ValueError("Not a task module: {}".format(module_name))
+    cls = getattr(importlib.import_module(module_name), class_name)
+    if not (isinstance(cls, type) and issubclass(cls, CalibreTask)):
+        raise ValueError("Not a task class: {}".format(task_class))
+    return cls
+
+
+def _load_task(task_class, arguments):
+    return _task_class(task_class).deserialize(json.loads(arguments))
+
+
+def _get_pool_size():
+    try:
+        return max(1, int(os.getenv("WORKER_POOL_SIZE") or WORKER_POOL_SIZE))
+    except ValueError:
+        return WORKER_POOL_SIZE
+
+
+class TaskQueue:
+    """Waiting tasks ordered by priority and by the order they were added, guarded by the lock of the worker"""
+    def __init__(self, lock):
+        self.items = list()
+        self.lock = lock
+
+    def put(self, item):
+        with self.lock:
+            self.items.append(item)
+            self.items.sort(key=lambda x: (x.task.priority, x.num))
+
     def to_list(self):
         """
         Returns a copy of all items in the queue without removing them.
         """
+        with self.lock:
+            return list(self.items)
+
+    def remove(self, item):
+        with self.lock:
+            self.items.remove(item)
 
-        with self.mutex:
-            return list(self.queue)
+    def __len__(self):
+        with self.lock:
+            return len(self.items)
 
 
-# Class for all worker tasks in the background
+# Class for all worker tasks in the background, dispatches the waiting tasks to a pool of threads
 class WorkerThread(threading.Thread):
     _instance = None
 
@@ -78,30 +131,77 @@ class WorkerThread(threading.Thread):
 
         self.dequeued = list()
 
-        self.doLock = threading.Lock()
-        self.queue = ImprovedQueue()
+        # reentrant, the task queue takes it as well while the dispatcher already holds it
+        self.doLock = threading.RLock()
+        # notified if a task was added or a running task finished
+        self.changed = threading.Condition(self.doLock)
+        self.changes = 0
+        self.queue = TaskQueue(self.doLock)
+        self.running = dict()
+        self.exclusive_running = False
+        # durable task queue shared with the other app processes, tasks only run from memory as long as it is unset
+        self.store = None
+        self.claimed = set()
+        self.pool_size = _get_pool_size()
+        # the pool threads are joined on exit, tasks are not halted abruptly
+        self.pool = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix="worker")
         self.num = 0
         self.start()
 
     @classmethod
     def add(cls, user, task, hidden=False):
         ins = cls.get_instance()
-        ins.num += 1
         username = user if user is not None else 'System'
         log.debug("Add Task for user: {} - {}".format(username, task))
-        ins.queue.put(QueuedTask(
-            num=ins.num,
-            user=username,
-            added=datetime.now(),
-            task=task,
-            hidden=hidden
-        ))
+        arguments = task.serialize() if ins.store is not None else None
+        if arguments is not None and ins.store.put("{}.{}".format(type(task).__module__, type(task).__name__),
+                                                   arguments, username, hidden, task.scheduled, task.task_type,
+                                                   task.priority, task.dedup_key, task.max_attempts):
+            with ins.changed:
+                ins._notify()
+            return
+        with ins.changed:
+            ins.num += 1
+            ins.queue.put(QueuedTask(
+                num=ins.num,
+                user=username,
+                added=datetime.now(),
+                task=task,
+                hidden=hidden
+            ))
+            ins._notify()
+
+    def set_store(self, store):
+        with self.changed:
+            self.store = store
+            self._notify()
+
+    def cancel_scheduled_tasks(self):
+        """Removes the scheduled tasks which still wait in the durable task queue"""
+        if self.store is not None:
+            self.store.cancel_scheduled()
 
     @property
     def tasks(self):
+        # tasks of the durable task queue which no node has claimed yet are listed behind the tasks of this process
+        waiting = self.store.waiting() if self.store is not None else []
         with self.doLock:
-            tasks = self.queue.to_list() + self.dequeued
-            return sorted(tasks, key=lambda x: x.num)
+            tasks = sorted(self.queue.to_list() + self.dequeued, key=lambda x: x.num)
+            claimed = set(self.claimed)
+            num = self.num
+        for entry in waiting:
+            # claimed after the queue was read, it is listed with the tasks of this process already
+            if entry.id in claimed:
+                continue
+            num += 1
+            tasks.append(QueuedTask(
+                num=num,
+                user=entry.user,
+                added=entry.created,
+                task=WaitingEntryTask(entry),
+                hidden=entry.hidden
+            ))
+        return tasks
 
     def cleanup_tasks(self):
         with self.doLock:
@@ -120,50 +220,154 @@ class WorkerThread(threading.Thread):
 
             self.dequeued = sorted(ret, key=lambda y: y.num)
 
+    def _notify(self):
+        # called with the lock held
+        self.changes += 1
+        self.changed.notify()
+
+    def _next_task(self):
+        # called with the lock held. An exclusive task waits until all running tasks are finished, the tasks behind
+        # it are held back meanwhile so that it is not starved
+        if self.exclusive_running:
+            return None
+        running = sum(self.running.values())
+        if running >= self.pool_size:
+            return None
+        for item in self.queue.to_list():
+            task_type = item.task.task_type
+            if item.task.exclusive:
+                return item if running == 0 else None
+            if self.running.get(task_type, 0) < TASK_TYPE_LIMITS.get(task_type, 1):
+                return item
+        return None
+
+    def _can_claim(self):
+        # called with the lock held, tasks waiting in memory are started before tasks of the durable queue
+        return (self.store is not None
+                and not self.exclusive_running
+                and sum(self.running.values()) < self.pool_size
+                and not any(item.task.exclusive for item in self.queue.to_list()))
+
+    def _start_item(self, item):
+        # called with the lock held
+        self.running[item.task.task_type] = self.running.get(item.task.task_type, 0) + 1
+        self.exclusive_running = item.task.exclusive
+        if item.task.queue_id is not None:
+            self.claimed.add(item.task.queue_id)
+        # add to list so that in-progress tasks show up
+        self.dequeued.append(item)
+        return len(self.dequeued) > TASK_CLEANUP_TRIGGER
+
+    def _claim_task(self):
+        entry = self.store.claim(TASK_TYPE_LIMITS)
+        if entry is None:
+            return None
+        try:
+            task = _load_task(entry.task_class, entry.arguments)
+        except Exception as ex:
+            log.error("Could not load task {} from task queue: {}".format(entry.task_class, ex))
+            self.store.fail(entry.id, str(ex), retry=False)
+            return None
+        task.queue_id = entry.id
+        task.scheduled = entry.scheduled
+        with self.changed:
+            self.num += 1
+            return QueuedTask(
+                num=self.num,
+                user=entry.user,
+                added=entry.created,
+                task=task,
+                hidden=entry.hidden
+            )
+
+    def _renew_leases(self):
+        with self.doLock:
+            claimed = list(self.claimed)
+        self.store.heartbeat(claimed)
+        self.store.recover()
+
     # Main thread loop starting the different tasks
     def run(self):
         main_thread = _get_main_thread()
+        last_renewal = 0
         while main_thread.is_alive():
-            try:
-                # this blocks until something is available. This can cause issues when the main thread dies - this
-                # thread will remain alive. We implement a timeout to unblock every second which allows us to check if
-                # the main thread is still alive.
-                # We don't use a daemon here because we don't want the tasks to just be abruptly halted, leading to
-                # possible file / database corruption
-                item = self.queue.get(timeout=1)
-            except queue.Empty:
-                time.sleep(1)
-                continue
-
-            with self.doLock:
-                # add to list so that in-progress tasks show up
-                self.dequeued.append(item)
+            if self.store is not None and time.monotonic() - last_renewal > self.store.lease / 4:
+                self._renew_leases()
+                last_renewal = time.monotonic()
+            with self.changed:
+                item = self._next_task()
+                if item is None and not self._can_claim():
+                    # blocks until a task is added or finished. The timeout allows us to check if the main thread is
+                    # still alive and to poll the durable queue for tasks of other processes. We don't use a daemon
+                    # here because we don't want the tasks to just be abruptly halted, leading to possible file /
+                    # database corruption
+                    self.changed.wait(timeout=WAIT_INTERVAL)
+                    continue
+                if item is not None:
+                    self.queue.remove(item)
+                    cleanup = self._start_item(item)
+                changes = self.changes
+
+            if item is None:
+                item = self._claim_task()
+                with self.changed:
+                    if item is None:
+                        # nothing to claim, wait unless something happened meanwhile
+                        if self.changes == changes:
+                            self.changed.wait(timeout=WAIT_INTERVAL)
+                        continue
+                    cleanup = self._start_item(item)
 
             # once we hit our trigger, start cleaning up dead tasks
-            if len(self.dequeued) > TASK_CLEANUP_TRIGGER:
+            if cleanup:
                 self.cleanup_tasks()
 
+            self.pool.submit(self._run_task, item)
+        self.pool.shutdown(wait=True)
+
+    def _run_task(self, item):
+        try:
             # sometimes tasks (like Upload) don't actually have work to do and are created as already finished
             if item.task.stat is STAT_WAITING:
                 # CalibreTask.start() should wrap all exceptions in its own error handling
                 item.task.start(self)
-
-            # remove self_cleanup tasks and hidden "System Tasks" from list
-            if item.task.self_cleanup or item.hidden:
-                self.dequeued.remove(item)
-
-            self.queue.task_done()
+        finally:
+            if item.task.queue_id is not None:
+                # cancelled tasks are not retried
+                if item.task.stat == STAT_FAIL:
+                    self.store.fail(item.task.queue_id, item.task.error)
+                else:
+                    self.store.complete(item.task.queue_id)
+            with self.changed:
+                self.running[item.task.task_type] -= 1
+                self.claimed.discard(item.task.queue_id)
+                if item.task.exclusive:
+                    self.exclusive_running = False
+                # remove self_cleanup tasks and hidden "System Tasks" from list
+                if (item.task.self_cleanup or item.hidden) and item in self.dequeued:
+                    self.dequeued.remove(item)
+                self._notify()
 
     def end_task(self, task_id):
         ins = self.get_instance()
         for __, __, __, task, __ in ins.tasks:
             if str(task.id) == str(task_id) and task.is_cancellable:
+                if isinstance(task, WaitingEntryTask):
+                    ins.store.cancel(task.queue_id)
                 task.stat = STAT_CANCELLED if task.stat == STAT_WAITING else STAT_ENDED
 
 
 class CalibreTask:
     __metaclass__ = abc.ABCMeta
 
+    # tasks of the same type share the concurrency limit of the type (TASK_TYPE_LIMITS)
+    task_type = 'default'
+    priority = PRIORITY_NORMAL
+    # exclusive tasks run while no other task is running
+    exclusive = False
+    # attempts of a task from the durable task queue before it is given up
+    max_attempts = 3
+
     def __init__(self, message):
         self._progress = 0
         self.stat = STAT_WAITING
@@ -174,6 +378,8 @@ class CalibreTask:
         self.id = uuid.uuid4()
         self.self_cleanup = False
         self._scheduled = False
+        # id of the entry in the durable task queue
+        self.queue_id = None
 
     @abc.abstractmethod
     def run(self, worker_thread):
@@ -190,6 +396,20 @@ class CalibreTask:
         """Does this task gracefully handle being cancelled (STAT_ENDED, STAT_CANCELLED)?"""
         raise NotImplementedError
 
+    def serialize(self):
+        """Constructor arguments of the task as JSON compatible dict. Tasks returning None are not stored in the durable
+        task queue and only run in the process they were added in"""
+        return None
+
+    @classmethod
+    def deserialize(cls, arguments):
+        return cls(**arguments)
+
+    @property
+    def dedup_key(self):
+        """Only one waiting task per key is kept in the durable task queue"""
+        return None
+
     def start(self, *args):
         self.start_time = datetime.now()
         self.stat = STAT_STARTED
@@ -269,3 +489,32 @@ class CalibreTask:
 
     def __str__(self):
         return self.name
+
+
+class WaitingEntryTask(CalibreTask):
+    """Entry of the durable task queue which no node has claimed yet, only used to list and cancel it"""
+    def __init__(self, entry):
+        super(WaitingEntryTask, self).__init__(json.loads(entry.arguments).get('task_message', ''))
+        # the id stays the same on every listing, the task list cancels tasks by id
+        self.id = "queue-{}".format(entry.id)
+        self.queue_id = entry.id
+        self.scheduled = entry.scheduled
+        try:
+            # the name and cancel flag of the task classes don't depend on the task arguments
+            cls = _task_class(entry.task_class)
+            self._name = cls.name.fget(self)
+            self._is_cancellable = cls.is_cancellable.fget(self)
+        except Exception:
+            self._name = entry.task_class.rpartition('.')[2]
+            self._is_cancellable = True
+
+    def run(self, worker_thread):
+        raise NotImplementedError
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def is_cancellable(self):
+        return self._is_cancellable
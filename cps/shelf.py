@@ -31,6 +31,7 @@ from sqlalchemy.sql.expression import func, true
 
 from . import calibre_db, config, db, logger, ub
 from .render_template import render_title_template
+from .search import adv_search_query
 from .usermanagement import login_required_if_no_ano, user_login_required
 
 log = logger.create()
@@ -116,18 +117,22 @@ def search_to_shelf(shelf_id):
         flash(_("You are not allowed to add a book to the shelf"), category="error")
         return redirect(url_for('web.index'))
 
-    if current_user.id in ub.searched_ids and ub.searched_ids[current_user.id]:
-        books_for_shelf = list()
-        books_in_shelf = ub.session.query(ub.BookShelf).filter(ub.BookShelf.shelf == shelf_id).all()
-        if books_in_shelf:
-            book_ids = list()
-            for book_id in books_in_shelf:
-                book_ids.append(book_id.book_id)
-            for searchid in ub.searched_ids[current_user.id]:
-                if searchid not in book_ids:
-                    books_for_shelf.append(searchid)
+    searched_ids = ub.get_searched_ids()
+    search_query = ub.get_search_query() if searched_ids is None else None
+    if search_query or searched_ids:
+        books_in_shelf = ub.session.query(ub.BookShelf.book_id).filter(ub.BookShelf.shelf == shelf_id)
+        if search_query:
+            # the last search is run again and only the ids of books missing in the shelf are fetched
+            if search_query['kind'] == 'advanced':
+                query = adv_search_query(search_query['term'])[0]
+            else:
+                query = calibre_db.search_query(search_query['term'], config)
+            query = query.with_entities(db.Books.id).filter(db.Books.id.notin_(books_in_shelf))\
+                .distinct().order_by(db.Books.id)
+            books_for_shelf = [book_id for book_id, in query]
         else:
-            books_for_shelf = ub.searched_ids[current_user.id]
+            book_ids = set(book_id for book_id, in books_in_shelf)
+            books_for_shelf = [searchid for searchid in searched_ids if searchid not in book_ids]
 
         if not books_for_shelf:
             log.error("Books are already part of {}".format(shelf.name))
@@ -1,12 +1,15 @@
 # -*- coding: utf-8 -*-
 
 from cps import logger, calibre_db, db, ub
-from cps.services.worker import CalibreTask
+from cps.services.worker import CalibreTask, PRIORITY_BULK
 from cps.forum.database.models import Thread, Category
 from slugify import slugify
 from flask_babel import lazy_gettext as N_
 
 class TaskCheckThreads(CalibreTask):
+    task_type = 'forum'
+    priority = PRIORITY_BULK
+
     def __init__(self, task_message=N_('Check and create missing book threads')):
         super(TaskCheckThreads, self).__init__(task_message)
         self.log = logger.create()
@@ -93,6 +96,13 @@ class TaskCheckThreads(CalibreTask):
         self.log.info(f"Thread check complete. Created: {created_count}, Skipped: {skipped_count}")
         self._handleSuccess()
 
+    def serialize(self):
+        return dict()
+
+    @property
+    def dedup_key(self):
+        return "check_threads"
+
     @property
     def name(self):
         return "Check Missing Threads"
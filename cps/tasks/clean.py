@@ -22,10 +22,13 @@ from flask_babel import lazy_gettext as N_
 from sqlalchemy.sql.expression import or_
 
 from cps import logger, file_helper, ub
-from cps.services.worker import CalibreTask
+from cps.services.worker import CalibreTask, PRIORITY_BULK
 
 
 class TaskClean(CalibreTask):
+    task_type = 'clean'
+    priority = PRIORITY_BULK
+
     def __init__(self, task_message=N_('Delete temp folder contents')):
         super(TaskClean, self).__init__(task_message)
         self.log = logger.create()
@@ -55,6 +58,13 @@ class TaskClean(CalibreTask):
         self._handleSuccess()
         self.app_db_session.remove()
 
+    def serialize(self):
+        return dict()
+
+    @property
+    def dedup_key(self):
+        return "clean"
+
     @property
     def name(self):
         return "Clean up"
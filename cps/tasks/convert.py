@@ -27,7 +27,7 @@ from uuid import uuid4
 from sqlalchemy.exc import SQLAlchemyError
 from flask_babel import lazy_gettext as N_
 
-from cps.services.worker import CalibreTask
+from cps.services.worker import CalibreTask, PRIORITY_NORMAL
 from cps import db
 from cps import logger, config
 from cps.subproc_wrapper import process_open
@@ -36,7 +36,7 @@ from cps.kobo_sync_status import remove_synced_book
 from cps.ub import init_db_thread
 from cps.file_helper import get_temp_dir
 
-from cps.tasks.mail import TaskEmail
+from cps.tasks.mail import TaskEmail, without_mail_settings
 from cps import gdriveutils, helper
 from cps.constants import SUPPORTED_CALIBRE_BINARIES
 
@@ -46,6 +46,9 @@ current_milli_time = lambda: int(round(time() * 1000))
 
 
 class TaskConvert(CalibreTask):
+    task_type = 'convert'
+    priority = PRIORITY_NORMAL
+
     def __init__(self, file_path, book_id, task_message, settings, ereader_mail, user=None):
         super(TaskConvert, self).__init__(task_message)
         self.worker_thread = None
@@ -324,6 +327,21 @@ class TaskConvert(CalibreTask):
                 error_message = N_("Calibre failed with error: %(error)s", error=ele)
         return check, error_message
 
+    def serialize(self):
+        # the mail server settings are not stored in the task queue, they are read from the config again
+        return dict(file_path=self.file_path,
+                    book_id=self.book_id,
+                    task_message=str(self.message),
+                    settings=without_mail_settings(self.settings),
+                    ereader_mail=self.ereader_mail,
+                    user=self.user)
+
+    @classmethod
+    def deserialize(cls, arguments):
+        if arguments['ereader_mail']:
+            arguments['settings'].update(config.get_mail_settings())
+        return cls(**arguments)
+
     @property
     def name(self):
         return N_("Convert")
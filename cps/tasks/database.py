@@ -19,10 +19,14 @@
 from flask_babel import lazy_gettext as N_
 
 from cps import config, logger, db, ub
-from cps.services.worker import CalibreTask
+from cps.services.worker import CalibreTask, PRIORITY_INTERACTIVE
 
 
 class TaskReconnectDatabase(CalibreTask):
+    task_type = 'database'
+    priority = PRIORITY_INTERACTIVE
+    exclusive = True
+
     def __init__(self, task_message=N_('Reconnecting Calibre database')):
         super(TaskReconnectDatabase, self).__init__(task_message)
         self.log = logger.create()
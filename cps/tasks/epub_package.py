@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+#  This file is part of the Calibre-Web (https://github.com/janeczku/calibre-web)
+#    Copyright (C) 2025 GetMyEBook-Web Contributors
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import zipfile
+
+from flask_babel import lazy_gettext as N_
+from sqlalchemy import text
+
+from cps import db, epub, logger, ub
+from cps.services.worker import CalibreTask, PRIORITY_BULK, STAT_CANCELLED, STAT_ENDED
+
+
+class TaskScanEpubPackages(CalibreTask):
+    """Parses the package of all epub files which are missing or outdated in the epub_package_info table"""
+    task_type = 'epub_package'
+    priority = PRIORITY_BULK
+
+    def __init__(self, batch_size=200, task_message=N_('Scanning epub files')):
+        super(TaskScanEpubPackages, self).__init__(task_message)
+        self.log = logger.create()
+        self.batch_size = batch_size
+        self.calibre_db = db.CalibreDB(expire_on_commit=False, init=True)
+        self.app_db_session = ub.get_new_session_instance()
+
+    def run(self, worker_thread):
+        if not self.calibre_db.session:
+            self._handleSuccess()
+            return
+        try:
+            # entries of deleted formats
+            self.app_db_session.execute(text("DELETE FROM epub_package_info i WHERE NOT EXISTS "
+                                             "(SELECT 1 FROM data d WHERE d.id = i.data_id)"))
+            self.app_db_session.commit()
+
+            files = (self.calibre_db.session.query(db.Data, db.Books.path)
+                     .join(db.Books, db.Data.book == db.Books.id)
+                     .filter(db.Data.format.in_(epub.PACKAGE_FORMATS)))
+            count = files.count()
+            stored = dict((row.data_id, (row.file_size, row.file_mtime)) for row in
+                          self.app_db_session.query(ub.EpubPackageInfo.data_id, ub.EpubPackageInfo.file_size,
+                                                    ub.EpubPackageInfo.file_mtime))
+            last_id = done = parsed = 0
+            while True:
+                batch = files.filter(db.Data.id > last_id).order_by(db.Data.id).limit(self.batch_size).all()
+                if not batch:
+                    break
+                connection = self.app_db_session.connection()
+                for book_data, book_path in batch:
+                    file_path = epub.get_book_file_path(book_path, book_data)
+                    stat = epub.file_stat(file_path)
+                    if stat is not None and stored.get(book_data.id) != stat:
+                        try:
+                            info = epub.read_package_info(file_path)
+                        except zipfile.BadZipfile as e:
+                            self.log.error("Epub file {} is no zip archive: {}".format(file_path, e))
+                            continue
+                        epub.store_package_info(connection, book_data.id, book_data.book, stat, info)
+                        parsed += 1
+                self.app_db_session.commit()
+                last_id = batch[-1][0].id
+                done += len(batch)
+                self.progress = min(1.0, done / count)
+                self.message = N_('Scanned %(count)s of %(total)s epub files', count=done, total=count)
+
+                # Check if job has been cancelled or ended
+                if self.stat == STAT_CANCELLED or self.stat == STAT_ENDED:
+                    self.log.info('ScanEpubPackages task has been stopped.')
+                    self._close_sessions()
+                    return
+            if parsed == 0:
+                self.self_cleanup = True
+            self._handleSuccess()
+        except Exception as ex:
+            self.log.error_or_exception(ex)
+            self._handleError('Error scanning epub files: ' + str(ex))
+            self.app_db_session.rollback()
+        self._close_sessions()
+
+    def _close_sessions(self):
+        self.calibre_db.session.close()
+        self.app_db_session.close()
+
+    def serialize(self):
+        return dict(batch_size=self.batch_size)
+
+    @property
+    def dedup_key(self):
+        return "scan_epub_packages"
+
+    @property
+    def name(self):
+        return "Scan Epub Files"
+
+    def __str__(self):
+        return "Scan epub package metadata"
+
+    @property
+    def is_cancellable(self):
+        return True
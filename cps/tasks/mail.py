@@ -29,7 +29,7 @@ from email.utils import formatdate, parseaddr
 from email.generator import Generator
 from flask_babel import lazy_gettext as N_
 
-from cps.services.worker import CalibreTask
+from cps.services.worker import CalibreTask, PRIORITY_INTERACTIVE
 from cps.services import gmail
 from cps.embed_helper import do_calibre_export
 from cps import logger, config
@@ -108,8 +108,17 @@ class EmailSSL(EmailBase, smtplib.SMTP_SSL):
         smtplib.SMTP_SSL.__init__(self, *args, **kwargs)
 
 
+def without_mail_settings(settings):
+    """Task settings without the mail server configuration, which contains the credentials"""
+    return dict((key, value) for key, value in settings.items() if not key.startswith('mail_'))
+
+
 class TaskEmail(CalibreTask):
-    def __init__(self, subject, filepath, attachment, settings, recipient, task_message, text, html=None, id=0, internal=False):
+    task_type = 'email'
+    priority = PRIORITY_INTERACTIVE
+
+    def __init__(self, subject, filepath, attachment, settings, recipient, task_message, text, html=None, id=0, internal=False,
+                 sensitive=False):
         super(TaskEmail, self).__init__(task_message)
         self.subject = subject
         self.attachment = attachment
@@ -120,6 +129,9 @@ class TaskEmail(CalibreTask):
         self.text = text
         self.asyncSMTP = None
         self.book_id = id
+        self.internal = internal
+        # mails with passwords or one time codes are only kept in memory, never in the task queue
+        self.sensitive = sensitive
         self.results = dict()
 
     # from calibre code:
@@ -312,6 +324,26 @@ class TaskEmail(CalibreTask):
                 return None
         return data
 
+    def serialize(self):
+        if self.sensitive:
+            return None
+        # the mail server settings are not stored in the task queue, they are read from the config again
+        return dict(subject=str(self.subject),
+                    filepath=self.filepath,
+                    attachment=self.attachment,
+                    settings=without_mail_settings(self.settings),
+                    recipient=self.recipient,
+                    task_message=str(self.message),
+                    text=str(self.text),
+                    html=self.html,
+                    id=self.book_id,
+                    internal=self.internal)
+
+    @classmethod
+    def deserialize(cls, arguments):
+        arguments['settings'].update(config.get_mail_settings())
+        return cls(**arguments)
+
     @property
     def name(self):
         return N_("E-mail")
@@ -20,13 +20,15 @@ import os
 from lxml import etree
 
 from cps import config, db, gdriveutils, logger
-from cps.services.worker import CalibreTask
+from cps.services.worker import CalibreTask, PRIORITY_BULK
 from flask_babel import lazy_gettext as N_
 
 from ..epub_helper import create_new_metadata_backup
 
 
 class TaskBackupMetadata(CalibreTask):
+    task_type = 'metadata_backup'
+    priority = PRIORITY_BULK
 
     def __init__(self, export_language="en",
                  translated_title="Cover",
@@ -112,6 +114,21 @@ class TaskBackupMetadata(CalibreTask):
             except Exception as ex:
                 raise Exception('Writing Metadata failed with error: {} '.format(ex))
 
+    def serialize(self):
+        return dict(export_language=str(self.export_language),
+                    translated_title=str(self.translated_title),
+                    set_dirty=self.set_dirty)
+
+    @classmethod
+    def deserialize(cls, arguments):
+        if arguments['set_dirty']:
+            arguments['task_message'] = N_("Queue all books for metadata backup")
+        return cls(**arguments)
+
+    @property
+    def dedup_key(self):
+        return "backup_metadata:{}".format(int(self.set_dirty))
+
     @property
     def name(self):
         return "Metadata backup"
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+#  This file is part of the Calibre-Web (https://github.com/janeczku/calibre-web)
+#    Copyright (C) 2025 GetMyEBook-Web Contributors
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from flask_babel import lazy_gettext as N_
+from sqlalchemy import func, or_, select
+from sqlalchemy.dialects.postgresql import insert
+
+from cps import app, logger
+from cps.forum import db as forum_db
+from cps.services.worker import CalibreTask, PRIORITY_BULK
+from cps.forum.database.models import Comment, CommentLike, CommentReactionCounts
+from cps.forum.database.models.like import REACTION_TYPES
+
+
+class TaskRepairReactionCounts(CalibreTask):
+    """Recounts the reactions of all forum comments and corrects the counters which differ, also fills the counters
+    of comments liked before the counters existed"""
+    task_type = 'forum'
+    priority = PRIORITY_BULK
+
+    def __init__(self, batch_size=500, task_message=N_('Repairing forum reaction counts')):
+        super(TaskRepairReactionCounts, self).__init__(task_message)
+        self.log = logger.create()
+        self.batch_size = batch_size
+
+    def run(self, worker_thread):
+        comments = Comment.__table__
+        likes = CommentLike.__table__
+        table = CommentReactionCounts.__table__
+        columns = ['total'] + [reaction_type + '_count' for reaction_type in REACTION_TYPES]
+        counts = [func.count(likes.c.id)] + [func.count(likes.c.id).filter(likes.c.reaction_type == reaction_type)
+                                             for reaction_type in REACTION_TYPES]
+        try:
+            repaired = done = last_id = 0
+            # the counters live in the forum database, which is bound to the app
+            with app.app_context():
+                count = forum_db.session.query(func.count(comments.c.id)).scalar()
+                forum_db.session.close()
+                while True:
+                    with forum_db.engine.begin() as conn:
+                        # the like endpoint locks its comment before it changes the like and the counters. The lock
+                        # of the batch waits for the likes in progress, the recount sees them and no counter changes
+                        # in between are overwritten
+                        ids = conn.execute(select(comments.c.id).where(comments.c.id > last_id)
+                                           .order_by(comments.c.id).limit(self.batch_size)
+                                           .with_for_update()).scalars().all()
+                        if not ids:
+                            break
+                        recount = (select(comments.c.id, *counts)
+                                   .select_from(comments.outerjoin(likes, likes.c.comment_id == comments.c.id))
+                                   .where(comments.c.id.in_(ids))
+                                   .group_by(comments.c.id))
+                        statement = insert(table).from_select(['comment_id'] + columns, recount)
+                        statement = statement.on_conflict_do_update(
+                            index_elements=[table.c.comment_id],
+                            set_=dict((column, statement.excluded[column]) for column in columns),
+                            where=or_(*[table.c[column] != statement.excluded[column] for column in columns]))
+                        repaired += conn.execute(statement).rowcount
+                    last_id = ids[-1]
+                    done += len(ids)
+                    self.progress = min(1.0, done / count) if count else 1.0
+            if repaired:
+                self.log.info("Corrected reaction counts of {} forum comments".format(repaired))
+            else:
+                self.self_cleanup = True
+            self._handleSuccess()
+        except Exception as ex:
+            self.log.error_or_exception(ex)
+            self._handleError('Error repairing reaction counts: ' + str(ex))
+
+    def serialize(self):
+        return dict(batch_size=self.batch_size)
+
+    @property
+    def dedup_key(self):
+        return "repair_reaction_counts"
+
+    @property
+    def name(self):
+        return "Repair Reaction Counts"
+
+    def __str__(self):
+        return "Repair forum reaction counts"
+
+    @property
+    def is_cancellable(self):
+        return False
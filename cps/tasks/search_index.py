@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+#  This file is part of the Calibre-Web (https://github.com/janeczku/calibre-web)
+#    Copyright (C) 2025 GetMyEBook-Web Contributors
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from flask_babel import lazy_gettext as N_
+
+from cps import db, logger, search_index
+from cps.services.worker import CalibreTask, PRIORITY_BULK, STAT_CANCELLED, STAT_ENDED
+
+
+class TaskUpdateSearchIndex(CalibreTask):
+    task_type = 'search_index'
+    priority = PRIORITY_BULK
+
+    def __init__(self, task_message=N_('Updating search index')):
+        super(TaskUpdateSearchIndex, self).__init__(task_message)
+        self.log = logger.create()
+        self.calibre_db = db.CalibreDB(expire_on_commit=False, init=True)
+
+    def run(self, worker_thread):
+        if not self.calibre_db.session:
+            self._handleSuccess()
+            return
+        try:
+            search_index.remove_orphans(self.calibre_db)
+            count = search_index.count_stale_books(self.calibre_db)
+            done = 0
+            while done < count:
+                indexed = search_index.refresh_stale_books(self.calibre_db)
+                if not indexed:
+                    break
+                done += indexed
+                self.progress = min(1.0, done / count)
+                self.message = N_('Indexed %(count)s of %(total)s books', count=done, total=count)
+
+                # Check if job has been cancelled or ended
+                if self.stat == STAT_CANCELLED or self.stat == STAT_ENDED:
+                    self.log.info('UpdateSearchIndex task has been stopped.')
+                    self.calibre_db.session.close()
+                    return
+            search_index.mark_ready()
+            if count == 0:
+                self.self_cleanup = True
+            self._handleSuccess()
+        except Exception as ex:
+            self.log.error_or_exception(ex)
+            self._handleError('Error updating search index: ' + str(ex))
+            self.calibre_db.session.rollback()
+        self.calibre_db.session.close()
+
+    def serialize(self):
+        return dict()
+
+    @property
+    def dedup_key(self):
+        return "update_search_index"
+
+    @property
+    def name(self):
+        return "Update Search Index"
+
+    def __str__(self):
+        return "Update full text search index"
+
+    @property
+    def is_cancellable(self):
+        return True
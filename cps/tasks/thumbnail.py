@@ -16,34 +16,33 @@
 #   You should have received a copy of the GNU General Public License
 #   along with this program. If not, see <http://www.gnu.org/licenses/>.
 
+import multiprocessing
 import os
-from shutil import copyfile, copyfileobj
-from urllib.request import urlopen
-from io import BytesIO
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 from .. import constants
-from cps import config, db, fs, gdriveutils, logger, ub
-from cps.services.worker import CalibreTask, STAT_CANCELLED, STAT_ENDED
+from cps import config, db, fs, gdriveutils, logger, ub, thumbnail_index
+from cps.services.worker import CalibreTask, PRIORITY_BULK, STAT_CANCELLED, STAT_ENDED
+from cps.tasks.thumbnail_render import get_resize_height, get_resize_width, render_cover_thumbnails
 from datetime import datetime
-from sqlalchemy import func, text, or_
+from sqlalchemy import text, or_
 from flask_babel import lazy_gettext as N_
 
 try:
     from wand.image import Image
+    from wand.version import formats as supported_formats
     use_IM = True
 except (ImportError, RuntimeError) as e:
     use_IM = False
 
+# formats of the cover thumbnails besides jpeg, generated if ImageMagick has a delegate for them
+THUMBNAIL_EXTRA_FORMATS = ['avif', 'webp']
+_thumbnail_formats = list()
+_thumbnail_formats_lock = threading.Lock()
 
-def get_resize_height(resolution):
-    return int(225 * resolution)
-
-
-def get_resize_width(resolution, original_width, original_height):
-    height = get_resize_height(resolution)
-    percent = (height / float(original_height))
-    width = int((float(original_width) * float(percent)))
-    return width if width % 2 == 0 else width + 1
+# number of books whose thumbnails are generated and committed together
+THUMBNAIL_BATCH_SIZE = 100
 
 
 def get_best_fit(width, height, image_width, image_height):
@@ -64,7 +63,30 @@ def get_best_fit(width, height, image_width, image_height):
     return {'width': resize_width, 'height': resize_height}
 
 
+def get_thumbnail_workers():
+    # number of processes generating cover thumbnails, defaults to the number of cpus
+    try:
+        return max(1, int(os.getenv("THUMBNAIL_WORKERS") or os.cpu_count() or 1))
+    except ValueError:
+        return 1
+
+
+def get_thumbnail_formats():
+    """Generated cover thumbnail formats, jpeg is always part of it"""
+    with _thumbnail_formats_lock:
+        if not _thumbnail_formats:
+            formats = ['jpeg']
+            if use_IM:
+                formats.extend(image_format for image_format in THUMBNAIL_EXTRA_FORMATS
+                               if supported_formats(image_format.upper()))
+            _thumbnail_formats.extend(formats)
+        return _thumbnail_formats
+
+
 class TaskGenerateCoverThumbnails(CalibreTask):
+    task_type = 'thumbnail'
+    priority = PRIORITY_BULK
+
     def __init__(self, book_id=-1, task_message=''):
         super(TaskGenerateCoverThumbnails, self).__init__(task_message)
         self.log = logger.create()
@@ -75,6 +97,8 @@ class TaskGenerateCoverThumbnails(CalibreTask):
             constants.COVER_THUMBNAIL_SMALL,
             constants.COVER_THUMBNAIL_MEDIUM
         ]
+        self.variants = [(resolution, image_format) for resolution in self.resolutions
+                         for image_format in get_thumbnail_formats()]
 
     def run(self, worker_thread):
         if use_IM and self.stat != STAT_CANCELLED and self.stat != STAT_ENDED:
@@ -82,30 +106,40 @@ class TaskGenerateCoverThumbnails(CalibreTask):
             books_with_covers = self.get_books_with_covers(self.book_id)
             count = len(books_with_covers)
 
+            workers = get_thumbnail_workers() if count > 1 else 1
+            # spawned instead of forked, forking the multithreaded app process can copy held locks
+            executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) \
+                if workers > 1 else None
             total_generated = 0
-            for i, book in enumerate(books_with_covers):
-
-                # Generate new thumbnails for missing covers
-                generated = self.create_book_cover_thumbnails(book)
-
-                # Increment the progress
-                self.progress = (1.0 / count) * i
-
-                if generated > 0:
-                    total_generated += generated
-                    self.message = N_('Generated %(count)s cover thumbnails', count=total_generated)
-
-                # Check if job has been cancelled or ended
-                if self.stat == STAT_CANCELLED:
-                    self.log.info(f'GenerateCoverThumbnails task has been cancelled.')
-                    return
-
-                if self.stat == STAT_ENDED:
-                    self.log.info(f'GenerateCoverThumbnails task has been ended.')
-                    return
+            try:
+                for start in range(0, count, THUMBNAIL_BATCH_SIZE):
+                    books = books_with_covers[start:start + THUMBNAIL_BATCH_SIZE]
+
+                    # Generate new thumbnails for missing covers, replace outdated or missing thumbnails
+                    generated = self.create_book_cover_thumbnails(books, executor)
+
+                    # Increment the progress
+                    self.progress = min(1.0, (start + len(books)) / count)
+
+                    if generated > 0:
+                        total_generated += generated
+                        self.message = N_('Generated %(count)s cover thumbnails', count=total_generated)
+
+                    # Check if job has been cancelled or ended
+                    if self.stat == STAT_CANCELLED or self.stat == STAT_ENDED:
+                        self.log.info('GenerateCoverThumbnails task has been {}.'.format(
+                            'cancelled' if self.stat == STAT_CANCELLED else 'ended'))
+                        if total_generated:
+                            thumbnail_index.invalidate()
+                        return
+            finally:
+                if executor:
+                    executor.shutdown(wait=True, cancel_futures=True)
 
             if total_generated == 0:
                 self.self_cleanup = True
+            else:
+                thumbnail_index.invalidate()
 
         self._handleSuccess()
         self.app_db_session.remove()
@@ -118,111 +152,118 @@ class TaskGenerateCoverThumbnails(CalibreTask):
         calibre_db.session.close()
         return books_cover
 
-    def get_book_cover_thumbnails(self, book_id):
-        return self.app_db_session \
-            .query(ub.Thumbnail) \
-            .filter(ub.Thumbnail.type == constants.THUMBNAIL_TYPE_COVER) \
-            .filter(ub.Thumbnail.entity_id == book_id) \
-            .filter(or_(ub.Thumbnail.expiration.is_(None), ub.Thumbnail.expiration > datetime.utcnow())) \
-            .all()
-
-    def create_book_cover_thumbnails(self, book):
-        generated = 0
-        book_cover_thumbnails = self.get_book_cover_thumbnails(book.id)
-
-        # Generate new thumbnails for missing covers
-        resolutions = list(map(lambda t: t.resolution, book_cover_thumbnails))
-        missing_resolutions = list(set(self.resolutions).difference(resolutions))
-        for resolution in missing_resolutions:
-            generated += 1
-            self.create_book_cover_single_thumbnail(book, resolution)
-
-        # Replace outdated or missing thumbnails
-        for thumbnail in book_cover_thumbnails:
-            if book.last_modified.replace(tzinfo=None) > thumbnail.generated_at:
-                generated += 1
-                self.update_book_cover_thumbnail(book, thumbnail)
-
-            elif not self.cache.get_cache_file_exists(thumbnail.filename, constants.CACHE_TYPE_THUMBNAILS):
-                generated += 1
-                self.update_book_cover_thumbnail(book, thumbnail)
-        return generated
-
-    def create_book_cover_single_thumbnail(self, book, resolution):
-        thumbnail = ub.Thumbnail()
-        thumbnail.type = constants.THUMBNAIL_TYPE_COVER
-        thumbnail.entity_id = book.id
-        thumbnail.format = 'jpeg'
-        thumbnail.resolution = resolution
-
-        self.app_db_session.add(thumbnail)
+    def get_book_cover_thumbnails(self, book_ids):
+        thumbnails = dict()
+        for thumbnail in self.app_db_session \
+                .query(ub.Thumbnail) \
+                .filter(ub.Thumbnail.type == constants.THUMBNAIL_TYPE_COVER) \
+                .filter(ub.Thumbnail.entity_id.in_(book_ids)) \
+                .filter(or_(ub.Thumbnail.expiration.is_(None), ub.Thumbnail.expiration > datetime.utcnow())):
+            thumbnails.setdefault(thumbnail.entity_id, []).append(thumbnail)
+        return thumbnails
+
+    def create_book_cover_thumbnails(self, books, executor=None):
+        """Generates the missing and outdated thumbnails of the books, the thumbnail rows are written in one
+        transaction after all covers of the batch are processed"""
+        book_cover_thumbnails = self.get_book_cover_thumbnails([book.id for book in books])
+        jobs = list()
+        for book in books:
+            thumbnails = book_cover_thumbnails.get(book.id, [])
+            pending = list()
+
+            # Generate new thumbnails for missing covers
+            variants = set((t.resolution, t.format) for t in thumbnails)
+            for resolution, image_format in sorted(set(self.variants).difference(variants)):
+                thumbnail = ub.Thumbnail()
+                thumbnail.type = constants.THUMBNAIL_TYPE_COVER
+                thumbnail.entity_id = book.id
+                thumbnail.format = image_format
+                thumbnail.resolution = resolution
+                self.app_db_session.add(thumbnail)
+                pending.append(thumbnail)
+
+            # Replace outdated or missing thumbnails
+            for thumbnail in thumbnails:
+                if (book.last_modified.replace(tzinfo=None) > thumbnail.generated_at
+                        or not self.cache.get_cache_file_exists(thumbnail.filename, constants.CACHE_TYPE_THUMBNAILS)):
+                    thumbnail.generated_at = datetime.utcnow()
+                    pending.append(thumbnail)
+            if pending:
+                jobs.append((book, pending))
+        if not jobs:
+            return 0
+
+        generated = list()
         try:
+            # assigns the file names of the new thumbnails
+            self.app_db_session.flush()
+            futures = dict()
+            for book, thumbnails in jobs:
+                try:
+                    source = self.get_cover_source(book)
+                    targets = [(thumbnail.resolution,
+                                self.cache.get_cache_file_path(thumbnail.filename, constants.CACHE_TYPE_THUMBNAILS),
+                                thumbnail.format) for thumbnail in thumbnails]
+                    if executor:
+                        futures[executor.submit(render_cover_thumbnails, source, targets)] = (book, thumbnails)
+                        continue
+                    errors = render_cover_thumbnails(source, targets)
+                except Exception as ex:
+                    errors = [((thumbnail.resolution, thumbnail.format), str(ex)) for thumbnail in thumbnails]
+                generated.extend(self.finish_book_cover_thumbnails(book, thumbnails, errors))
+            for future in as_completed(futures):
+                book, thumbnails = futures[future]
+                try:
+                    errors = future.result()
+                except Exception as ex:
+                    errors = [((thumbnail.resolution, thumbnail.format), str(ex)) for thumbnail in thumbnails]
+                generated.extend(self.finish_book_cover_thumbnails(book, thumbnails, errors))
+            # indexed before the commit expires the rows, a failed commit reloads the index
+            for thumbnail in generated:
+                thumbnail_index.add(thumbnail)
             self.app_db_session.commit()
-            self.generate_book_thumbnail(book, thumbnail)
         except Exception as ex:
-            self.log.debug('Error creating book thumbnail: ' + str(ex))
-            self._handleError('Error creating book thumbnail: ' + str(ex))
+            self.log.debug('Error creating book thumbnails: ' + str(ex))
+            self._handleError('Error creating book thumbnails: ' + str(ex))
             self.app_db_session.rollback()
+            thumbnail_index.invalidate()
+            return 0
+        return len(generated)
+
+    def finish_book_cover_thumbnails(self, book, thumbnails, errors):
+        # failed thumbnails are removed, they are generated again on the next run
+        failed = dict(errors)
+        generated = list()
+        for thumbnail in thumbnails:
+            variant = (thumbnail.resolution, thumbnail.format)
+            if variant in failed:
+                self.log.debug('Error generating thumbnail of book {}: {}'.format(book.id, failed[variant]))
+                self.app_db_session.delete(thumbnail)
+            else:
+                generated.append(thumbnail)
+        return generated
 
-    def update_book_cover_thumbnail(self, book, thumbnail):
-        thumbnail.generated_at = datetime.utcnow()
-
-        try:
-            self.app_db_session.commit()
-            self.cache.delete_cache_file(thumbnail.filename, constants.CACHE_TYPE_THUMBNAILS)
-            self.generate_book_thumbnail(book, thumbnail)
-        except Exception as ex:
-            self.log.debug('Error updating book thumbnail: ' + str(ex))
-            self._handleError('Error updating book thumbnail: ' + str(ex))
-            self.app_db_session.rollback()
+    def get_cover_source(self, book):
+        if config.config_use_google_drive:
+            if not gdriveutils.is_gdrive_ready():
+                raise Exception('Google Drive is configured but not ready')
 
-    def generate_book_thumbnail(self, book, thumbnail):
-        if book and thumbnail:
-            if config.config_use_google_drive:
-                if not gdriveutils.is_gdrive_ready():
-                    raise Exception('Google Drive is configured but not ready')
+            content = gdriveutils.get_cover_via_gdrive(book.path)
+            if not content:
+                raise Exception('Google Drive cover url not found')
+            return content
 
-                content = gdriveutils.get_cover_via_gdrive(book.path)
-                if not content:
-                    raise Exception('Google Drive cover url not found')
-                try:
-                    stream = BytesIO(content)
-                    with Image(file=stream) as img:
-                        filename = self.cache.get_cache_file_path(thumbnail.filename,
-                                                                  constants.CACHE_TYPE_THUMBNAILS)
-                        height = get_resize_height(thumbnail.resolution)
-                        if img.height > height:
-                            width = get_resize_width(thumbnail.resolution, img.width, img.height)
-                            img.resize(width=width, height=height, filter='lanczos')
-                            img.format = thumbnail.format
-                            img.save(filename=filename)
-                        else:
-                            with open(filename, 'rb') as fd:
-                                copyfileobj(stream, fd)
+        book_cover_filepath = os.path.join(config.get_book_path(), book.path, 'cover.jpg')
+        if not os.path.isfile(book_cover_filepath):
+            raise Exception('Book cover file not found')
+        return book_cover_filepath
 
-                except Exception as ex:
-                    # Bubble exception to calling function
-                    self.log.debug('Error generating thumbnail file: ' + str(ex))
-                    raise ex
-                finally:
-                    if stream is not None:
-                        stream.close()
-            else:
-                book_cover_filepath = os.path.join(config.get_book_path(), book.path, 'cover.jpg')
-                if not os.path.isfile(book_cover_filepath):
-                    raise Exception('Book cover file not found')
+    def serialize(self):
+        return dict(book_id=self.book_id)
 
-                with Image(filename=book_cover_filepath) as img:
-                    height = get_resize_height(thumbnail.resolution)
-                    filename = self.cache.get_cache_file_path(thumbnail.filename, constants.CACHE_TYPE_THUMBNAILS)
-                    if img.height > height:
-                        width = get_resize_width(thumbnail.resolution, img.width, img.height)
-                        img.resize(width=width, height=height, filter='lanczos')
-                        img.format = thumbnail.format
-                        img.save(filename=filename)
-                    else:
-                        # take cover as is
-                        copyfile(book_cover_filepath, filename)
+    @property
+    def dedup_key(self):
+        return "generate_cover_thumbnails:{}".format(self.book_id)
 
     @property
     def name(self):
@@ -239,10 +280,21 @@ class TaskGenerateCoverThumbnails(CalibreTask):
         return True
 
 
+def get_series_source_signature(books):
+    # identifies the covers a series thumbnail is made of, covers change together with last_modified of the book
+    return ",".join("{}:{}".format(book.id, int(book.last_modified.timestamp())) for book in books)
+
+
 class TaskGenerateSeriesThumbnails(CalibreTask):
-    def __init__(self, task_message=''):
+    """Generates the mosaic thumbnails of series with at least four books with cover. A mosaic is built from the
+    already generated book thumbnails and only regenerated if one of its four source covers changed"""
+    task_type = 'thumbnail'
+    priority = PRIORITY_BULK
+
+    def __init__(self, series_ids=None, task_message=''):
         super(TaskGenerateSeriesThumbnails, self).__init__(task_message)
         self.log = logger.create()
+        self.series_ids = series_ids
         self.app_db_session = ub.get_new_session_instance()
         self.calibre_db = db.CalibreDB(expire_on_commit=False, init=True)
         self.cache = fs.FileSystem()
@@ -254,31 +306,32 @@ class TaskGenerateSeriesThumbnails(CalibreTask):
     def run(self, worker_thread):
         if self.calibre_db.session and use_IM and self.stat != STAT_CANCELLED and self.stat != STAT_ENDED:
             self.message = 'Scanning Series'
-            all_series = self.get_series_with_four_plus_books()
-            count = len(all_series)
+            series_sources = self.get_series_source_books()
+            count = len(series_sources)
+            signatures = self.get_source_signatures(list(series_sources))
+            series_thumbnails = self.get_series_thumbnails(list(series_sources))
 
             total_generated = 0
-            for i, series in enumerate(all_series):
+            for i, (series_id, series_books) in enumerate(series_sources.items()):
                 generated = 0
-                series_thumbnails = self.get_series_thumbnails(series.id)
-                series_books = self.get_series_books(series.id)
+                thumbnails = series_thumbnails.get(series_id, [])
+                signature = get_series_source_signature(series_books)
+                changed = signatures.get(series_id) != signature
 
                 # Generate new thumbnails for missing covers
-                resolutions = list(map(lambda t: t.resolution, series_thumbnails))
+                resolutions = list(map(lambda t: t.resolution, thumbnails))
                 missing_resolutions = list(set(self.resolutions).difference(resolutions))
                 for resolution in missing_resolutions:
-                    generated += 1
-                    self.create_series_thumbnail(series, series_books, resolution)
+                    generated += self.create_series_thumbnail(series_id, series_books, resolution)
 
-                # Replace outdated or missing thumbnails
-                for thumbnail in series_thumbnails:
-                    if any(book.last_modified > thumbnail.generated_at for book in series_books):
-                        generated += 1
-                        self.update_series_thumbnail(series_books, thumbnail)
+                # Replace thumbnails whose source covers changed, or which are missing
+                for thumbnail in thumbnails:
+                    if changed or not self.cache.get_cache_file_exists(thumbnail.filename,
+                                                                       constants.CACHE_TYPE_THUMBNAILS):
+                        generated += self.update_series_thumbnail(series_books, thumbnail)
 
-                    elif not self.cache.get_cache_file_exists(thumbnail.filename, constants.CACHE_TYPE_THUMBNAILS):
-                        generated += 1
-                        self.update_series_thumbnail(series_books, thumbnail)
+                if generated > 0 or changed:
+                    self.store_source_signature(series_id, signature)
 
                 # Increment the progress
                 self.progress = (1.0 / count) * i
@@ -288,51 +341,69 @@ class TaskGenerateSeriesThumbnails(CalibreTask):
                     self.message = N_('Generated {0} series thumbnails').format(total_generated)
 
                 # Check if job has been cancelled or ended
-                if self.stat == STAT_CANCELLED:
-                    self.log.info(f'GenerateSeriesThumbnails task has been cancelled.')
-                    return
-
-                if self.stat == STAT_ENDED:
-                    self.log.info(f'GenerateSeriesThumbnails task has been ended.')
+                if self.stat == STAT_CANCELLED or self.stat == STAT_ENDED:
+                    self.log.info('GenerateSeriesThumbnails task has been {}.'.format(
+                        'cancelled' if self.stat == STAT_CANCELLED else 'ended'))
+                    if total_generated:
+                        thumbnail_index.invalidate()
                     return
 
             if total_generated == 0:
                 self.self_cleanup = True
+            else:
+                thumbnail_index.invalidate()
 
         self._handleSuccess()
         self.app_db_session.remove()
 
-    def get_series_with_four_plus_books(self):
-        return self.calibre_db.session \
-            .query(db.Series) \
-            .join(db.books_series_link) \
-            .join(db.Books) \
-            .filter(db.Books.has_cover == 1) \
-            .group_by(db.Series.id) \
-            .having(func.count('book_series_link') > 3) \
-            .all()
-
-    def get_series_books(self, series_id):
-        return self.calibre_db.session \
-            .query(db.Books) \
-            .join(db.books_series_link) \
-            .join(db.Series) \
-            .filter(db.Books.has_cover == 1) \
-            .filter(db.Series.id == series_id) \
-            .all()
+    def get_series_source_books(self):
+        """Returns the four books of each series with at least four books with cover, whose covers form the
+        thumbnail, highest series index first. All series are read with one query"""
+        query = self.calibre_db.session \
+            .query(db.books_series_link.c.series, db.Books.id, db.Books.path, db.Books.series_index,
+                   db.Books.last_modified) \
+            .join(db.Books, db.books_series_link.c.book == db.Books.id) \
+            .filter(db.Books.has_cover == 1)
+        if self.series_ids is not None:
+            query = query.filter(db.books_series_link.c.series.in_(self.series_ids))
+        series_books = dict()
+        for book in query:
+            series_books.setdefault(book.series, []).append(book)
+        return dict((series_id, sorted(books, key=lambda b: float(b.series_index), reverse=True)[:4])
+                    for series_id, books in series_books.items() if len(books) > 3)
+
+    def get_source_signatures(self, series_ids):
+        return dict(self.app_db_session
+                    .query(ub.SeriesThumbnailSources.series_id, ub.SeriesThumbnailSources.signature)
+                    .filter(ub.SeriesThumbnailSources.series_id.in_(series_ids)))
+
+    def store_source_signature(self, series_id, signature):
+        sources = self.app_db_session.get(ub.SeriesThumbnailSources, series_id)
+        if not sources:
+            sources = ub.SeriesThumbnailSources(series_id=series_id)
+            self.app_db_session.add(sources)
+        sources.signature = signature
+        sources.generated_at = datetime.utcnow()
+        try:
+            self.app_db_session.commit()
+        except Exception as ex:
+            self.log.debug('Error storing series thumbnail sources: ' + str(ex))
+            self.app_db_session.rollback()
 
-    def get_series_thumbnails(self, series_id):
-        return self.app_db_session \
-            .query(ub.Thumbnail) \
-            .filter(ub.Thumbnail.type == constants.THUMBNAIL_TYPE_SERIES) \
-            .filter(ub.Thumbnail.entity_id == series_id) \
-            .filter(or_(ub.Thumbnail.expiration.is_(None), ub.Thumbnail.expiration > datetime.utcnow())) \
-            .all()
+    def get_series_thumbnails(self, series_ids):
+        thumbnails = dict()
+        for thumbnail in self.app_db_session \
+                .query(ub.Thumbnail) \
+                .filter(ub.Thumbnail.type == constants.THUMBNAIL_TYPE_SERIES) \
+                .filter(ub.Thumbnail.entity_id.in_(series_ids)) \
+                .filter(or_(ub.Thumbnail.expiration.is_(None), ub.Thumbnail.expiration > datetime.utcnow())):
+            thumbnails.setdefault(thumbnail.entity_id, []).append(thumbnail)
+        return thumbnails
 
-    def create_series_thumbnail(self, series, series_books, resolution):
+    def create_series_thumbnail(self, series_id, series_books, resolution):
         thumbnail = ub.Thumbnail()
         thumbnail.type = constants.THUMBNAIL_TYPE_SERIES
-        thumbnail.entity_id = series.id
+        thumbnail.entity_id = series_id
         thumbnail.format = 'jpeg'
         thumbnail.resolution = resolution
 
@@ -340,10 +411,13 @@ class TaskGenerateSeriesThumbnails(CalibreTask):
         try:
             self.app_db_session.commit()
             self.generate_series_thumbnail(series_books, thumbnail)
+            thumbnail_index.add(thumbnail)
+            return 1
         except Exception as ex:
-            self.log.debug('Error creating book thumbnail: ' + str(ex))
-            self._handleError('Error creating book thumbnail: ' + str(ex))
+            self.log.debug('Error creating series thumbnail: ' + str(ex))
+            self._handleError('Error creating series thumbnail: ' + str(ex))
             self.app_db_session.rollback()
+        return 0
 
     def update_series_thumbnail(self, series_books, thumbnail):
         thumbnail.generated_at = datetime.utcnow()
@@ -352,62 +426,53 @@ class TaskGenerateSeriesThumbnails(CalibreTask):
             self.app_db_session.commit()
             self.cache.delete_cache_file(thumbnail.filename, constants.CACHE_TYPE_THUMBNAILS)
             self.generate_series_thumbnail(series_books, thumbnail)
+            thumbnail_index.add(thumbnail)
+            return 1
         except Exception as ex:
-            self.log.debug('Error updating book thumbnail: ' + str(ex))
-            self._handleError('Error updating book thumbnail: ' + str(ex))
+            self.log.debug('Error updating series thumbnail: ' + str(ex))
+            self._handleError('Error updating series thumbnail: ' + str(ex))
             self.app_db_session.rollback()
+        return 0
+
+    def get_source_images(self, books, resolution):
+        """Image sources of the books for a mosaic of the resolution, the book thumbnail of the same resolution is
+        large enough for one quarter of the mosaic, the full size cover is only used if it doesn't exist"""
+        thumbnails = dict((row.entity_id, row) for row in self.app_db_session
+                          .query(ub.Thumbnail.entity_id, ub.Thumbnail.filename, ub.Thumbnail.generated_at)
+                          .filter(ub.Thumbnail.type == constants.THUMBNAIL_TYPE_COVER)
+                          .filter(ub.Thumbnail.entity_id.in_([book.id for book in books]))
+                          .filter(ub.Thumbnail.resolution == resolution)
+                          .filter(ub.Thumbnail.format == 'jpeg'))
+        sources = list()
+        for book in books:
+            book_thumbnail = thumbnails.get(book.id)
+            if (book_thumbnail and book_thumbnail.generated_at >= book.last_modified.replace(tzinfo=None)
+                    and self.cache.get_cache_file_exists(book_thumbnail.filename, constants.CACHE_TYPE_THUMBNAILS)):
+                sources.append({'filename': self.cache.get_cache_file_path(book_thumbnail.filename,
+                                                                           constants.CACHE_TYPE_THUMBNAILS)})
+            elif config.config_use_google_drive:
+                if not gdriveutils.is_gdrive_ready():
+                    raise Exception('Google Drive is configured but not ready')
 
-    def generate_series_thumbnail(self, series_books, thumbnail):
-        # Get the last four books in the series based on series_index
-        books = sorted(series_books, key=lambda b: float(b.series_index), reverse=True)[:4]
+                content = gdriveutils.get_cover_via_gdrive(book.path)
+                if not content:
+                    raise Exception('Google Drive cover not found')
+                sources.append({'blob': content})
+            else:
+                book_cover_filepath = os.path.join(config.get_book_path(), book.path, 'cover.jpg')
+                if not os.path.isfile(book_cover_filepath):
+                    raise Exception('Book cover file not found')
+                sources.append({'filename': book_cover_filepath})
+        return sources
 
+    def generate_series_thumbnail(self, series_books, thumbnail):
         top = 0
         left = 0
         width = 0
         height = 0
         with Image() as canvas:
-            for book in books:
-                if config.config_use_google_drive:
-                    if not gdriveutils.is_gdrive_ready():
-                        raise Exception('Google Drive is configured but not ready')
-
-                    web_content_link = gdriveutils.get_cover_via_gdrive(book.path)
-                    if not web_content_link:
-                        raise Exception('Google Drive cover url not found')
-
-                    stream = None
-                    try:
-                        stream = urlopen(web_content_link)
-                        with Image(file=stream) as img:
-                            # Use the first image in this set to determine the width and height to scale the
-                            # other images in this set
-                            if width == 0 or height == 0:
-                                width = get_resize_width(thumbnail.resolution, img.width, img.height)
-                                height = get_resize_height(thumbnail.resolution)
-                                canvas.blank(width, height)
-
-                            dimensions = get_best_fit(width, height, img.width, img.height)
-
-                            # resize and crop the image
-                            img.resize(width=int(dimensions['width']), height=int(dimensions['height']),
-                                       filter='lanczos')
-                            img.crop(width=int(width / 2.0), height=int(height / 2.0), gravity='center')
-
-                            # add the image to the canvas
-                            canvas.composite(img, left, top)
-
-                    except Exception as ex:
-                        self.log.debug('Error generating thumbnail file: ' + str(ex))
-                        raise ex
-                    finally:
-                        if stream is not None:
-                            stream.close()
-
-                book_cover_filepath = os.path.join(config.get_book_path(), book.path, 'cover.jpg')
-                if not os.path.isfile(book_cover_filepath):
-                    raise Exception('Book cover file not found')
-
-                with Image(filename=book_cover_filepath) as img:
+            for source in self.get_source_images(series_books, thumbnail.resolution):
+                with Image(**source) as img:
                     # Use the first image in this set to determine the width and height to scale the
                     # other images in this set
                     if width == 0 or height == 0:
@@ -437,6 +502,15 @@ class TaskGenerateSeriesThumbnails(CalibreTask):
             filename = self.cache.get_cache_file_path(thumbnail.filename, constants.CACHE_TYPE_THUMBNAILS)
             canvas.save(filename=filename)
 
+    def serialize(self):
+        return dict(series_ids=self.series_ids)
+
+    @property
+    def dedup_key(self):
+        if self.series_ids is None:
+            return "generate_series_thumbnails"
+        return "generate_series_thumbnails:" + ",".join(str(series_id) for series_id in sorted(self.series_ids))
+
     @property
     def name(self):
         return N_('Cover Thumbnails')
@@ -450,6 +524,9 @@ class TaskGenerateSeriesThumbnails(CalibreTask):
 
 
 class TaskClearCoverThumbnailCache(CalibreTask):
+    task_type = 'thumbnail'
+    priority = PRIORITY_BULK
+
     def __init__(self, book_id, task_message=N_('Clearing cover thumbnail cache')):
         super(TaskClearCoverThumbnailCache, self).__init__(task_message)
         self.log = logger.create()
@@ -473,6 +550,7 @@ class TaskClearCoverThumbnailCache(CalibreTask):
             else:
                 for thumbnail in thumbnails:
                     self.delete_thumbnail(thumbnail)
+            thumbnail_index.invalidate()
         self._handleSuccess()
         self.app_db_session.remove()
 
@@ -492,6 +570,7 @@ class TaskClearCoverThumbnailCache(CalibreTask):
                 .filter(ub.Thumbnail.entity_id == thumbnail.entity_id) \
                 .delete()
             self.app_db_session.commit()
+            thumbnail_index.remove(constants.THUMBNAIL_TYPE_COVER, thumbnail.entity_id)
         except Exception as ex:
             self.log.debug('Error deleting book thumbnail: ' + str(ex))
             self._handleError('Error deleting book thumbnail: ' + str(ex))
@@ -500,11 +579,19 @@ class TaskClearCoverThumbnailCache(CalibreTask):
         try:
             self.app_db_session.query(ub.Thumbnail).filter(ub.Thumbnail.type == constants.THUMBNAIL_TYPE_COVER).delete()
             self.app_db_session.commit()
+            thumbnail_index.remove(constants.THUMBNAIL_TYPE_COVER)
             self.cache.delete_cache_dir(constants.CACHE_TYPE_THUMBNAILS)
         except Exception as ex:
             self.log.debug('Error deleting thumbnail directory: ' + str(ex))
             self._handleError('Error deleting thumbnail directory: ' + str(ex))
 
+    def serialize(self):
+        return dict(book_id=self.book_id)
+
+    @property
+    def dedup_key(self):
+        return "clear_cover_thumbnails:{}".format(self.book_id)
+
     @property
     def name(self):
         return N_('Cover Thumbnails')
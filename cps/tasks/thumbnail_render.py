@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+#  This file is part of the Calibre-Web (https://github.com/janeczku/calibre-web)
+#    Copyright (C) 2025 GetMyEBook-Web Contributors
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Image work of the cover thumbnail task. The task runs it in spawned worker processes, which import this module
+# only, so it must not depend on modules which need the configuration of the app process.
+
+from shutil import copyfile
+
+try:
+    from wand.image import Image
+    use_IM = True
+except (ImportError, RuntimeError) as e:
+    use_IM = False
+
+
+def get_resize_height(resolution):
+    return int(225 * resolution)
+
+
+def get_resize_width(resolution, original_width, original_height):
+    height = get_resize_height(resolution)
+    percent = (height / float(original_height))
+    width = int((float(original_width) * float(percent)))
+    return width if width % 2 == 0 else width + 1
+
+
+def render_cover_thumbnails(source, targets):
+    """Decodes the cover once and writes one thumbnail per target (resolution, file path, format), source is the
+    path of the cover file or the cover image itself. Runs in a worker process, returns the failed targets as
+    ((resolution, format), error) pairs"""
+    errors = list()
+    image_source = {'blob': source} if isinstance(source, bytes) else {'filename': source}
+    with Image(**image_source) as cover_image:
+        for resolution, filename, image_format in targets:
+            try:
+                height = get_resize_height(resolution)
+                if cover_image.height > height:
+                    with cover_image.clone() as img:
+                        width = get_resize_width(resolution, cover_image.width, cover_image.height)
+                        img.resize(width=width, height=height, filter='lanczos')
+                        img.format = image_format
+                        img.save(filename=filename)
+                elif image_format != 'jpeg':
+                    with cover_image.clone() as img:
+                        img.format = image_format
+                        img.save(filename=filename)
+                elif isinstance(source, bytes):
+                    # take cover as is
+                    with open(filename, 'wb') as fd:
+                        fd.write(source)
+                else:
+                    copyfile(source, filename)
+            except Exception as ex:
+                errors.append(((resolution, image_format), str(ex)))
+    return errors
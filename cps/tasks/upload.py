@@ -20,10 +20,13 @@ from datetime import datetime
 
 from flask_babel import lazy_gettext as N_
 
-from cps.services.worker import CalibreTask, STAT_FINISH_SUCCESS
+from cps.services.worker import CalibreTask, PRIORITY_INTERACTIVE, STAT_FINISH_SUCCESS
 
 
 class TaskUpload(CalibreTask):
+    task_type = 'upload'
+    priority = PRIORITY_INTERACTIVE
+
     def __init__(self, task_message, book_title):
         super(TaskUpload, self).__init__(task_message)
         self.start_time = self.end_time = datetime.now()
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+#  This file is part of the Calibre-Web (https://github.com/janeczku/calibre-web)
+#    Copyright (C) 2025 GetMyEBook-Web Contributors
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# In-process index of the generated thumbnails, maps (type, entity id, resolution, format) to the thumbnail file, so
+# cover requests need no query on the thumbnail table. The thumbnail tasks update the index of their own process and
+# touch a marker file in the thumbnail cache directory afterwards. Every process compares the modification time of
+# the marker at most every SIGNAL_CHECK_INTERVAL seconds and reloads the index from the database if it changed.
+
+import os
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
+
+from sqlalchemy import or_
+from sqlalchemy.exc import SQLAlchemyError
+
+from . import constants, fs, logger, ub
+
+log = logger.create()
+
+SIGNAL_CHECK_INTERVAL = 2
+SIGNAL_FILE = '.index_version'
+
+ThumbnailEntry = namedtuple('ThumbnailEntry', 'filename resolution format generated_at expiration')
+
+_lock = threading.Lock()
+_state = {'entries': None, 'signal': None, 'checked': 0.0, 'signal_path': None}
+
+
+def _signal_path():
+    if _state['signal_path'] is None:
+        _state['signal_path'] = os.path.join(fs.FileSystem().get_cache_dir(constants.CACHE_TYPE_THUMBNAILS),
+                                             SIGNAL_FILE)
+    return _state['signal_path']
+
+
+def _read_signal():
+    try:
+        return os.stat(_signal_path()).st_mtime_ns
+    except OSError:
+        return None
+
+
+def _entry(thumbnail):
+    return ThumbnailEntry(thumbnail.filename, thumbnail.resolution, thumbnail.format, thumbnail.generated_at,
+                          thumbnail.expiration)
+
+
+def load(session):
+    """Reads all valid thumbnails of the database into the index"""
+    # read before querying, changes during the query lead to another reload
+    signal = _read_signal()
+    try:
+        rows = (session.query(ub.Thumbnail.type, ub.Thumbnail.entity_id, ub.Thumbnail.resolution,
+                              ub.Thumbnail.format, ub.Thumbnail.filename, ub.Thumbnail.generated_at,
+                              ub.Thumbnail.expiration)
+                .filter(or_(ub.Thumbnail.expiration.is_(None), ub.Thumbnail.expiration > datetime.utcnow()))
+                .all())
+    except SQLAlchemyError as ex:
+        session.rollback()
+        log.error("Loading thumbnail index failed: {}".format(ex))
+        return False
+    entries = dict(((row.type, row.entity_id, row.resolution, row.format), _entry(row)) for row in rows)
+    with _lock:
+        _state['entries'] = entries
+        _state['signal'] = signal
+        _state['checked'] = time.monotonic()
+    return True
+
+
+def get(thumbnail_type, entity_id, resolution, formats=('jpeg',)):
+    """First valid thumbnail of the entity in one of the formats, formats are in order of preference"""
+    now = time.monotonic()
+    if _state['entries'] is None or now - _state['checked'] > SIGNAL_CHECK_INTERVAL:
+        _state['checked'] = now
+        if _state['entries'] is None or _read_signal() != _state['signal']:
+            load(ub.session)
+    entries = _state['entries'] or {}
+    for image_format in formats:
+        entry = entries.get((thumbnail_type, entity_id, resolution, image_format))
+        if entry and not (entry.expiration and entry.expiration <= datetime.utcnow()):
+            return entry
+    return None
+
+
+def add(thumbnail):
+    """Adds a generated thumbnail (row of the thumbnail table) to the index of this process"""
+    with _lock:
+        if _state['entries'] is not None:
+            key = (thumbnail.type, thumbnail.entity_id, thumbnail.resolution, thumbnail.format)
+            _state['entries'][key] = _entry(thumbnail)
+
+
+def remove(thumbnail_type, entity_id=None):
+    """Removes all thumbnails of the entity, or of all entities of the type, from the index of this process"""
+    with _lock:
+        if _state['entries'] is not None:
+            _state['entries'] = dict((key, entry) for key, entry in _state['entries'].items()
+                                     if key[0] != thumbnail_type or (entity_id is not None and key[1] != entity_id))
+
+
+def invalidate():
+    """Tells all processes to reload the index, called after the thumbnail table was changed"""
+    path = _signal_path()
+    try:
+        with open(path, 'a'):
+            pass
+        now = time.time_ns()
+        os.utime(path, ns=(now, now))
+    except OSError as ex:
+        log.error("Could not signal thumbnail index change: {}".format(ex))
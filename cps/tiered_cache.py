@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+
+#  This file is part of the Calibre-Web (https://github.com/janeczku/calibre-web)
+#    Copyright (C) 2025 GetMyEBook-Web Contributors
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Two tier cache shared by the app and the forum. A bounded LRU in the memory of the process sits in front of an
+# optional shared backend, an unlogged table of the app database or a directory on the local disk. Values are
+# stored as JSON in the backend, so only JSON compatible values can be cached and tuples come back as lists.
+# Entries are grouped in namespaces which can be invalidated as a whole, entries of local namespaces are never
+# written to the backend. With a shared backend, entries stay at most memory_timeout seconds in memory, so changes
+# of other processes are seen soon. Values returned from the memory tier are shared between callers and must not be
+# changed.
+
+import json
+import os
+import threading
+import time
+from collections import Counter, OrderedDict
+from datetime import datetime, timedelta, timezone
+
+from cachelib import FileSystemCache
+from sqlalchemy import delete, event, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session, object_session
+
+from . import logger
+
+log = logger.create()
+
+DEFAULT_TIMEOUT = 5 * 60
+DEFAULT_MAX_ENTRIES = 10000
+DEFAULT_MEMORY_TIMEOUT = 10
+# expired rows of the database backend are deleted every this many writes
+PURGE_INTERVAL = 500
+
+_MISSING = object()
+
+
+def _now():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class DatabaseBackend:
+    """Entries in a table with the columns namespace, key, value and expires"""
+    def __init__(self, engine, table):
+        self.engine = engine
+        self.table = table
+        self._writes = 0
+
+    def get(self, namespace, key):
+        table = self.table
+        with self.engine.begin() as conn:
+            data = conn.execute(select(table.c.value).where(table.c.namespace == namespace,
+                                                            table.c.key == key,
+                                                            table.c.expires > _now())).scalar()
+        return json.loads(data) if data is not None else None
+
+    def set(self, namespace, key, value, timeout):
+        table = self.table
+        data = json.dumps(value).encode('utf-8')
+        expires = _now() + timedelta(seconds=timeout)
+        statement = insert(table).values(namespace=namespace, key=key, value=data, expires=expires)
+        statement = statement.on_conflict_do_update(index_elements=[table.c.namespace, table.c.key],
+                                                    set_={'value': data, 'expires': expires})
+        self._writes += 1
+        with self.engine.begin() as conn:
+            conn.execute(statement)
+            if self._writes % PURGE_INTERVAL == 0:
+                conn.execute(delete(table).where(table.c.expires <= _now()))
+
+    def delete(self, namespace, key):
+        with self.engine.begin() as conn:
+            conn.execute(delete(self.table).where(self.table.c.namespace == namespace, self.table.c.key == key))
+
+    def clear(self, namespace):
+        with self.engine.begin() as conn:
+            conn.execute(delete(self.table).where(self.table.c.namespace == namespace))
+
+
+class _JsonSerializer:
+    """File format of the disk backend, JSON instead of the pickle of cachelib"""
+    def dump(self, value, f, protocol=None):
+        f.write(json.dumps(value).encode('utf-8'))
+
+    def load(self, f):
+        return json.loads(f.read())
+
+
+class _JsonFileSystemCache(FileSystemCache):
+    serializer = _JsonSerializer()
+
+
+class DiskBackend:
+    """Entries in one directory per namespace, only shared by the processes of one host"""
+    def __init__(self, directory):
+        self.directory = directory
+        self._caches = dict()
+
+    def _cache(self, namespace):
+        cache = self._caches.get(namespace)
+        if cache is None:
+            cache = self._caches[namespace] = _JsonFileSystemCache(os.path.join(self.directory, namespace))
+        return cache
+
+    def get(self, namespace, key):
+        return self._cache(namespace).get(key)
+
+    def set(self, namespace, key, value, timeout):
+        self._cache(namespace).set(key, value, timeout=timeout)
+
+    def delete(self, namespace, key):
+        self._cache(namespace).delete(key)
+
+    def clear(self, namespace):
+        self._cache(namespace).clear()
+
+
+class TieredCache:
+    def __init__(self, backend=None, max_entries=DEFAULT_MAX_ENTRIES, default_timeout=DEFAULT_TIMEOUT,
+                 memory_timeout=DEFAULT_MEMORY_TIMEOUT):
+        self.backend = backend
+        self.max_entries = max_entries
+        self.default_timeout = default_timeout
+        self.memory_timeout = memory_timeout
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = Counter()
+        self._local = set()
+
+    def set_backend(self, backend):
+        with self._lock:
+            self.backend = backend
+            self._memory.clear()
+
+    def set_local(self, namespace):
+        """Entries of the namespace are only kept in the memory of the process"""
+        self._local.add(namespace)
+
+    def _shared(self, namespace):
+        return self.backend is not None and namespace not in self._local
+
+    def _remember(self, namespace, key, value, timeout):
+        if self.backend is not None:
+            timeout = min(timeout, self.memory_timeout)
+        with self._lock:
+            self._memory[(namespace, key)] = (time.monotonic() + timeout, value)
+            self._memory.move_to_end((namespace, key))
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def _backend_call(self, action, method, *args):
+        try:
+            return getattr(self.backend, method)(*args)
+        except Exception as ex:
+            self._stats['errors'] += 1
+            log.error("Cache {} failed: {}".format(action, ex))
+            return None
+
+    def get(self, namespace, key, default=None):
+        with self._lock:
+            entry = self._memory.get((namespace, key))
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self._memory.move_to_end((namespace, key))
+                    self._stats['memory_hits'] += 1
+                    return entry[1]
+                del self._memory[(namespace, key)]
+        if self._shared(namespace):
+            value = self._backend_call("read", "get", namespace, key)
+            if value is not None:
+                self._stats['backend_hits'] += 1
+                self._remember(namespace, key, value, self.memory_timeout)
+                return value
+        self._stats['misses'] += 1
+        return default
+
+    def set(self, namespace, key, value, timeout=None):
+        timeout = timeout or self.default_timeout
+        self._remember(namespace, key, value, timeout)
+        self._stats['sets'] += 1
+        if self._shared(namespace):
+            self._backend_call("write", "set", namespace, key, value, timeout)
+
+    def delete(self, namespace, key):
+        with self._lock:
+            self._memory.pop((namespace, key), None)
+        if self._shared(namespace):
+            self._backend_call("delete", "delete", namespace, key)
+
+    def invalidate(self, namespace):
+        """Removes all entries of the namespace"""
+        with self._lock:
+            for cache_key in [cache_key for cache_key in self._memory if cache_key[0] == namespace]:
+                del self._memory[cache_key]
+        self._stats['invalidations'] += 1
+        if self._shared(namespace):
+            self._backend_call("invalidation", "clear", namespace)
+
+    def remember(self, namespace, key, producer, timeout=None):
+        """Cached value of the key, calls producer and caches its result if there is none"""
+        value = self.get(namespace, key, _MISSING)
+        if value is _MISSING:
+            value = producer()
+            self.set(namespace, key, value, timeout)
+        return value
+
+    def stats(self):
+        """Hit, miss and error counters of this process"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._memory)
+        return stats
+
+
+def create_backend(backend, engine=None, table=None, directory=None):
+    if backend == "database" and engine is not None and table is not None:
+        return DatabaseBackend(engine, table)
+    if backend == "disk" and directory:
+        return DiskBackend(directory)
+    if backend not in ("memory", "database", "disk"):
+        log.error("Unknown cache backend '{}', using memory only".format(backend))
+    return None
+
+
+def invalidate_on_commit(model, namespace, keys=None, events=('after_insert', 'after_update', 'after_delete')):
+    """Drops the keys, or the whole namespace if keys is None, from the cache after a session which changed
+    instances of the model is committed. Dropping after the commit keeps other requests from caching the state
+    before the commit again"""
+    def listener(mapper, connection, target):
+        session = object_session(target)
+        if session is not None:
+            pending = session.info.setdefault('tiered_cache', set())
+            if keys is None:
+                pending.add((namespace, None))
+            else:
+                pending.update((namespace, key) for key in keys)
+
+    for name in events:
+        event.listen(model, name, listener)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_after_commit(session):
+    for namespace, key in session.info.pop('tiered_cache', ()):
+        if key is None:
+            cache.invalidate(namespace)
+        else:
+            cache.delete(namespace, key)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_after_rollback(session):
+    session.info.pop('tiered_cache', None)
+
+
+# memory only until ub.init_db sets the configured backend
+cache = TieredCache()
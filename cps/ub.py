@@ -30,9 +30,10 @@ from .cw_login import AnonymousUserMixin, current_user
 from .cw_login import user_logged_in
 
 from sqlalchemy import create_engine, exc, exists, event, text
-from sqlalchemy import Column, ForeignKey
-from sqlalchemy import String, Integer, SmallInteger, Boolean, DateTime, Float, JSON , Text
+from sqlalchemy import Column, ForeignKey, Index, Sequence
+from sqlalchemy import String, Integer, SmallInteger, BigInteger, Boolean, DateTime, Float, JSON , Text, LargeBinary
 from sqlalchemy.orm.attributes import flag_modified
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.sql.expression import func
 try:
     # Compatibility with sqlalchemy 2.0
@@ -42,7 +43,7 @@ except ImportError:
 from sqlalchemy.orm import backref, relationship, sessionmaker, Session, scoped_session
 from werkzeug.security import generate_password_hash
 from dotenv import load_dotenv
-from . import constants, logger
+from . import constants, logger, result_store, tiered_cache
 from.utils import get_env_path
 
 log = logger.create()
@@ -50,7 +51,8 @@ log = logger.create()
 session = None
 app_DB_path = None
 Base = declarative_base()
-searched_ids = {}
+# replaced by the configured store in init_db
+searched_ids = result_store.MemoryResultStore()
 
 logged_in = dict()
 oauth_support = True
@@ -117,16 +119,21 @@ def check_user_session(user_id, session_key, random):
 user_logged_in.connect(signal_store_user_session)
 
 def store_ids(result):
-    ids = list()
-    for element in result:
-        ids.append(element.id)
-    searched_ids[current_user.id] = ids
+    searched_ids.set(current_user.id, (element.id for element in result))
 
 def store_combo_ids(result):
-    ids = list()
-    for element in result:
-        ids.append(element[0].id)
-    searched_ids[current_user.id] = ids
+    searched_ids.set(current_user.id, (element[0].id for element in result))
+
+def get_searched_ids():
+    return searched_ids.get(current_user.id)
+
+def store_search_query(kind, term):
+    # Only the search itself is kept in the session, it is evaluated again if all results are added to a shelf
+    flask_session['search_query'] = {'kind': kind, 'term': term}
+    searched_ids.delete(current_user.id)
+
+def get_search_query():
+    return flask_session.get('search_query')
 
 class UserBase:
 
@@ -506,6 +513,25 @@ class ArchivedBook(Base):
     is_archived = Column(Boolean, unique=False)
     last_modified = Column(DateTime, default=datetime.datetime.utcnow)
 
+# Book ids of the last search result per user, used by the database backend of the search result store
+class SearchResult(Base):
+    __tablename__ = 'searched_ids'
+
+    key = Column(Integer, primary_key=True)
+    ids = Column(LargeBinary)
+    created = Column(DateTime)
+    accessed = Column(DateTime, index=True)
+
+# Shared tier of the cache (tiered_cache.py), unlogged as all entries can be rebuilt at any time
+class CacheEntry(Base):
+    __tablename__ = 'cache_entries'
+    __table_args__ = {'prefixes': ['UNLOGGED']}
+
+    namespace = Column(String, primary_key=True)
+    key = Column(String, primary_key=True)
+    value = Column(LargeBinary)
+    expires = Column(DateTime, index=True)
+
 class KoboSyncedBooks(Base):
     __tablename__ = 'kobo_synced_books'
     id = Column(Integer, primary_key=True, autoincrement=True)
@@ -564,6 +590,13 @@ class Downloads(Base):
     def __repr__(self):
         return '<Download %r' % self.book_id
 
+# Number of users who downloaded a book, kept up to date by update_download and delete_download
+class DownloadCount(Base):
+    __tablename__ = 'download_counts'
+
+    book_id = Column(Integer, primary_key=True)
+    count = Column(Integer, default=0, index=True)
+
 class Registration(Base):
     __tablename__ = 'registration'
 
@@ -612,6 +645,58 @@ class Thumbnail(Base):
     generated_at = Column(DateTime, default=lambda: datetime.datetime.utcnow())
     expiration = Column(DateTime, nullable=True)
 
+# Books whose covers make up the thumbnail of a series, the thumbnail is only regenerated if the signature changes
+class SeriesThumbnailSources(Base):
+    __tablename__ = 'series_thumbnail_sources'
+
+    series_id = Column(Integer, primary_key=True)
+    signature = Column(String)
+    generated_at = Column(DateTime, default=lambda: datetime.datetime.utcnow())
+
+# Parsed package facts of an epub or kepub file (data row of the calibre database), valid as long as size and
+# modification time of the file are unchanged
+class EpubPackageInfo(Base):
+    __tablename__ = 'epub_package_info'
+
+    data_id = Column(Integer, primary_key=True)
+    book_id = Column(Integer, index=True)
+    file_size = Column(BigInteger)
+    file_mtime = Column(Float)
+    opf_version = Column(String)
+    layout = Column(String)
+    spine_length = Column(Integer)
+    cover_href = Column(String)
+    scanned_at = Column(DateTime, default=lambda: datetime.datetime.utcnow())
+
+# Entries of the durable task queue (services/task_store.py), a task is stored as its class and the JSON encoded
+# constructor arguments. Only one waiting entry per dedup key is allowed
+class TaskQueueEntry(Base):
+    __tablename__ = 'task_queue'
+
+    id = Column(Integer, primary_key=True)
+    position = Column(BigInteger, Sequence('task_queue_position_seq'))
+    task_class = Column(String)
+    arguments = Column(Text)
+    user = Column(String)
+    hidden = Column(Boolean, default=False)
+    scheduled = Column(Boolean, default=False)
+    task_type = Column(String)
+    priority = Column(SmallInteger)
+    dedup_key = Column(String)
+    status = Column(String, index=True)
+    attempts = Column(Integer, default=0)
+    max_attempts = Column(Integer)
+    run_after = Column(DateTime)
+    locked_by = Column(String)
+    heartbeat = Column(DateTime)
+    last_error = Column(Text)
+    created = Column(DateTime)
+
+    __table_args__ = (
+        Index('ix_task_queue_dedup_key', 'dedup_key', unique=True, postgresql_where=text("status = 'waiting'")),
+        Index('ix_task_queue_waiting', 'priority', 'position', postgresql_where=text("status = 'waiting'")),
+    )
+
 def add_missing_tables(engine, _session):
     # For PostgreSQL, tables should be created via migrations
     # This function is kept for compatibility but won't create tables in PostgreSQL
@@ -632,10 +717,22 @@ def migrate_user_session_table(engine, _session):
     # For PostgreSQL, schema changes should be handled via migrations
     pass
 
+def migrate_download_counts(_session):
+    # fill the aggregated download counts once for existing download entries
+    try:
+        if not _session.query(exists().where(DownloadCount.book_id.isnot(None))).scalar() \
+                and _session.query(exists().where(Downloads.id.isnot(None))).scalar():
+            refresh_download_counts(_session)
+            _session.commit()
+    except exc.SQLAlchemyError as e:
+        _session.rollback()
+        log.error("Building download counts failed: {}".format(e))
+
 def migrate_Database(_session):
     # For PostgreSQL, migrations should be handled separately
     # This function is simplified for PostgreSQL
     migrate_registration_table(_session.bind, _session)
+    migrate_download_counts(_session)
 
 def clean_database(_session):
     now = datetime.datetime.now()
@@ -653,6 +750,9 @@ def update_download(book_id, user_id):
     if not check:
         new_download = Downloads(user_id=user_id, book_id=book_id)
         session.add(new_download)
+        statement = pg_insert(DownloadCount).values(book_id=book_id, count=1)
+        session.execute(statement.on_conflict_do_update(index_elements=[DownloadCount.book_id],
+                                                        set_={'count': DownloadCount.count + 1}))
         try:
             session.commit()
         except exc.OperationalError:
@@ -660,11 +760,23 @@ def update_download(book_id, user_id):
 
 def delete_download(book_id):
     session.query(Downloads).filter(book_id == Downloads.book_id).delete()
+    session.query(DownloadCount).filter(book_id == DownloadCount.book_id).delete()
     try:
         session.commit()
     except exc.OperationalError:
         session.rollback()
 
+def refresh_download_counts(_session, book_ids=None):
+    # Recalculates the download counts of the given books or of all books, the caller commits
+    counts = _session.query(Downloads.book_id, func.count(Downloads.id)).group_by(Downloads.book_id)
+    old_counts = _session.query(DownloadCount)
+    if book_ids is not None:
+        book_ids = list(book_ids)
+        counts = counts.filter(Downloads.book_id.in_(book_ids))
+        old_counts = old_counts.filter(DownloadCount.book_id.in_(book_ids))
+    old_counts.delete(synchronize_session=False)
+    _session.execute(pg_insert(DownloadCount).from_select(['book_id', 'count'], counts.statement))
+
 def create_anonymous_user(_session):
     user = User()
     user.name = "Guest"
@@ -720,6 +832,7 @@ def init_db_thread():
 def init_db(app_db_path=None):
     global session
     global app_DB_path
+    global searched_ids
 
     app_DB_path = app_db_path
     
@@ -753,6 +866,15 @@ def init_db(app_db_path=None):
     migrate_Database(session)
     clean_database(session)
 
+    searched_ids = result_store.create_store(os.getenv("SEARCH_RESULT_STORE") or "database",
+                                             engine,
+                                             SearchResult.__table__,
+                                             int(os.getenv("SEARCH_RESULT_TTL") or result_store.DEFAULT_TTL))
+    tiered_cache.cache.set_backend(tiered_cache.create_backend(os.getenv("CACHE_BACKEND") or "database",
+                                                               engine,
+                                                               CacheEntry.__table__,
+                                                               os.path.join(constants.CACHE_DIR, 'shared')))
+
     # Check if we need to create default users
     user_count = session.query(User).count()
     # log.info(f"User count is :{user_count}")
@@ -22,11 +22,12 @@ import os
 import json
 import mimetypes
 import chardet  # dependency of requests
-import copy
 import random
+from collections import namedtuple
 
 from flask import Blueprint, jsonify
 from flask import request, redirect, send_from_directory, make_response, flash, abort, url_for, Response
+from flask import stream_with_context
 from flask import session as flask_session
 from flask_babel import gettext as _
 from flask_babel import get_locale
@@ -34,7 +35,7 @@ from .cw_login import login_user, logout_user, current_user
 from flask_limiter import RateLimitExceeded
 from flask_limiter.util import get_remote_address
 from sqlalchemy.exc import IntegrityError, InvalidRequestError, OperationalError
-from sqlalchemy.sql.expression import text, func, false, not_, and_, or_
+from sqlalchemy.sql.expression import func, false, not_, and_, or_
 from sqlalchemy.orm.attributes import flag_modified
 from sqlalchemy.sql.functions import coalesce
 
@@ -43,13 +44,13 @@ from werkzeug.security import generate_password_hash, check_password_hash
 
 from . import constants, logger, isoLanguages, services
 from . import db, ub, config, app
-from . import calibre_db, kobo_sync_status
+from . import calibre_db, kobo_sync_status, serializer
 from .search import render_search_results, render_adv_search_results
 from .gdriveutils import getFileFromEbooksFolder, do_gdrive_download
 from .helper import check_valid_domain, check_email, check_username, \
     get_book_cover, get_series_cover_thumbnail, get_download_link, send_mail, generate_random_password, \
     send_registration_mail, check_send_to_ereader, check_read_formats, tags_filters, reset_password, valid_email, \
-    edit_book_read_status, valid_password
+    edit_book_read_status, valid_password, accepted_thumbnail_formats
 from .pagination import Pagination
 from .redirect import get_redirect_location
 from .babel import get_available_locale
@@ -191,6 +192,8 @@ def toggle_read(book_id):
 @user_login_required
 def toggle_archived(book_id):
     change_archived_books(book_id, message="Book {} archive bit toggled".format(book_id))
+    calibre_db.invalidate_common_filters(current_user.id)
+    calibre_db.invalidate_category_cache(current_user.id)
     # Remove book from syncd books list to force resync (?)
     remove_synced_book(book_id)
     return ""
@@ -335,11 +338,15 @@ def generate_char_list(entries): # data_colum, db_link):
     return char_list
 
 
-def query_char_list(data_colum, db_link):
-    results = (calibre_db.session.query(func.upper(func.substr(data_colum, 1, 1)).label('char'))
-            .join(db_link).join(db.Books).filter(calibre_db.common_filters())
-            .group_by(func.upper(func.substr(data_colum, 1, 1))).all())
-    return results
+RatingEntry = namedtuple('RatingEntry', ['Ratings', 'count', 'name'])
+
+
+def category_entries(query, kind, column):
+    # Pairs the categories returned by query with their cached book count, categories without visible books are
+    # filtered out by column, also returns the number of books without category
+    counts, no_category_count = calibre_db.get_category_counts(kind)
+    query = query.filter(calibre_db.category_filter(column, counts))
+    return [(entry, counts[entry.id]) for entry in query], no_category_count
 
 
 def get_sort_function(sort_param, data):
@@ -369,9 +376,9 @@ def get_sort_function(sort_param, data):
     if sort_param == 'seriesdesc':
         order = [db.Books.series_index.desc()]
     if sort_param == 'hotdesc':
-        order = [func.count(ub.Downloads.book_id).desc()]
+        order = [ub.DownloadCount.count.desc(), db.Books.id]
     if sort_param == 'hotasc':
-        order = [func.count(ub.Downloads.book_id).asc()]
+        order = [ub.DownloadCount.count.asc(), db.Books.id]
     if sort_param is None:
         sort_param = "new"
     return order, sort_param
@@ -463,33 +470,13 @@ def render_discover_books(book_id):
 def render_hot_books(page, order):
     if current_user.check_visibility(constants.SIDEBAR_HOT):
         if order[1] not in ['hotasc', 'hotdesc']:
-            # Unary expression comparison only working (for this expression) in sqlalchemy 1.4+
-            # if not (order[0][0].compare(func.count(ub.Downloads.book_id).desc()) or
-            #        order[0][0].compare(func.count(ub.Downloads.book_id).asc())):
-            order = [func.count(ub.Downloads.book_id).desc()], 'hotdesc'
-        if current_user.show_detail_random():
-            random_query = calibre_db.generate_linked_query(config.config_read_column, db.Books)
-            random = list(random_query.filter(calibre_db.common_filters())
-                     .order_by(func.random())
-                     .limit(config.config_random_books).all())
-        else:
-            random = False
-
-        off = int(int(config.config_books_per_page) * (page - 1))
-        all_books = ub.session.query(ub.Downloads.book_id, func.count(ub.Downloads.book_id).label('count')) \
-            .order_by(*order[0]).group_by(ub.Downloads.book_id)
-        hot_books = all_books.offset(off).limit(config.config_books_per_page)
-        entries = list()
-        for book in hot_books:
-            query = calibre_db.generate_linked_query(config.config_read_column, db.Books)
-            download_book = query.filter(calibre_db.common_filters()).filter(
-                book.book_id == db.Books.id).first()
-            if download_book:
-                entries.append(download_book)
-            else:
-                ub.delete_download(book.book_id)
-        num_books = entries.__len__()
-        pagination = Pagination(page, config.config_books_per_page, num_books)
+            order = [ub.DownloadCount.count.desc(), db.Books.id], 'hotdesc'
+        entries, random, pagination = calibre_db.fill_indexpage(page, 0, db.Books,
+                                                                ub.DownloadCount.count > 0,
+                                                                order[0],
+                                                                True, config.config_read_column,
+                                                                ub.DownloadCount,
+                                                                db.Books.id == ub.DownloadCount.book_id)
         return render_title_template('index.html', random=random, entries=entries, pagination=pagination,
                                      title=_("Hot Books (Most Downloaded)"), page="hot", order=order[1])
     else:
@@ -874,6 +861,8 @@ def list_books():
     off = int(request.args.get("offset") or 0)
     limit = int(request.args.get("limit") or config.config_books_per_page)
     search_param = request.args.get("search")
+    cursor = request.args.get("cursor")
+    next_cursor = None
     sort_param = request.args.get("sort", "id")
     order = request.args.get("order", "").lower()
     state = None
@@ -899,12 +888,13 @@ def list_books():
         order = [db.Languages.lang_code.asc()] if order == "asc" else [db.Languages.lang_code.desc()]
         join = db.books_languages_link, db.Books.id == db.books_languages_link.c.book, db.Languages
     elif order and sort_param in ["sort", "title", "authors_sort", "series_index"]:
-        order = [text(sort_param + " " + order)]
+        sort_column = db.Books.author_sort if sort_param == "authors_sort" else getattr(db.Books, sort_param)
+        order = [sort_column.asc()] if order == "asc" else [sort_column.desc()]
     elif not state:
         order = [db.Books.timestamp.desc()]
 
-    total_count = filtered_count = calibre_db.session.query(db.Books).filter(
-        calibre_db.common_filters(allow_show_archived=True)).count()
+    total_count = filtered_count = calibre_db.count_books(calibre_db.session.query(db.Books).filter(
+        calibre_db.common_filters(allow_show_archived=True)), "cached")
     if state is not None:
         if search_param:
             books = calibre_db.search_query(search_param, config).all()
@@ -919,7 +909,14 @@ def list_books():
                                                                     off,
                                                                     [order, ''],
                                                                     limit,
-                                                                    *join)
+                                                                    *join,
+                                                                    count_mode="cached")
+    elif cursor is not None and calibre_db.keyset_order(order):
+        try:
+            entries, next_cursor, __ = calibre_db.fill_indexpage_keyset(cursor, db.Books, limit, True, order, True,
+                                                                        config.config_read_column, None)
+        except ValueError:
+            abort(400)
     else:
         entries, __, __ = calibre_db.fill_indexpage_with_archived_books((int(off) / (int(limit)) + 1),
                                                                         db.Books,
@@ -931,22 +928,16 @@ def list_books():
                                                                         config.config_read_column,
                                                                         *join)
 
-    result = list()
-    for entry in entries:
-        val = entry[0]
-        val.is_archived = entry[1] is True
-        val.read_status = entry[2] == ub.ReadBook.STATUS_FINISHED
-        for lang_index in range(0, len(val.languages)):
-            val.languages[lang_index].language_name = isoLanguages.get_language_name(get_locale(), val.languages[
-                lang_index].lang_code)
-        result.append(val)
-
-    table_entries = {'totalNotFiltered': total_count, 'total': filtered_count, "rows": result}
-    js_list = json.dumps(table_entries, cls=db.AlchemyEncoder)
-
-    response = make_response(js_list)
-    response.headers["Content-Type"] = "application/json; charset=utf-8"
-    return response
+    schema = serializer.project(serializer.book_table_schema(calibre_db.get_cc_columns(config,
+                                                                                       filter_config_custom_read=True),
+                                                             get_locale(),
+                                                             ub.ReadBook.STATUS_FINISHED),
+                                request.args.get("fields"))
+    table_entries = {'totalNotFiltered': total_count, 'total': filtered_count}
+    if next_cursor:
+        table_entries['next_cursor'] = next_cursor
+    return Response(stream_with_context(serializer.stream_json(table_entries, "rows", entries, schema)),
+                    content_type="application/json; charset=utf-8")
 
 
 @web.route("/ajax/table_settings", methods=['POST'])
@@ -975,16 +966,12 @@ def author_list():
         else:
             order = db.Authors.sort.asc()
             order_no = 1
-        subquery = calibre_db.session.query(db.books_authors_link.c.author, func.count(db.books_authors_link.c.book).label('count')) \
-            .join(db.Books, db.Books.id == db.books_authors_link.c.book).filter(calibre_db.common_filters()) \
-            .group_by(db.books_authors_link.c.author).subquery()
-        entries = calibre_db.session.query(db.Authors, subquery.c.count) \
-            .join(subquery, db.Authors.id == subquery.c.author).order_by(order).all()
-        char_list = query_char_list(db.Authors.sort, db.books_authors_link)
-        author_copy = copy.deepcopy(entries)
-        for entry in author_copy:
-            entry.Authors.name = entry.Authors.name.replace('|', ',')
-        return render_title_template('author_list.html', entries=author_copy, folder='web.books_list', charlist=char_list,
+        # plain rows instead of Authors objects, the displayed name must not be written back to the database
+        authors = calibre_db.session.query(db.Authors.id, func.replace(db.Authors.name, '|', ',').label('name'),
+                                           db.Authors.image).order_by(order)
+        entries = category_entries(authors, 'author', db.Authors.id)[0]
+        char_list = calibre_db.get_letter_index('author')
+        return render_title_template('author_list.html', entries=entries, folder='web.books_list', charlist=char_list,
                                      title="Authors", page="author", data='author', order=order_no)
     else:
         abort(404)
@@ -1160,20 +1147,12 @@ def publisher_list():
         order = db.Publishers.name.asc()
         order_no = 1
     if current_user.check_visibility(constants.SIDEBAR_PUBLISHER):
-        subquery = calibre_db.session.query(db.books_publishers_link.c.publisher, func.count(db.books_publishers_link.c.book).label('count')) \
-            .join(db.Books, db.Books.id == db.books_publishers_link.c.book).filter(calibre_db.common_filters()) \
-            .group_by(db.books_publishers_link.c.publisher).subquery()
-        entries = calibre_db.session.query(db.Publishers, subquery.c.count) \
-            .join(subquery, db.Publishers.id == subquery.c.publisher).order_by(order).all()
-        no_publisher_count = (calibre_db.session.query(db.Books)
-                           .outerjoin(db.books_publishers_link).outerjoin(db.Publishers)
-                           .filter(db.Publishers.name == None)
-                           .filter(calibre_db.common_filters())
-                           .count())
+        entries, no_publisher_count = category_entries(calibre_db.session.query(db.Publishers).order_by(order),
+                                                       'publisher', db.Publishers.id)
         if no_publisher_count:
             entries.append([db.Category(_("None"), "-1"), no_publisher_count])
         entries = sorted(entries, key=lambda x: x[0].name.lower(), reverse=not order_no)
-        char_list = generate_char_list(entries)
+        char_list = calibre_db.get_letter_index('publisher')
         return render_title_template('publisher_list.html', entries=entries, folder='web.books_list', charlist=char_list,
                                      title=_("Publishers"), page="publisher", data="publisher", order=order_no)
     else:
@@ -1190,18 +1169,10 @@ def series_list():
         else:
             order = db.Series.sort.asc()
             order_no = 1
-        char_list = query_char_list(db.Series.sort, db.books_series_link)
+        char_list = calibre_db.get_letter_index('series')
         if current_user.get_view_property('series', 'series_view') == 'list':
-            subquery = calibre_db.session.query(db.books_series_link.c.series, func.count(db.books_series_link.c.book).label('count')) \
-                .join(db.Books, db.Books.id == db.books_series_link.c.book).filter(calibre_db.common_filters()) \
-                .group_by(db.books_series_link.c.series).subquery()
-            entries = calibre_db.session.query(db.Series, subquery.c.count) \
-                .join(subquery, db.Series.id == subquery.c.series).order_by(order).all()
-            no_series_count = (calibre_db.session.query(db.Books)
-                            .outerjoin(db.books_series_link).outerjoin(db.Series)
-                            .filter(db.Series.name == None)
-                            .filter(calibre_db.common_filters())
-                            .count())
+            entries, no_series_count = category_entries(calibre_db.session.query(db.Series).order_by(order),
+                                                        'series', db.Series.id)
             if no_series_count:
                 entries.append([db.Category(_("None"), "-1"), no_series_count])
             entries = sorted(entries, key=lambda x: x[0].name.lower(), reverse=not order_no)
@@ -1237,16 +1208,11 @@ def ratings_list():
         else:
             order = db.Ratings.rating.asc()
             order_no = 1
-        subquery = calibre_db.session.query(db.books_ratings_link.c.rating, func.count(db.books_ratings_link.c.book).label('count')) \
-            .join(db.Books, db.Books.id == db.books_ratings_link.c.book).filter(calibre_db.common_filters()) \
-            .group_by(db.books_ratings_link.c.rating).subquery()
-        entries = calibre_db.session.query(db.Ratings, subquery.c.count, (db.Ratings.rating / 2).label('name')) \
-            .join(subquery, db.Ratings.id == subquery.c.rating).filter(db.Ratings.rating > 0).order_by(order).all()
-        no_rating_count = (calibre_db.session.query(db.Books)
-                           .outerjoin(db.books_ratings_link).outerjoin(db.Ratings)
-                           .filter(or_(db.Ratings.rating == None, db.Ratings.rating == 0))
-                           .filter(calibre_db.common_filters())
-                           .count())
+        counts, no_rating_count = calibre_db.get_category_counts('rating')
+        entries = [RatingEntry(rating, counts[rating.id], name) for rating, name in
+                   calibre_db.session.query(db.Ratings, (db.Ratings.rating / 2).label('name'))
+                   .filter(db.Ratings.rating > 0, calibre_db.category_filter(db.Ratings.id, counts))
+                   .order_by(order)]
         if no_rating_count:
             entries.append([db.Category(_("None"), "-1", -1), no_rating_count])
         entries = sorted(entries, key=lambda x: x[0].rating, reverse=not order_no)
@@ -1266,19 +1232,10 @@ def formats_list():
         else:
             order = db.Data.format.asc()
             order_no = 1
-        entries = calibre_db.session.query(db.Data.format.label('format'),
-                                           func.count('data.book').label('count')) \
-            .join(db.Books).filter(calibre_db.common_filters()) \
-            .group_by(db.Data.format).order_by(order).all()
-        
+        counts, no_format_count = calibre_db.get_category_counts('format')
         final_entries = []
-        for entry in entries:
-            final_entries.append([db.Category(entry.format, entry.format), entry.count])
-        
-        no_format_count = (calibre_db.session.query(db.Books).outerjoin(db.Data)
-                           .filter(db.Data.format == None)
-                           .filter(calibre_db.common_filters())
-                           .count())
+        for book_format in sorted(counts, reverse=not order_no):
+            final_entries.append([db.Category(book_format, book_format), counts[book_format]])
         if no_format_count:
             final_entries.append([db.Category(_("None"), "-1"), no_format_count])
         return render_title_template('formats.html', entries=final_entries, folder='web.books_list', charlist=list(),
@@ -1310,20 +1267,12 @@ def category_list():
         else:
             order = db.Tags.name.asc()
             order_no = 1
-        subquery = calibre_db.session.query(db.books_tags_link.c.tag, func.count(db.books_tags_link.c.book).label('count')) \
-            .join(db.Books, db.Books.id == db.books_tags_link.c.book).filter(calibre_db.common_filters()) \
-            .group_by(db.books_tags_link.c.tag).subquery()
-        entries = calibre_db.session.query(db.Tags, subquery.c.count) \
-            .join(subquery, db.Tags.id == subquery.c.tag).order_by(order).all()
-        no_tag_count = (calibre_db.session.query(db.Books)
-                         .outerjoin(db.books_tags_link).outerjoin(db.Tags)
-                        .filter(db.Tags.name == None)
-                         .filter(calibre_db.common_filters())
-                         .count())
+        entries, no_tag_count = category_entries(calibre_db.session.query(db.Tags).order_by(order), 'tag',
+                                                  db.Tags.id)
         if no_tag_count:
             entries.append([db.Category(_("None"), "-1"), no_tag_count])
         entries = sorted(entries, key=lambda x: x[0].name.lower(), reverse=not order_no)
-        char_list = generate_char_list(entries)
+        char_list = calibre_db.get_letter_index('tag')
         return render_title_template('list.html', entries=entries, folder='web.books_list', charlist=char_list,
                                      title=_("Categories"), page="category", data="category", order=order_no)
     else:
@@ -1346,7 +1295,8 @@ def get_cover(book_id, resolution=None):
         'lg': constants.COVER_THUMBNAIL_LARGE,
     }
     cover_resolution = resolutions.get(resolution, None)
-    return get_book_cover(book_id, cover_resolution)
+    return get_book_cover(book_id, cover_resolution, request.args.get('c'),
+                          accepted_thumbnail_formats(request.args.get('format')))
 
 
 @web.route("/series_cover/<int:series_id>")
@@ -1926,8 +1876,11 @@ def show_book(book_id):
 @login_required_if_no_ano
 def mobile_get_all_books():
     off = int(request.args.get("offset") or 0)
-    limit = calibre_db.get_total_book_count()
+    # without limit the whole library is returned, the app relies on it
+    limit = int(request.args.get("limit") or calibre_db.get_total_book_count())
     search_param = request.args.get("search")
+    cursor = request.args.get("cursor")
+    next_cursor = None
     sort_param = request.args.get("sort", "id")
     order = request.args.get("order", "").lower()
     state = None
@@ -1953,12 +1906,13 @@ def mobile_get_all_books():
         order = [db.Languages.lang_code.asc()] if order == "asc" else [db.Languages.lang_code.desc()]
         join = db.books_languages_link, db.Books.id == db.books_languages_link.c.book, db.Languages
     elif order and sort_param in ["sort", "title", "authors_sort", "series_index"]:
-        order = [text(sort_param + " " + order)]
+        sort_column = db.Books.author_sort if sort_param == "authors_sort" else getattr(db.Books, sort_param)
+        order = [sort_column.asc()] if order == "asc" else [sort_column.desc()]
     elif not state:
         order = [db.Books.timestamp.desc()]
 
-    total_count = filtered_count = calibre_db.session.query(db.Books).filter(
-        calibre_db.common_filters(allow_show_archived=True)).count()
+    total_count = filtered_count = calibre_db.count_books(calibre_db.session.query(db.Books).filter(
+        calibre_db.common_filters(allow_show_archived=True)), "cached")
     if state is not None:
         if search_param:
             books = calibre_db.search_query(search_param, config).all()
@@ -1973,7 +1927,14 @@ def mobile_get_all_books():
                                                                     off,
                                                                     [order, ''],
                                                                     limit,
-                                                                    *join)
+                                                                    *join,
+                                                                    count_mode="cached")
+    elif cursor is not None and calibre_db.keyset_order(order):
+        try:
+            entries, next_cursor, __ = calibre_db.fill_indexpage_keyset(cursor, db.Books, limit, True, order, True,
+                                                                        config.config_read_column, None)
+        except ValueError:
+            abort(400)
     else:
         entries, __, __ = calibre_db.fill_indexpage_with_archived_books((int(off) / (int(limit)) + 1),
                                                                         db.Books,
@@ -1985,66 +1946,26 @@ def mobile_get_all_books():
                                                                         config.config_read_column,
                                                                         *join)
 
-    result = list()
-    for entry in entries:
-        val = entry[0]
-        val.is_archived = entry[1] is True
-        val.read_status = entry[2] == ub.ReadBook.STATUS_FINISHED
-        for lang_index in range(0, len(val.languages)):
-            val.languages[lang_index].language_name = isoLanguages.get_language_name(get_locale(), val.languages[
-                lang_index].lang_code)
-        result.append(val)
-
-
-    table_entries = {'totalNotFiltered': total_count, 'total': filtered_count, "rows": result}
-    parent_metadata = {'title':'getmyebooks','numberOfItems':len(result)}
-    parent_link = [{"rel": "self","href": "","type": "application/opds+json"}]
-    publication_list = list()
-    mimetype_of_pdf = 'application/pdf'
-    mimetype_of_epub = 'application/epub+zip'
     env_url = "https://getmyebook.in"
-    for data in result:
-        publication_metadata_dict = {
-            "@type": "http://schema.org/Book",
-            "title": data.title,
-            "subtitle": "",
-            "author": data.authors[0].name,
-            "identifier": data.identifiers,
-            "language": data.languages,
-            "modified": data.last_modified,
-            "published": data.pubdate,
-            "publisher": data.publishers,
-            "imprint": "",
-            "numberOfPages": 0,
-            "subject": [],
-            "belongsTo": {},
-            "description" : ""
-        }
-        book_id = data.id;
-        book_data = calibre_db.get_book_data_by_id(book_id)
-        book_format = book_data.format.lower()
-        mimetype = mimetype_of_pdf if book_format=='pdf' else mimetype_of_epub
-        publication_links_list = [{
-            "rel": env_url,
-            "href": f"{env_url}/download/{book_id}/{book_format}/{book_id}.{book_format}",
-            "type": mimetype
-        }]
-        publication_images_list = [{
-            "href": f"{env_url}/cover/{book_id}",
-            "type": "image/jpg",
-            "height": 0,
-            "width": 0
-        }]
-        publication_dict = {
-            'metadata': publication_metadata_dict,
-            'links': publication_links_list,
-            'images': publication_images_list
-        }
-        publication_list.append(publication_dict)
-    final_dict = {'metadata':parent_metadata,'links':parent_link,'publications':publication_list}
-    print(final_dict)
-    js_list = json.dumps(final_dict, cls=db.AlchemyEncoder,default=str)
-
-    response = make_response(js_list)
-    response.headers["Content-Type"] = "application/json; charset=utf-8"
-    return response
+    book_formats = {book_id: book_format.lower() for book_id, book_format
+                    in calibre_db.get_book_formats(entry[0].id for entry in entries).items()}
+    schema = serializer.publication_schema(serializer.project(serializer.publication_metadata_schema(),
+                                                              request.args.get("fields")),
+                                           book_formats,
+                                           env_url)
+    parent_metadata = {'title': 'getmyebooks', 'numberOfItems': len(entries)}
+    parent_link = [{"rel": "self", "href": "", "type": "application/opds+json"}]
+    if next_cursor:
+        parent_link.append({"rel": "next",
+                            "href": url_for('web.mobile_get_all_books', cursor=next_cursor, limit=limit,
+                                            sort=sort_param, order=request.args.get("order", "")),
+                            "type": "application/opds+json"})
+    elif state is None and filtered_count is not None and off + len(entries) < filtered_count:
+        parent_link.append({"rel": "next",
+                            "href": url_for('web.mobile_get_all_books', offset=off + limit, limit=limit,
+                                            sort=sort_param, order=request.args.get("order", ""),
+                                            search=search_param),
+                            "type": "application/opds+json"})
+    head = {'metadata': parent_metadata, 'links': parent_link}
+    return Response(stream_with_context(serializer.stream_json(head, "publications", entries, schema)),
+                    content_type="application/json; charset=utf-8")
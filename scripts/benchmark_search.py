@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Search Latency Benchmark
+Times the simple search with the full text search index against the ILIKE search used without it,
+on the database configured for the app (.env)
+
+Usage: python scripts/benchmark_search.py [-n RUNS] [-u USER] [term ...]
+The app server has to be stopped, it holds locks the startup of the app waits for
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+# Add project root to path
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, project_root)
+
+DEFAULT_TERMS = ['a', 'the', 'harry', 'history', 'ography', 'zzzz']
+PAGE_SIZE = 60
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Benchmark of the simple search with and without search index')
+    parser.add_argument('-n', '--runs', type=int, default=20, help='timed runs per term and search path')
+    parser.add_argument('-u', '--user', default='admin', help='user whose restrictions apply to the search')
+    parser.add_argument('terms', nargs='*', default=DEFAULT_TERMS, help='search terms')
+    return parser.parse_args()
+
+
+def time_search(calibre_db, config, term, runs):
+    """Milliseconds of the count and the first result page of every run"""
+    timings = list()
+    for __ in range(runs + 1):
+        start = time.perf_counter()
+        calibre_db.get_search_results(term, config, 0, None, PAGE_SIZE)
+        timings.append((time.perf_counter() - start) * 1000)
+    # the first run warms up the caches of the database
+    return timings[1:]
+
+
+def main():
+    args = parse_arguments()
+    sys.argv = sys.argv[:1]
+
+    from cps import create_app, calibre_db, config, search_index, ub
+    from cps.cw_login import login_user
+
+    app = create_app()
+    with app.test_request_context():
+        user = ub.session.query(ub.User).filter(ub.User.name == args.user).first()
+        if not user:
+            print("User {} not found".format(args.user))
+            return False
+        login_user(user)
+        if not search_index._update_ready_state():
+            print("The search index is not in sync with the books, run the 'Update Search Index' task first")
+            return False
+        engine = search_index._state['engine']
+        print("{:<12} {:>8} {:>12} {:>12} {:>12} {:>12}".format(
+            'term', 'matches', 'index p50', 'index p95', 'ilike p50', 'ilike p95'))
+        for term in args.terms:
+            search_index.mark_ready()
+            __, matches, __ = calibre_db.get_search_results(term, config, 0, None, PAGE_SIZE)
+            index_times = time_search(calibre_db, config, term, args.runs)
+            # without engine the search falls back to ILIKE
+            search_index._state['engine'] = None
+            try:
+                ilike_times = time_search(calibre_db, config, term, args.runs)
+            finally:
+                search_index._state['engine'] = engine
+            print("{:<12} {:>8} {:>12.1f} {:>12.1f} {:>12.1f} {:>12.1f}".format(
+                term, matches,
+                statistics.median(index_times), statistics.quantiles(index_times, n=20)[-1],
+                statistics.median(ilike_times), statistics.quantiles(ilike_times, n=20)[-1]))
+    return True
+
+
+if __name__ == '__main__':
+    success = False
+    try:
+        success = main()
+    except Exception:
+        import traceback
+        traceback.print_exc()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        # the worker and scheduler threads started with the app are not waited for
+        os._exit(0 if success else 1)
@@ -0,0 +1,73 @@
+from flask import Flask
+from flask_login import LoginManager, current_user, login_user
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+from cps import ub
+from cps.forum import db
+from cps.forum.database.models import Category, Comment, CommentLike, CommentReactionCounts, Thread
+from cps.forum.src.api.comment_schema import comments_schema
+
+
+def _count_statements(engine, statements):
+    @event.listens_for(engine, "before_cursor_execute")
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+
+def test_load_tree_query_count(monkeypatch):
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+    app.config["SECRET_KEY"] = "test"
+    db.init_app(app)
+    LoginManager(app)
+
+    users_engine = create_engine("sqlite://")
+    ub.User.__table__.create(users_engine)
+    users_session = sessionmaker(bind=users_engine)()
+    monkeypatch.setattr(ub, "session", users_session, raising=False)
+
+    with app.app_context():
+        db.metadata.create_all(db.engine, tables=[model.__table__ for model in
+                                                  (Category, Thread, Comment, CommentLike, CommentReactionCounts)])
+        users = [ub.User(name="user{}".format(i), email="user{}@example.org".format(i)) for i in range(3)]
+        users_session.add_all(users)
+        users_session.commit()
+
+        category = Category(name="Books", slug="books")
+        thread = Thread(title="Thread", slug="thread", content="", book_id=1, category=category)
+        db.session.add(thread)
+        db.session.flush()
+        thread_id = thread.id
+        # every top level comment has a reply, which has a reply of its own
+        for root_number in range(4):
+            parent = None
+            for depth in range(3):
+                comment = Comment(content="c", thread_id=thread_id, user_id=users[depth].id,
+                                  parent_id=parent.id if parent else None)
+                db.session.add(comment)
+                db.session.flush()
+                db.session.add(CommentLike(user_id=users[0].id, comment_id=comment.id, reaction_type="love"))
+                db.session.add(CommentReactionCounts(comment_id=comment.id, total=1, love_count=1))
+                parent = comment
+        db.session.commit()
+        db.session.expunge_all()
+        thread = db.session.get(Thread, thread_id)
+
+        # the comments are dumped like comments.index does for a logged in user
+        with app.test_request_context():
+            login_user(users_session.get(ub.User, users[0].id))
+            statements = []
+            _count_statements(db.engine, statements)
+            _count_statements(users_engine, statements)
+            roots = comments_schema.dump(Comment.load_tree(thread, current_user))
+
+        # the comments with their counters, the reactions of the user and the authors
+        assert len(statements) == 3
+        assert len(roots) == 4
+        assert all(len(root["replies"]) == 1 and len(root["replies"][0]["replies"]) == 1 for root in roots)
+        assert roots[0]["top_reaction"] == "love"
+        assert roots[0]["likes_count"] == 1
+        assert roots[0]["replies"][0]["current_user_reaction"] == "love"
+        assert roots[0]["replies"][0]["liked_by_current_user"]
+        assert roots[0]["replies"][0]["owner"]["name"] == "user1"
@@ -0,0 +1,63 @@
+from types import SimpleNamespace
+
+from flask import Flask
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.sql.expression import true
+
+from cps import db, ub
+from cps.cw_login import LoginManager, login_user
+
+
+def _count_statements(engine, statements):
+    @event.listens_for(engine, "before_cursor_execute")
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+
+def test_fill_indexpage_orders_authors_with_constant_query_count(monkeypatch):
+    app = Flask(__name__)
+    app.config["SECRET_KEY"] = "test"
+    LoginManager(app)
+
+    engine = create_engine("sqlite://")
+    db.Base.metadata.create_all(engine, tables=[db.Books.__table__, db.Authors.__table__,
+                                                db.books_authors_link])
+    ub.Base.metadata.create_all(engine, tables=[ub.User.__table__, ub.User_Sessions.__table__,
+                                                ub.ArchivedBook.__table__])
+    session = sessionmaker(bind=engine, expire_on_commit=False)()
+    monkeypatch.setattr(ub, "session", session, raising=False)
+
+    user = ub.User(name="user", email="user@example.org", default_language="all", sidebar_view=0)
+    session.add(user)
+    for number in range(10):
+        # the author sort lists the authors in reverse order of their creation
+        authors = [db.Authors("Author {}-{}".format(number, index), "Sort {}-{}".format(number, index))
+                   for index in range(3)]
+        book = db.Books("Book {}".format(number), "Book {}".format(number),
+                        " & ".join(author.sort for author in reversed(authors)),
+                        None, None, "1.0", None, "path/{}".format(number), None, None, None)
+        book.authors = authors
+        session.add(book)
+    session.commit()
+    user_id = user.id
+    session.expunge_all()
+
+    calibre_db = db.CalibreDB()
+    calibre_db.session = session
+    calibre_db.config = SimpleNamespace(config_books_per_page=10, config_random_books=4,
+                                        config_restricted_column=0)
+
+    with app.test_request_context():
+        login_user(session.get(ub.User, user_id))
+        statements = []
+        _count_statements(engine, statements)
+        entries, __, pagination = calibre_db.fill_indexpage(1, 0, db.Books, true(), [db.Books.sort])
+        names = [[author.name for author in entry.ordered_authors] for entry in entries]
+
+    # the count, the page of books and the authors of all books of the page
+    assert len(statements) == 3
+    assert pagination.total_count == 10
+    assert len(entries) == 10
+    assert names[0] == ["Author 0-2", "Author 0-1", "Author 0-0"]
+    assert all(len(authors) == 3 for authors in names)
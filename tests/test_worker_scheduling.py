@@ -0,0 +1,98 @@
+import threading
+from datetime import datetime
+
+from cps.services.worker import (CalibreTask, QueuedTask, TaskQueue, WorkerThread, PRIORITY_BULK,
+                                 PRIORITY_INTERACTIVE)
+
+
+class DummyTask(CalibreTask):
+    def __init__(self, task_type='default', priority=None, exclusive=False):
+        super(DummyTask, self).__init__('dummy')
+        self.task_type = task_type
+        if priority is not None:
+            self.priority = priority
+        self.exclusive = exclusive
+
+    def run(self, worker_thread):
+        pass
+
+    @property
+    def name(self):
+        return 'Dummy'
+
+    @property
+    def is_cancellable(self):
+        return False
+
+
+def _worker(store=None, pool_size=4):
+    # the dispatcher state of a worker, without starting its thread or its pool
+    worker = WorkerThread.__new__(WorkerThread)
+    worker.doLock = threading.RLock()
+    worker.queue = TaskQueue(worker.doLock)
+    worker.running = dict()
+    worker.exclusive_running = False
+    worker.store = store
+    worker.claimed = set()
+    worker.dequeued = list()
+    worker.pool_size = pool_size
+    worker.num = 0
+    return worker
+
+
+def _add(worker, task):
+    worker.num += 1
+    item = QueuedTask(num=worker.num, user='System', added=datetime.now(), task=task, hidden=False)
+    worker.queue.put(item)
+    return item
+
+
+def _start(worker, item):
+    worker.queue.remove(item)
+    worker._start_item(item)
+
+
+def test_exclusive_task_holds_back_later_tasks():
+    worker = _worker(store=object())
+    _start(worker, _add(worker, DummyTask('convert')))
+    exclusive = _add(worker, DummyTask('database', exclusive=True))
+    _add(worker, DummyTask('clean'))
+
+    # the exclusive task waits for the running task, the task behind it and the durable queue wait as well
+    assert worker._next_task() is None
+    assert not worker._can_claim()
+
+    worker.running['convert'] = 0
+    assert worker._next_task() is exclusive
+    _start(worker, exclusive)
+    assert worker._next_task() is None
+    assert not worker._can_claim()
+
+
+def test_email_tasks_run_two_at_a_time():
+    worker = _worker()
+    mails = [_add(worker, DummyTask('email')) for __ in range(3)]
+    other = _add(worker, DummyTask('convert'))
+
+    _start(worker, worker._next_task())
+    _start(worker, worker._next_task())
+    assert worker.running['email'] == 2
+    # the third mail waits, the task of another type behind it is started
+    assert worker._next_task() is other
+    _start(worker, other)
+    assert worker._next_task() is None
+    assert worker.queue.to_list() == [mails[2]]
+
+
+def test_priority_wins_over_submission_order():
+    worker = _worker()
+    bulk = _add(worker, DummyTask('thumbnail', priority=PRIORITY_BULK))
+    normal = _add(worker, DummyTask('convert'))
+    interactive = _add(worker, DummyTask('email', priority=PRIORITY_INTERACTIVE))
+
+    started = list()
+    for __ in range(3):
+        item = worker._next_task()
+        _start(worker, item)
+        started.append(item)
+    assert started == [interactive, normal, bulk]